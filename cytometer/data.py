@@ -18,6 +18,8 @@ import shutil
 import glob
 import warnings
 import pickle
+import base64
+import json
 import ujson
 import time
 from PIL import Image
@@ -37,7 +39,6 @@ import six
 from svgpathtools import svg2paths
 import random
 import colorsys
-from shapely.geometry import Polygon
 import pyvips
 import aicsimageio
 from aicsimageio.readers.czi_reader import CziReader
@@ -594,7 +595,8 @@ def area2quantile(areas, quantiles=np.linspace(0.0, 1.0, 101)):
     Return function to map from cell areas to quantiles.
 
     :param areas: Vector with random sample that is representative of area values in the population. The probability
-    distribution and quantiles are computed from this random sample.
+    distribution and quantiles are computed from this random sample. Alternatively, QuantileSketch of the population,
+    e.g. merged from the sketches of all the slides in a cohort.
     :param quantiles: (def np.linspace(0.0, 1.0, 101)) Quantiles values in [0.0, 1.0] at which the function will be
     linearly interpolated.
     :return:
@@ -602,14 +604,17 @@ def area2quantile(areas, quantiles=np.linspace(0.0, 1.0, 101)):
     outside the range are mapped to 0.0 (smaller) or 1.0 (larger).
     """
 
-    areas_by_quantiles = scipy.stats.mstats.hdquantiles(areas, prob=quantiles)
-    f_area2quantile = scipy.interpolate.interp1d(areas_by_quantiles.data, quantiles, bounds_error=False,
+    if isinstance(areas, QuantileSketch):
+        areas_by_quantiles = areas.quantile(quantiles)
+    else:
+        areas_by_quantiles = scipy.stats.mstats.hdquantiles(areas, prob=quantiles).data
+    f_area2quantile = scipy.interpolate.interp1d(areas_by_quantiles, quantiles, bounds_error=False,
                                                fill_value=(0.0, 1.0))
 
-    if DEBUG:
+    if DEBUG and not isinstance(areas, QuantileSketch):
         plt.clf()
         fig = plt.hist(areas, bins=50, density=True, histtype='step')
-        for x in areas_by_quantiles.data:
+        for x in areas_by_quantiles:
             plt.plot([x, x], [0, fig[0].max()], 'k')
 
     return f_area2quantile
@@ -733,7 +738,7 @@ def aida_contour_items(contours, f_area2quantile, cm='quantiles_aida', xres=1.0,
         raise ValueError('Only quantiles_aida colourmap is implemented')
 
     # compute area of each contour
-    areas = [Polygon(c).area * xres * yres for c in contours]  # (um^2)
+    areas = polygon_metrics(*pack_contours(contours))['area'] * xres * yres  # (um^2)
 
     # convert to quantiles
     q = f_area2quantile(areas)
@@ -811,6 +816,10 @@ def aida_write_new_items(filename, items, mode='append_to_last_layer', indent=0,
                          double_precision=10, number_of_attempts=1):
     """
     Create a new or update existing AIDA annotations file, adding new items.
+
+    Note: This function reads and rewrites the whole file. To add items many times to the same file (e.g. once per
+    tile in a full slide segmentation), use AidaAnnotationWriter instead.
+
     :param filename: String with path to .json annotations file.
     :param items: List of items, obtained e.g. with aida_contour_items() or aida_rectangle_items().
     :param mode:
@@ -920,6 +929,532 @@ def aida_write_new_items(filename, items, mode='append_to_last_layer', indent=0,
             raise
 
 
+def _retry_network_filesystem(number_of_attempts, fun, *args):
+    """
+    If we are trying to save to a network filesystem, the server hosting the filesystem may return a
+    ConnectionResetError. We let the user try a couple of times, with a little wait between tries.
+    """
+    for attempt in range(number_of_attempts):
+        try:
+            return fun(*args)
+        except ConnectionResetError:
+            print('# ======> ConnectionResetError. Attempt ' + str(attempt) + '/' + str(number_of_attempts)
+                  + ' ...')
+            if attempt == number_of_attempts - 1:
+                raise
+            time.sleep(5)  # secs
+        except BrokenPipeError:
+            print('# ======> BrokenPipeError. Attempt ' + str(attempt) + '/' + str(number_of_attempts)
+                  + ' ...')
+            if attempt == number_of_attempts - 1:
+                raise
+            time.sleep(5)  # secs
+
+
+class AidaAnnotationWriter(object):
+    """
+    Incremental writer for AIDA annotations files.
+
+    aida_write_new_items() reads, parses and rewrites the whole annotations file every time it's called, so writing
+    the annotations of a full slide tile by tile takes a time that grows quadratically with the number of tiles. This
+    class keeps the file open and only rewrites its tail.
+
+    The annotations file has this structure:
+
+        {"name": "DeepCytometer annotations", "layers": [<committed layers>, <open layers>]}
+
+    Committed layers are written once and never touched again. Open layers are the last layer of each item type
+    ('White adipocyte N' for paths, 'Blocks N' for rectangles), as those are the only ones that items can be appended to
+    with mode='append_to_last_layer'. Open layers are kept in memory (already encoded as JSON) and rewritten after the
+    committed layers on each flush. When a new layer of the same item type is created, the previous open layer is
+    committed, i.e. appended to the end of the committed part of the file (truncating the tail, similarly to
+    append_paths_to_aida_json_file()).
+
+    Flushes are atomic: the bytes that replace the tail are first saved to a small write-ahead file (filename + '.wal')
+    with a rename, and then written in place. If the process is killed during the in-place write, the next time the
+    file is opened (mode 'a') the tail is written again from the write-ahead file. When the writer is opened, the file
+    is rebuilt in filename + '.tmp' and renamed, so that the previous contents are never lost. The write-ahead file is
+    removed on close().
+
+    Note that layers are not necessarily written in the same order they were created, e.g. the 'Blocks' layer that
+    receives one rectangle per tile will be written after the 'White adipocyte N' layers. AIDA and aida_get_contours()
+    don't depend on the layer order.
+
+    Usage:
+
+        with cytometer.data.AidaAnnotationWriter(annotations_file, mode='w', number_of_attempts=5) as writer:
+            for ...:
+                writer.write_new_items(rectangle_item, mode='append_to_last_layer')
+                writer.write_new_items(contour_items, mode='append_new_layer')
+    """
+
+    # layer name that corresponds to each item type
+    _layer_names = {'path': 'White adipocyte', 'rectangle': 'Blocks'}
+
+    def __init__(self, filename, mode='w', indent=0, ensure_ascii=False, number_of_attempts=1,
+                 name='DeepCytometer annotations', layer_item_counts=None):
+        """
+        Open a new or existing AIDA annotations file for incremental writing.
+
+        :param filename: String with path to .json annotations file.
+        :param mode: (def 'w')
+            - 'w': Overwrite existing file, or create a new one.
+            - 'a': Append to existing file, or create a new one if it doesn't exist. The existing file is loaded
+              (completing any flush interrupted by a crash) and rewritten once with the layout described in the class
+              help.
+        :param indent: (def 0) Number of indentation spaces for pretty print format of each item and layer.
+        :param ensure_ascii: (def False) Limits output to ASCII and escapes all extended characters above 127.
+        :param number_of_attempts: (def 1) Number of times we try to write the file if the server returns
+        ConnectionResetError or BrokenPipeError.
+        :param name: (def 'DeepCytometer annotations') Name of the annotations object if a new file is created.
+        :param layer_item_counts: (def None) With mode='a', dictionary {layer_name: number_of_items}, as returned by
+        self.layer_item_counts() at some earlier point. Existing layers not in the dictionary are removed, and layers
+        with more items are truncated, so that the file goes back to that point. This is used to resume a job after a
+        crash, as the annotations file may have been written for a tile that the job state doesn't have yet (see
+        SlideJobState).
+        """
+
+        self.filename = filename
+        self.indent = indent
+        self.ensure_ascii = ensure_ascii
+        self.number_of_attempts = number_of_attempts
+
+        # layers waiting to be written to the committed part of the file (JSON strings)
+        self._layers_to_commit = []
+
+        # open layers, one per item type: {item_type: {'name':..., 'opacity':..., 'items': [JSON strings]}}
+        self._open_layers = {}
+
+        # last layer number used for each item type
+        self._layer_number = {}
+
+        # number of items in each layer: {layer_name: number_of_items}
+        self._item_counts = {}
+
+        # existing layers that will be written when the file is first flushed
+        layers = []
+
+        if mode not in ['w', 'a']:
+            raise NotImplementedError('mode not implemented: ' + mode)
+
+        if mode == 'a' and os.path.isfile(filename):
+
+            # complete a flush interrupted by a crash
+            if os.path.isfile(self._wal_filename()):
+                self._retry(self._apply_wal)
+
+            # load existing data
+            with open(filename) as fp:
+                annotations = ujson.load(fp)
+
+            # check that this file has the expected format
+            if 'name' not in annotations:
+                raise KeyError('Annotations have no \'name\' key')
+            if 'layers' not in annotations:
+                raise KeyError('Annotations have no \'layers\' key')
+
+            name = annotations['name']
+            layers = annotations['layers']
+
+            # roll back items written after the layer_item_counts snapshot
+            if layer_item_counts is not None:
+                layers = [dict(layer, items=layer['items'][:layer_item_counts[layer['name']]])
+                          for layer in layers if layer['name'] in layer_item_counts]
+
+        # find the last layer of each item type, which will be kept open so that we can append items to it. Layers
+        # with other names (e.g. edited in AIDA) are kept as they are
+        i_open_layers = {}
+        for l, layer in enumerate(layers):
+            for item_type, layer_name in self._layer_names.items():
+                match = re.fullmatch(re.escape(layer_name) + r' (\d+)', layer['name'])
+                if match is not None:
+                    i_open_layers[item_type] = l
+                    self._layer_number[item_type] = max(self._layer_number.get(item_type, -1),
+                                                        int(match.group(1)))
+
+        for l, layer in enumerate(layers):
+            self._item_counts[layer['name']] = len(layer['items'])
+            if l in i_open_layers.values():
+                item_type = [k for k, v in i_open_layers.items() if v == l][0]
+                self._open_layers[item_type] = {'name': layer['name'], 'opacity': layer.get('opacity', 1.0),
+                                                'items': [self._dumps(item) for item in layer['items']]}
+            else:
+                self._layers_to_commit.append(self._dumps(layer))
+
+        # header, and position of the end of the committed part of the file
+        self._header = ('{"name":' + self._dumps(name) + ',"layers":[').encode('utf-8')
+        self._number_of_committed_layers = 0
+        self._committed_pos = len(self._header)
+
+        # the write-ahead file refers to the previous layout of the file, so it's removed before replacing the file
+        self._fp = None
+        self._retry(self._remove_wal)
+
+        # write the whole file to a temporary file, and replace the existing file, if any
+        committed, tail, n = self._pending_bytes()
+
+        def write_tmp_file():
+            with open(filename + '.tmp', 'wb') as fp:
+                fp.write(self._header + committed + tail)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(filename + '.tmp', filename)
+
+        self._retry(write_tmp_file)
+        self._commit_pending(committed, n)
+
+        # reopen the file to rewrite its tail in the following flushes
+        self._fp = self._retry(open, filename, 'r+b')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _dumps(self, obj):
+        return ujson.dumps(obj, indent=self.indent, ensure_ascii=self.ensure_ascii)
+
+    def _retry(self, fun, *args):
+        return _retry_network_filesystem(self.number_of_attempts, fun, *args)
+
+    def _wal_filename(self):
+        return self.filename + '.wal'
+
+    def _apply_wal(self):
+        """
+        Write the tail saved in the write-ahead file to the annotations file.
+        """
+        with open(self._wal_filename(), 'rb') as fp:
+            pos = int(fp.readline())
+            data = fp.read()
+        with open(self.filename, 'r+b') as fp:
+            fp.seek(pos)
+            fp.write(data)
+            fp.truncate()
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def _remove_wal(self):
+        if os.path.isfile(self._wal_filename()):
+            os.remove(self._wal_filename())
+
+    def write_new_items(self, items, mode='append_to_last_layer', flush=True):
+        """
+        Add new items to the annotations file.
+
+        :param items: List of items, obtained e.g. with aida_contour_items() or aida_rectangle_items().
+        :param mode:
+            - 'append_to_last_layer': (def) Append items to the last layer with the same item type.
+            - 'append_new_layer': Create new layer for items.
+        :param flush: (def True) Write the changes to the file. If False, changes are kept in memory until the next
+        flush.
+        :return:
+        * None
+        """
+
+        if self._fp is None:
+            raise ValueError('I/O operation on closed AidaAnnotationWriter')
+        if type(items) != list:
+            raise SyntaxError('items must be a list, but is type: ' + str(type(items)))
+        if len(items) == 0:
+            return
+
+        # get item type
+        item_type = items[0]['type']
+        if item_type not in self._layer_names:
+            raise NotImplementedError('item_type not implemented: ' + item_type)
+
+        # if no layer exists, we'll need to add a new layer
+        if item_type not in self._open_layers:
+            mode = 'append_new_layer'
+
+        if mode == 'append_new_layer':
+
+            # the previous layer of this type won't get any more items, so it can be committed
+            if item_type in self._open_layers:
+                self._layers_to_commit.append(self._layer_to_json(self._open_layers[item_type]))
+
+            # new layer object
+            layer_number = self._layer_number.get(item_type, -1) + 1
+            self._layer_number[item_type] = layer_number
+            self._open_layers[item_type] = {'name': self._layer_names[item_type] + ' ' + str(layer_number),
+                                            'opacity': 1.0, 'items': []}
+
+        elif mode != 'append_to_last_layer':
+            raise NotImplementedError('mode not implemented: ' + mode)
+
+        self._open_layers[item_type]['items'] += [self._dumps(item) for item in items]
+        layer_name = self._open_layers[item_type]['name']
+        self._item_counts[layer_name] = self._item_counts.get(layer_name, 0) + len(items)
+
+        if flush:
+            self.flush()
+
+    def layer_item_counts(self):
+        """
+        Number of items in each layer, to save with the job state. See layer_item_counts in __init__().
+
+        :return:
+        * Dictionary {layer_name: number_of_items}.
+        """
+        return dict(self._item_counts)
+
+    def _layer_to_json(self, layer):
+        return '{"name":' + self._dumps(layer['name']) + ',"opacity":' + self._dumps(layer['opacity']) \
+               + ',"items":[' + ','.join(layer['items']) + ']}'
+
+    def flush(self):
+        """
+        Write pending changes to the annotations file.
+
+        Layers waiting to be committed are written after the committed part of the file, followed by the open layers
+        and the closing brackets. Everything is saved to the write-ahead file first, and then written with a single
+        write call from the end of the committed part of the file, so that the operation can be repeated if the network
+        filesystem returns an error, or completed when the file is reopened after a crash.
+        """
+
+        if self._fp is None:
+            raise ValueError('I/O operation on closed AidaAnnotationWriter')
+
+        committed, tail, n = self._pending_bytes()
+
+        # save the new tail to the write-ahead file, so that the in-place write can be completed after a crash
+        def write_wal():
+            with open(self._wal_filename() + '.tmp', 'wb') as fp:
+                fp.write(str(self._committed_pos).encode('utf-8') + b'\n' + committed + tail)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(self._wal_filename() + '.tmp', self._wal_filename())
+
+        def write_from_committed_pos():
+            self._fp.seek(self._committed_pos)
+            self._fp.write(committed + tail)
+            self._fp.truncate()
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+
+        self._retry(write_wal)
+        self._retry(write_from_committed_pos)
+        self._commit_pending(committed, n)
+
+    def _pending_bytes(self):
+        """
+        Bytes to write from the end of the committed part of the file.
+
+        :return:
+        * committed: Layers waiting to be committed.
+        * tail: Open layers and end of file.
+        * n: Number of committed layers after writing them.
+        """
+
+        # new layers for the committed part of the file
+        n = self._number_of_committed_layers
+        committed = ''.join([(',' if n + i > 0 else '') + layer for i, layer in enumerate(self._layers_to_commit)])
+        committed = committed.encode('utf-8')
+        n += len(self._layers_to_commit)
+
+        # open layers and end of file
+        tail = ''.join([(',' if n + i > 0 else '') + self._layer_to_json(layer)
+                        for i, layer in enumerate(self._open_layers.values())]) + ']}'
+        tail = tail.encode('utf-8')
+
+        return committed, tail, n
+
+    def _commit_pending(self, committed, n):
+        """
+        The new layers are now part of the committed file.
+        """
+        self._committed_pos += len(committed)
+        self._number_of_committed_layers = n
+        self._layers_to_commit = []
+
+    def close(self):
+        """
+        Flush pending changes and close the annotations file.
+        """
+        if self._fp is not None:
+            try:
+                self.flush()
+            finally:
+                self._fp.close()
+                self._fp = None
+            # the file is complete, so the last write-ahead file is no longer needed
+            self._retry(self._remove_wal)
+
+
+class SlideJobState(object):
+    """
+    Append-only log of the tiles of a slide that have been processed, so that a segmentation job can be resumed after
+    a crash or a cluster job timeout.
+
+    Saving the whole coarse tissue mask, downsampled image and timing lists with np.savez_compressed() after each tile
+    rewrites a file whose size doesn't depend on the tile, and a crash during the write leaves a corrupted checkpoint.
+    Instead, this class appends one small JSON record per tile to a log file, e.g.
+
+        {"tile": [first_row, last_row, first_col, last_col], "time_step": 12.3, "annotations": {...}, ...}
+
+    Each record is written with a single write call followed by fsync, so a crash can only leave an incomplete last
+    line, which is discarded when the log is opened again. Records are arbitrary dictionaries that can be encoded by
+    ujson, but the following keys have a meaning for the methods of this class:
+
+      * 'tile': [first_row, last_row, first_col, last_col] of a completed tile (see completed_tiles()).
+      * 'annotations', 'annotations_corrected': AidaAnnotationWriter.layer_item_counts() after writing the tile, so
+        that items written after the last record can be rolled back when the annotations file is reopened.
+
+    Small masks (e.g. the update of the coarse tissue mask within the tile) can be added to records with
+    encode_mask() and decode_mask().
+
+    Usage:
+
+        with cytometer.data.SlideJobState(job_state_file, number_of_attempts=5) as job_state:
+            done = job_state.completed_tiles()
+            for tile in tiles:
+                if tile in done:
+                    continue
+                ...
+                job_state.append({'tile': tile, 'annotations': annotations_writer.layer_item_counts()})
+    """
+
+    def __init__(self, filename, mode='a', number_of_attempts=1):
+        """
+        Open a new or existing job state log.
+
+        :param filename: String with path to the log file (e.g. '*_job_state.jsonl').
+        :param mode: (def 'a')
+            - 'w': Start a new log, overwriting the existing file.
+            - 'a': Load the records of an existing log, or create a new one if it doesn't exist.
+        :param number_of_attempts: (def 1) Number of times we try to write the file if the server returns
+        ConnectionResetError or BrokenPipeError.
+        """
+
+        self.filename = filename
+        self.number_of_attempts = number_of_attempts
+        self.records = []
+
+        if mode not in ['w', 'a']:
+            raise NotImplementedError('mode not implemented: ' + mode)
+
+        # position of the end of the valid part of the file
+        self._pos = 0
+
+        if mode == 'a' and os.path.isfile(filename):
+
+            with open(filename, 'rb') as fp:
+                data = fp.read()
+
+            # parse complete lines, and stop at the first one that is incomplete or corrupted
+            for line in data.split(b'\n')[:-1]:
+                try:
+                    record = ujson.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                self.records.append(record)
+                self._pos += len(line) + 1
+
+            self._fp = open(filename, 'r+b')
+
+            # discard the incomplete tail
+            if self._pos < len(data):
+                _retry_network_filesystem(self.number_of_attempts, self._write_from_pos, b'')
+
+        else:
+
+            self._fp = open(filename, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.records)
+
+    def _write_from_pos(self, data):
+        self._fp.seek(self._pos)
+        self._fp.write(data)
+        self._fp.truncate()
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+    def append(self, record):
+        """
+        Append a record to the log, and sync it to disk.
+
+        The record is written from the end of the valid part of the file, so the write can be repeated if the network
+        filesystem returns an error.
+
+        :param record: Dictionary that can be encoded by ujson.
+        :return:
+        * None
+        """
+
+        if self._fp is None:
+            raise ValueError('I/O operation on closed SlideJobState')
+
+        line = (ujson.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        _retry_network_filesystem(self.number_of_attempts, self._write_from_pos, line)
+        self._pos += len(line)
+        self.records.append(record)
+
+    def last(self, key=None):
+        """
+        Last record in the log.
+
+        :param key: (def None) If provided, the last record that contains this key.
+        :return:
+        * Dictionary with the record, or None if there are no records.
+        """
+
+        for record in reversed(self.records):
+            if key is None or key in record:
+                return record
+        return None
+
+    def completed_tiles(self):
+        """
+        Tiles that have been completed according to the log.
+
+        :return:
+        * Set of (first_row, last_row, first_col, last_col) tuples.
+        """
+        return set([tuple(record['tile']) for record in self.records if record.get('tile') is not None])
+
+    @staticmethod
+    def encode_mask(mask):
+        """
+        Encode a binary mask so that it can be stored in a record.
+
+        :param mask: 2D array. Non-zero pixels are considered True.
+        :return:
+        * Dictionary {'shape': [rows, cols], 'bits': string}.
+        """
+        mask = np.asarray(mask)
+        return {'shape': list(mask.shape), 'bits': base64.b64encode(np.packbits(mask != 0)).decode('ascii')}
+
+    @staticmethod
+    def decode_mask(code):
+        """
+        Decode a binary mask encoded with encode_mask().
+
+        :param code: Dictionary {'shape': [rows, cols], 'bits': string}.
+        :return:
+        * mask: bool array.
+        """
+        shape = tuple(code['shape'])
+        bits = np.frombuffer(base64.b64decode(code['bits']), dtype=np.uint8)
+        return np.unpackbits(bits, count=int(np.prod(shape))).astype(bool).reshape(shape)
+
+    def close(self):
+        """
+        Close the log file.
+        """
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
 def aida_get_contours(annotations, layer_name='.*', return_props=False):
     """
     Concatenate items as contours in an AIDA annotations file or dict. Only 'path' and 'rectangle' types implemented.
@@ -988,6 +1523,649 @@ def aida_get_contours(annotations, layer_name='.*', return_props=False):
         return items
 
 
+class _JsonStream(object):
+    """
+    Minimal incremental JSON reader, to walk the top levels of a large JSON file without loading it whole. Values
+    are decoded one at a time with json.JSONDecoder.raw_decode() from a buffer that is refilled from the file as
+    needed.
+    """
+
+    _whitespace = ' \t\n\r'
+
+    def __init__(self, fp, chunk_size=2**20):
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """
+        Read another chunk from the file. Returns False if the end of the file has been reached.
+        """
+        if self._eof:
+            return False
+        chunk = self._fp.read(self._chunk_size)
+        if len(chunk) == 0:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character without consuming it ('' at the end of the file).
+        """
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in self._whitespace:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        """
+        Consume the next character, which must be one of chars, and return it.
+        """
+        c = self.peek()
+        if c == '' or c not in chars:
+            raise ValueError('Expected one of ' + repr(chars) + ' but found ' + repr(c) + ' in JSON file')
+        self._pos += 1
+        return c
+
+    def value(self):
+        """
+        Decode and return the next JSON value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # a number close to the end of the buffer may be incomplete, e.g. '0.' from '0.25'
+                if end + 64 < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+    def keys(self):
+        """
+        Iterate the keys of the object that starts at the current position. After each key, the caller must consume
+        the value with value() or by walking into it.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def elements(self):
+        """
+        Iterate the elements of the array that starts at the current position. The caller must consume each element
+        before the next iteration.
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield
+            if self.expect(',]') == ']':
+                return
+
+
+def aida_iter_items(annotations, layer_name='.*', chunk_size=2**20):
+    """
+    Iterate the items in an AIDA annotations file without loading the whole file into memory.
+
+    aida_get_contours() loads the whole file with ujson.load(), which for full slides with hundreds of thousands of
+    contours needs several GB of memory. This function reads the file incrementally, and items are decoded one at a
+    time. Layers are selected by name before decoding their items, as long as the layer's 'name' key comes before
+    its 'items' key (as in files written by AidaAnnotationWriter or aida_write_new_items()). Otherwise, the layer's
+    items are decoded and kept in memory until the layer's name is read.
+
+    :param annotations: Filename or dict with AIDA annotations.
+    :param layer_name: (def '.*', which matches any name). Regular expression to match the layer names (see
+    aida_get_contours()).
+    :param chunk_size: (def 2**20) Number of characters read from the file at a time.
+    :return:
+    * Iterator of (layer_name, item) tuples, where item is the dictionary of an AIDA item.
+    """
+
+    if isinstance(annotations, dict):
+        for layer in annotations['layers']:
+            if re.match(layer_name, layer['name']) is not None:
+                for item in layer['items']:
+                    yield layer['name'], item
+        return
+
+    with open(annotations) as fp:
+        stream = _JsonStream(fp, chunk_size=chunk_size)
+        for key in stream.keys():
+            if key != 'layers':
+                stream.value()
+                continue
+            for _ in stream.elements():
+
+                # walk the layer object
+                name = None
+                items = None
+                for layer_key in stream.keys():
+                    if layer_key == 'name':
+                        name = stream.value()
+                    elif layer_key == 'items' and name is not None:
+                        is_match = re.match(layer_name, name) is not None
+                        for _ in stream.elements():
+                            item = stream.value()
+                            if is_match:
+                                yield name, item
+                    elif layer_key == 'items':
+                        items = stream.value()
+                    else:
+                        stream.value()
+
+                # items that came before the layer name
+                if items is not None and name is not None and re.match(layer_name, name) is not None:
+                    for item in items:
+                        yield name, item
+
+
+def aida_iter_contours(annotations, layer_name='.*', return_props=False, dtype=np.float32, chunk_size=2**20):
+    """
+    Iterate the contours in an AIDA annotations file as arrays, without loading the whole file into memory. Only
+    'path' and 'rectangle' types implemented.
+
+    This is the streaming version of aida_get_contours(), see aida_iter_items().
+
+    :param annotations: Filename or dict with AIDA annotations.
+    :param layer_name: (def '.*', which matches any name). Regular expression to match the layer names (see
+    aida_get_contours()).
+    :param return_props: (def False). Also yield the properties of each contour.
+    :param dtype: (def np.float32) Type of the contour arrays.
+    :param chunk_size: (def 2**20) Number of characters read from the file at a time.
+    :return:
+    * Iterator of contours, (N, 2)-np.array with the [x, y] points, or (contour, props) tuples if return_props=True.
+      props is a dictionary. Currently, only implemented output is props['cell_prob'] (None for items without it).
+    """
+
+    for i, (name, item) in enumerate(aida_iter_items(annotations, layer_name=layer_name, chunk_size=chunk_size)):
+
+        if item['type'] == 'path':
+            contour = np.array(item['segments'], dtype=dtype).reshape(-1, 2)
+
+        elif item['type'] == 'rectangle':
+            # 4 corners of the rectangle, with first repeated for closed contour
+            x0 = item['x']
+            y0 = item['y']
+            xend = x0 + item['width'] - 1
+            yend = y0 + item['height'] - 1
+            contour = np.array([[x0, y0], [xend, y0], [xend, yend], [x0, yend], [x0, y0]], dtype=dtype)
+
+        else:
+            warnings.warn('Unknown item type found: layer ' + name + ', item ' + str(i) + ': ' + item['type'],
+                          SyntaxWarning)
+            continue
+
+        if return_props:
+            yield contour, {'cell_prob': item.get('cell_prob', None)}
+        else:
+            yield contour
+
+
+def pack_contours(contours):
+    """
+    Pack a list of contours into a single array of coordinates, with offsets to the first point of each contour.
+
+    This is the same layout as the indices of a CSR sparse matrix, and is used to store and process the contours of a
+    whole slide without one Python object per contour.
+
+    :param contours: List [contour_0, contour_1...], where contour_i is an (Ni, 2)-array or list of [x, y] points.
+    :return:
+    * xy: (N, 2)-np.array (float32) with the points of all contours, N = N0 + N1 + ...
+    * offsets: (n+1,)-np.array (int64) where the points of contour i are xy[offsets[i]:offsets[i+1], :].
+    """
+
+    offsets = np.zeros(shape=(len(contours) + 1,), dtype=np.int64)
+    offsets[1:] = np.cumsum([len(c) for c in contours])
+    if offsets[-1] == 0:
+        return np.zeros(shape=(0, 2), dtype=np.float32), offsets
+    xy = np.concatenate([np.asarray(c, dtype=np.float32).reshape(-1, 2) for c in contours])
+    return xy, offsets
+
+
+def unpack_contours(xy, offsets):
+    """
+    Split packed coordinates into a list of contours. Inverse of pack_contours().
+
+    :param xy: (N, 2)-np.array with the points of all contours.
+    :param offsets: (n+1,)-np.array with the offset of the first point of each contour.
+    :return:
+    * contours: List [contour_0, contour_1...] of (Ni, 2)-np.array views of xy.
+    """
+    return [xy[offsets[i]:offsets[i+1], :] for i in range(len(offsets) - 1)]
+
+
+def polygon_metrics(xy, offsets):
+    """
+    Area, perimeter, inverse compactness, centroid, bounding box and sphericity of many closed polygons, computed with
+    shoelace-style NumPy reductions on the packed coordinates instead of one shapely Polygon per polygon.
+
+    The last point of each polygon is joined to the first one (if they are the same point, the extra side has length
+    0, so polygons can be given with or without the first point repeated at the end). Values are the same as those
+    computed with shapely, e.g. Polygon(c).area, Polygon(c).length, Polygon(c).centroid and Polygon(c).bounds.
+
+    :param xy: (N, 2)-np.array with the [x, y] points of all polygons.
+    :param offsets: (n+1,)-np.array with the offset of the first point of each polygon (see pack_contours()).
+    :return:
+    * Dictionary of (n,)-np.array:
+        'area', 'perimeter': Area and perimeter of each polygon.
+        'inv_compactness': perimeter^2 / (4 * pi * area). 1.0 for a circle, and larger for less compact shapes. NaN if
+        area is 0.
+        'centroid_x', 'centroid_y': Centroid of the polygon area (centroid of the vertices if area is 0).
+        'bbox_x0', 'bbox_y0', 'bbox_xend', 'bbox_yend': Bounding box of the polygon points.
+        'sphericity': Minimum / maximum distance from vertices to centroid, as in cytometer.utils.sphericity().
+      Values are NaN for polygons without points.
+    """
+
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n = len(offsets) - 1
+    count = np.diff(offsets)
+    nonempty = count > 0
+    first = offsets[:-1][nonempty]
+    last = offsets[1:][nonempty] - 1
+
+    # index of the next point in each polygon, wrapping around at the end
+    idx_next = np.arange(1, xy.shape[0] + 1)
+    idx_next[last] = first
+
+    x, y = xy[:, 0], xy[:, 1]
+    x_next, y_next = x[idx_next], y[idx_next]
+    cross = x * y_next - x_next * y
+
+    def polygon_reduce(ufunc, v):
+        out = np.full(shape=(n,), fill_value=np.nan)
+        if len(first) > 0:
+            out[nonempty] = ufunc.reduceat(v, first)
+        return out
+
+    signed_area = 0.5 * polygon_reduce(np.add, cross)
+    metrics = {'area': np.abs(signed_area),
+               'perimeter': polygon_reduce(np.add, np.hypot(x_next - x, y_next - y))}
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+
+        metrics['inv_compactness'] = metrics['perimeter'] ** 2 / (4 * np.pi * metrics['area'])
+        metrics['inv_compactness'][metrics['area'] == 0] = np.nan
+
+        # centroid of the polygon area, or of the vertices for degenerate polygons
+        centroid_x = polygon_reduce(np.add, (x + x_next) * cross) / (6 * signed_area)
+        centroid_y = polygon_reduce(np.add, (y + y_next) * cross) / (6 * signed_area)
+        degenerate = nonempty & (signed_area == 0)
+        centroid_x[degenerate] = (polygon_reduce(np.add, x) / count)[degenerate]
+        centroid_y[degenerate] = (polygon_reduce(np.add, y) / count)[degenerate]
+    metrics['centroid_x'] = centroid_x
+    metrics['centroid_y'] = centroid_y
+
+    metrics['bbox_x0'] = polygon_reduce(np.minimum, x)
+    metrics['bbox_y0'] = polygon_reduce(np.minimum, y)
+    metrics['bbox_xend'] = polygon_reduce(np.maximum, x)
+    metrics['bbox_yend'] = polygon_reduce(np.maximum, y)
+
+    # distance from each vertex to the centroid of its polygon. A repeated first point doesn't change the min or max
+    polygon_idx = np.repeat(np.arange(n), count)
+    d = np.hypot(x - centroid_x[polygon_idx], y - centroid_y[polygon_idx])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        metrics['sphericity'] = polygon_reduce(np.minimum, d) / polygon_reduce(np.maximum, d)
+
+    return metrics
+
+
+def cell_table(contours, xres=1.0, yres=1.0, cell_prob=None, **columns):
+    """
+    Columnar table of cell measures, computed from the contours.
+
+    Downstream analyses usually need the area and shape of every cell in a slide, and re-parsing the AIDA annotations
+    file and creating a shapely Polygon per cell to compute them is slow for whole slides. This table is computed once
+    and stored with write_cell_table().
+
+    :param contours: List [contour_0, contour_1...] of (Ni, 2)-arrays with [x, y] points in pixels, or tuple (xy,
+    offsets) with the contours already packed (see pack_contours()).
+    :param xres: (def 1.0) Pixel size in the x-coordinate (um).
+    :param yres: (def 1.0) Pixel size in the y-coordinate (um).
+    :param cell_prob: (def None) Vector with one value per contour, with the probability of the object being a cell.
+    :param columns: Extra columns, each one a scalar or a vector with one value per contour, e.g. slide='slide_name',
+    tile=tile_index, corrected=True.
+    :return:
+    * table: pandas.DataFrame with one row per contour, and columns:
+        'area_um2', 'perimeter_um': area and perimeter in um^2 and um.
+        'inv_compactness': perimeter^2 / (4 * pi * area). 1.0 for a circle, and larger for less compact shapes.
+        'centroid_x', 'centroid_y': centroid in pixels.
+        'bbox_x0', 'bbox_y0', 'bbox_xend', 'bbox_yend': bounding box of the contour points in pixels.
+        'sphericity': see polygon_metrics().
+        'cell_prob': if provided.
+        extra columns.
+    * xy: (N, 2)-np.array (float32) with the packed points of all contours.
+    * offsets: (n+1,)-np.array (int64) with the offset of the first point of each contour.
+    """
+
+    if isinstance(contours, tuple):
+        xy, offsets = contours
+    else:
+        xy, offsets = pack_contours(contours)
+
+    # area and perimeter in um, centroid and bounding box in pixels
+    metrics = polygon_metrics(xy * np.array([xres, yres]), offsets)
+    table = pd.DataFrame({'area_um2': metrics['area'], 'perimeter_um': metrics['perimeter'],
+                          'inv_compactness': metrics['inv_compactness']})
+    for key, res in zip(['centroid_x', 'centroid_y', 'bbox_x0', 'bbox_y0', 'bbox_xend', 'bbox_yend'],
+                        [xres, yres, xres, yres, xres, yres]):
+        table[key] = metrics[key] / res
+    table['sphericity'] = metrics['sphericity']
+
+    if cell_prob is not None:
+        table['cell_prob'] = np.asarray(cell_prob, dtype=np.float64)
+    for key, value in columns.items():
+        table[key] = value
+
+    return table, xy, offsets
+
+
+def concat_cell_tables(tables):
+    """
+    Concatenate cell tables, e.g. the tables of the tiles in a slide.
+
+    :param tables: List of (table, xy, offsets) tuples, as returned by cell_table().
+    :return:
+    * (table, xy, offsets) with the rows of all tables. The table index is reset.
+    """
+
+    if len(tables) == 0:
+        return pd.DataFrame(), np.zeros(shape=(0, 2), dtype=np.float32), np.zeros(shape=(1,), dtype=np.int64)
+
+    table = pd.concat([x[0] for x in tables], ignore_index=True, sort=False)
+    xy = np.concatenate([x[1] for x in tables]).astype(np.float32)
+
+    # shift the offsets of each table by the number of points in the previous tables
+    num_points = np.cumsum([0] + [x[2][-1] for x in tables])
+    offsets = np.concatenate([[0]] + [x[2][1:] + n for x, n in zip(tables, num_points[:-1])]).astype(np.int64)
+
+    return table, xy, offsets
+
+
+def write_cell_table(filename, table, xy, offsets):
+    """
+    Save a cell table and its packed contours to a .npz file, with one array per column.
+
+    The file is written to a temporary file first, and then renamed, so that a crash doesn't leave a partial file.
+
+    :param filename: String with path to the .npz file.
+    :param table: pandas.DataFrame returned by cell_table() or concat_cell_tables().
+    :param xy: (N, 2)-np.array with the packed points of all contours.
+    :param offsets: (n+1,)-np.array with the offset of the first point of each contour.
+    """
+
+    # string columns are saved as fixed-length unicode arrays, so that the file can be loaded without pickle
+    arrays = {'column_' + key: table[key].to_numpy() for key in table.columns}
+    for key in arrays:
+        if arrays[key].dtype.kind == 'O':
+            arrays[key] = arrays[key].astype(str)
+    tmp_file = os.path.splitext(filename)[0] + '.tmp.npz'
+    np.savez_compressed(tmp_file, contour_xy=np.asarray(xy, dtype=np.float32),
+                        contour_offsets=np.asarray(offsets, dtype=np.int64), **arrays)
+    os.replace(tmp_file, filename)
+
+
+def read_cell_table(filename, columns=None, return_contours=True):
+    """
+    Load a cell table saved with write_cell_table().
+
+    :param filename: String with path to the .npz file.
+    :param columns: (def None) List of columns to load. By default, all columns.
+    :param return_contours: (def True) Also load the packed contours.
+    :return:
+    * table: pandas.DataFrame.
+    * xy, offsets: (only if return_contours=True) Packed contours (see pack_contours()).
+    """
+
+    with np.load(filename) as aux:
+        keys = [key[len('column_'):] for key in aux.files if key.startswith('column_')]
+        if columns is not None:
+            keys = [key for key in keys if key in columns]
+        table = pd.DataFrame({key: aux['column_' + key] for key in keys})
+        if return_contours:
+            return table, aux['contour_xy'], aux['contour_offsets']
+        else:
+            return table
+
+
+def cell_table_from_aida(annotations, xres=1.0, yres=1.0, layer_name='White adipocyte.*', **columns):
+    """
+    Compute the cell table of the contours in an AIDA annotations file, e.g. for slides segmented before cell tables
+    were written by the pipeline.
+
+    :param annotations: Filename or dict with AIDA annotations.
+    :param xres: (def 1.0) Pixel size in the x-coordinate (um).
+    :param yres: (def 1.0) Pixel size in the y-coordinate (um).
+    :param layer_name: (def 'White adipocyte.*') Regular expression to select layers (see aida_get_contours()).
+    :param columns: Extra columns (see cell_table()).
+    :return:
+    * table, xy, offsets: See cell_table().
+    """
+
+    contours = []
+    cell_prob = []
+    for contour, props in aida_iter_contours(annotations, layer_name=layer_name, return_props=True):
+        contours.append(contour)
+        cell_prob.append(np.nan if props['cell_prob'] is None else props['cell_prob'])
+    return cell_table(contours, xres=xres, yres=yres, cell_prob=cell_prob, **columns)
+
+
+class QuantileSketch(object):
+    """
+    Mergeable quantile sketch of a population of positive values, e.g. the cell areas of a slide.
+
+    Values are counted in logarithmically spaced buckets (as in DDSketch, Masson et al. 2019), so that any quantile is
+    estimated with a relative error smaller than relative_accuracy, regardless of the number of values, and the memory
+    only grows with the logarithm of the range of values. Two sketches are merged by adding their bucket counts, so
+    the result doesn't depend on the order in which tiles, slides or animals are merged, and it's the same as if all
+    the values had been added to a single sketch.
+
+    Values <= 0 are counted in a separate bucket, represented by 0.0, and NaN values are ignored.
+
+    Usage:
+
+        # one sketch per slide, updated as tiles are processed
+        sketch = cytometer.data.QuantileSketch()
+        sketch.update(areas_tile)
+        sketch.save(sketch_file)
+
+        # cohort quantiles from the slide sketches
+        sketch = cytometer.data.QuantileSketch()
+        for sketch_file in sketch_files:
+            sketch.merge(cytometer.data.QuantileSketch.load(sketch_file))
+        f_area2quantile = cytometer.data.area2quantile(sketch)
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        """
+        :param relative_accuracy: (def 0.01) Maximum relative error of the quantile values.
+        """
+        if relative_accuracy <= 0.0 or relative_accuracy >= 1.0:
+            raise ValueError('relative_accuracy must be in (0.0, 1.0)')
+        self.relative_accuracy = float(relative_accuracy)
+        self._log_gamma = np.log((1.0 + self.relative_accuracy) / (1.0 - self.relative_accuracy))
+        # bucket i counts the values in (gamma^(offset+i-1), gamma^(offset+i)]
+        self._offset = 0
+        self._counts = np.zeros(shape=(0,), dtype=np.int64)
+        self.zero_count = 0
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def __len__(self):
+        return self.count
+
+    def _add_counts(self, offset, counts):
+        """
+        Add bucket counts that start at bucket key offset, extending the buckets if necessary.
+        """
+        if len(counts) == 0:
+            return
+        if len(self._counts) == 0:
+            self._offset = offset
+            self._counts = np.array(counts, dtype=np.int64)
+            return
+        first = min(self._offset, offset)
+        last = max(self._offset + len(self._counts), offset + len(counts))
+        if first < self._offset or last > self._offset + len(self._counts):
+            aux = np.zeros(shape=(last - first,), dtype=np.int64)
+            aux[self._offset - first:self._offset - first + len(self._counts)] = self._counts
+            self._counts = aux
+            self._offset = first
+        self._counts[offset - self._offset:offset - self._offset + len(counts)] += counts
+
+    def update(self, values):
+        """
+        Add values to the sketch.
+
+        :param values: Scalar or array of values.
+        :return: self.
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return self
+        self.count += len(values)
+        self.min = min(self.min, float(np.min(values)))
+        self.max = max(self.max, float(np.max(values)))
+        is_positive = values > 0
+        self.zero_count += int(np.count_nonzero(~is_positive))
+        if np.any(is_positive):
+            keys = np.ceil(np.log(values[is_positive]) / self._log_gamma).astype(np.int64)
+            offset = int(np.min(keys))
+            self._add_counts(offset, np.bincount(keys - offset))
+        return self
+
+    def merge(self, other):
+        """
+        Add the values of another sketch to this sketch.
+
+        :param other: QuantileSketch with the same relative_accuracy.
+        :return: self.
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Sketches with different relative_accuracy cannot be merged')
+        self._add_counts(other._offset, other._counts)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, quantiles):
+        """
+        Estimate of the values at the given quantiles.
+
+        :param quantiles: Scalar or array with values in [0.0, 1.0].
+        :return: Array with the same shape as quantiles (NaN if the sketch is empty). Quantiles 0.0 and 1.0 are the
+        exact minimum and maximum values.
+        """
+        quantiles = np.asarray(quantiles, dtype=np.float64)
+        if self.count == 0:
+            return np.full(shape=quantiles.shape, fill_value=np.nan)
+
+        # bucket of the value with rank q * (count - 1), as in numpy.quantile(..., method='lower')
+        rank = np.floor(quantiles * (self.count - 1))
+        cum_counts = np.cumsum(np.concatenate(([self.zero_count], self._counts)))
+        idx = np.minimum(np.searchsorted(cum_counts, rank, side='right'), len(cum_counts) - 1)
+
+        # bucket centres, such that the relative error is at most relative_accuracy
+        gamma = np.exp(self._log_gamma)
+        values = np.where(idx == 0, 0.0, 2.0 * np.exp((self._offset + idx - 1) * self._log_gamma) / (gamma + 1.0))
+        values = np.clip(values, self.min, self.max)
+        return np.where(quantiles <= 0.0, self.min, np.where(quantiles >= 1.0, self.max, values))
+
+    def cdf(self, x):
+        """
+        Estimate of the fraction of values <= x.
+
+        :param x: Scalar or array of values.
+        :return: Array with the same shape as x, with values in [0.0, 1.0] (NaN if the sketch is empty).
+        """
+        x = np.asarray(x, dtype=np.float64)
+        if self.count == 0:
+            return np.full(shape=x.shape, fill_value=np.nan)
+        cum_counts = np.cumsum(np.concatenate(([self.zero_count], self._counts)))
+
+        # values in the bucket of x are counted as <= x
+        with np.errstate(divide='ignore', invalid='ignore'):
+            idx = np.ceil(np.log(np.maximum(x, 0.0)) / self._log_gamma) - self._offset + 1
+        idx = np.clip(np.nan_to_num(idx, nan=0.0), 0, len(cum_counts) - 1).astype(np.int64)
+        below = np.where(x < 0, 0, cum_counts[idx])
+        return np.where(x >= self.max, 1.0, np.where(x < self.min, 0.0, below / self.count))
+
+    def to_dict(self):
+        """
+        Sketch as a dictionary that can be saved as JSON, e.g. in a SlideJobState record.
+        """
+        return {'relative_accuracy': self.relative_accuracy, 'offset': int(self._offset),
+                'counts': self._counts.tolist(), 'zero_count': int(self.zero_count), 'count': int(self.count),
+                'min': float(self.min) if self.count > 0 else None, 'max': float(self.max) if self.count > 0 else None}
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Sketch from a dictionary created with to_dict().
+        """
+        sketch = cls(relative_accuracy=d['relative_accuracy'])
+        sketch._offset = int(d['offset'])
+        sketch._counts = np.array(d['counts'], dtype=np.int64)
+        sketch.zero_count = int(d['zero_count'])
+        sketch.count = int(d['count'])
+        if sketch.count > 0:
+            sketch.min = float(d['min'])
+            sketch.max = float(d['max'])
+        return sketch
+
+    def save(self, filename):
+        """
+        Save the sketch to a .npz file.
+
+        The file is written to a temporary file first, and then renamed, so that a crash doesn't leave a partial file.
+
+        :param filename: String with path to the .npz file.
+        """
+        d = self.to_dict()
+        d['counts'] = self._counts
+        d['min'] = self.min
+        d['max'] = self.max
+        tmp_file = os.path.splitext(filename)[0] + '.tmp.npz'
+        np.savez_compressed(tmp_file, **d)
+        os.replace(tmp_file, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a sketch saved with save().
+
+        :param filename: String with path to the .npz file.
+        :return: QuantileSketch.
+        """
+        with np.load(filename) as aux:
+            return cls.from_dict({key: aux[key] for key in aux.files})
+
+
 def read_keras_training_output(filename, every_step=True):
     """
     Read a text file with the keras output of one or multiple trainings. The output from
@@ -22,6 +22,7 @@ import keras.backend as K
 import keras.engine
 import numpy as np
 import time
+import collections
 
 
 if K.image_data_format() == 'channels_first':
@@ -94,6 +95,145 @@ def change_input_size(model, batch_shape):
     return model_out
 
 
+class ModelCache(object):
+    """
+    Registry of Keras models that are loaded once per process and reused, e.g. between tiles of a full slide
+    segmentation.
+
+    Models are requested by filename and input shape with get(). The first time a filename is requested, the model is
+    loaded with load_model_with_retries(), and its architecture (JSON) and weights are kept in memory, so the file is
+    never read again. Each (filename, input shape) pair corresponds to a model with the input layer adapted by
+    change_input_size(). These models are kept in a least recently used (LRU) cache, so repeated tile shapes reuse the
+    same model and its predict function, instead of building a new graph for each tile.
+
+    Each new model adds nodes to the Keras/TensorFlow graph, which is what makes each iteration slower if
+    K.clear_session() is not called. Calling check_session() between tiles clears the session only when more than
+    max_models_per_session models have been built in it. Models are then rebuilt as needed from the architectures and
+    weights in memory, without reading the files again.
+
+    Usage:
+
+        model_cache = cytometer.models.ModelCache()
+        for tile in ...:
+            dmap_model = model_cache.get(dmap_model_file, input_shape=tile.shape)
+            ...
+            model_cache.check_session()
+    """
+
+    def __init__(self, max_models=16, max_models_per_session=64, number_of_attempts=5):
+        """
+        :param max_models: (def 16) Maximum number of models kept in the cache. When the cache is full, the least
+        recently used model is evicted.
+        :param max_models_per_session: (def 64) Maximum number of models built in the Keras session before
+        check_session() clears it.
+        :param number_of_attempts: (def 5) Number of attempts passed to load_model_with_retries().
+        """
+
+        self.max_models = max_models
+        self.max_models_per_session = max_models_per_session
+        self.number_of_attempts = number_of_attempts
+
+        # model architectures and weights: {filename: (json, weights)}
+        self._sources = {}
+
+        # models built in the current session: {(filename, input_shape): model}, sorted from least to most recently used
+        self._models = collections.OrderedDict()
+
+        # number of models built in the current session
+        self._num_built = 0
+
+    def __len__(self):
+        return len(self._models)
+
+    def __contains__(self, key):
+        return key in self._models
+
+    def get(self, filename, input_shape=None):
+        """
+        Get model from the cache, loading it or building it if necessary.
+
+        :param filename: String with path to the .h5 file with the keras model.
+        :param input_shape: (def None) Shape of the input to the model, e.g. (n, 1001, 1001, 3). The batch size (first
+        dimension) is ignored. If None, the model has the input shape it was saved with.
+        :return: Keras model.
+        """
+
+        key = self._key(filename, input_shape)
+
+        # cache hit
+        if key in self._models:
+            self._models.move_to_end(key)
+            return self._models[key]
+
+        # model with the input shape it was saved with
+        base_key = self._key(filename, None)
+        if base_key in self._models:
+            model = self._models[base_key]
+        else:
+            model = self._build(filename)
+            self._add(base_key, model)
+
+        # model with the required input shape
+        if key != base_key:
+            if model.input_shape[1:] != key[1]:
+                model = change_input_size(model, batch_shape=(None,) + key[1])
+                self._num_built += 1
+            self._add(key, model)
+
+        return model
+
+    def check_session(self):
+        """
+        Clear the Keras session if more than max_models_per_session models have been built in it, to keep the graph
+        small. Models previously returned by get() are not valid after the session is cleared, so this method should be
+        called when none are in use, e.g. between tiles.
+
+        :return:
+        * True if the session was cleared, False otherwise.
+        """
+        if self._num_built > self.max_models_per_session:
+            self.clear_session()
+            return True
+        else:
+            return False
+
+    def clear_session(self):
+        """
+        Clear the Keras session and remove all models from the cache. Model architectures and weights are kept in
+        memory, so that models can be rebuilt without reading the files again.
+        """
+        self._models.clear()
+        self._num_built = 0
+        K.clear_session()
+
+    @staticmethod
+    def _key(filename, input_shape):
+        if input_shape is None:
+            return (filename, None)
+        else:
+            return (filename, tuple(input_shape[1:]))
+
+    def _add(self, key, model):
+        self._models[key] = model
+        self._models.move_to_end(key)
+        while len(self._models) > self.max_models:
+            self._models.popitem(last=False)
+
+    def _build(self, filename):
+        """
+        Build model with the input shape it was saved with. The model file is only read the first time.
+        """
+        if filename in self._sources:
+            model_json, weights = self._sources[filename]
+            model = keras.models.model_from_json(model_json)
+            model.set_weights(weights)
+        else:
+            model = load_model_with_retries(filename, number_of_attempts=self.number_of_attempts)
+            self._sources[filename] = (model.to_json(), model.get_weights())
+        self._num_built += 1
+        return model
+
+
 def check_model(model):
     """
     Check the layers with weights for NaNs.
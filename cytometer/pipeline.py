@@ -0,0 +1,1128 @@
+"""
+cytometer/pipeline.py
+
+Functions to run the segmentation pipeline on full histology slides, overlapping the reading of the slide, the neural
+network inference, the post-processing and the writing of the results.
+
+Environments: cytometer_tensorflow, cytometer_tensorflow_v2.
+"""
+
+"""
+This file is part of Cytometer
+Copyright 2021 Medical Research Council
+SPDX-License-Identifier: Apache-2.0
+Author: Ramon Casero <rcasero@gmail.com>
+"""
+
+import os
+import time
+import shutil
+import warnings
+import socket
+import uuid
+import queue
+import threading
+import traceback
+import collections
+import multiprocessing
+import concurrent.futures
+import ujson
+import numpy as np
+import pandas as pd
+from PIL import Image
+import openslide
+import cytometer.utils
+import cytometer.data
+import cytometer.models
+
+DEBUG = False
+
+
+def segment_slide(histo_file, tiles, dmap_model, contour_model, classifier_model, correction_model,
+                  annotations_file, annotations_corrected_file, f_area2quantile,
+                  lores_mask=None, colour_offset=None, xres=None, yres=None,
+                  min_cell_area=0, max_cell_area=200e3, remove_edge_labels=True, min_mask_overlap=0.8,
+                  phagocytosis=True, min_class_prop=0.0, correction_window_len=401, correction_smoothing=11,
+                  batch_size=16, tiles_per_batch=None, contour_downsample_factor=0.1, bspline_k=1,
+                  model_cache=None, shape_buckets=None, num_workers=None, executor=None, prefetch=4, max_pending=4,
+                  annotations_mode='w', number_of_attempts=5, job_state=None, cells_file=None, sketch_file=None):
+    """
+    Segment the tiles of a full histology slide with the v8 pipeline, and write the contours to AIDA annotations files.
+
+    This function produces the same kind of output as the tile loop in the *_full_slide_pipeline_v8.py scripts, but
+    the processing is split into stages that run at the same time, connected by bounded queues:
+
+      1. A reader process reads tiles from the slide with OpenSlide, applies the colour correction and interpolates the
+         tissue mask, prefetching up to prefetch tiles.
+      2. The main process runs the neural networks: segment_dmap_contour_v6_batch() for the dmap, contour and
+         classifier networks, on batches of up to tiles_per_batch tiles from the reader (with the seed labelling and
+         watershed in the pool of step 3), and correct_segmentation() for the correction network.
+      3. A pool of processes does the CPU post-processing: clean_segmentation() and
+         one_image_per_label_v2() between the two inference steps, and labels2contours_batch(), resample_contours() and
+         aida_contour_items() after the correction.
+      4. A writer thread appends the items to the annotations files with cytometer.data.AidaAnnotationWriter, in the
+         same order as the tiles.
+
+    Thus, the networks can be processing one tile while the post-processing and I/O of other tiles are running.
+
+    If the tiles have core regions (as computed by cytometer.utils.get_all_rois_to_process()), each object is only
+    kept in the tile whose core region contains the object's centroid, so that objects in the overlap between windows
+    are not written twice.
+
+    Worker processes are started with the 'spawn' method, because forking a process after TensorFlow has been
+    initialised is not safe.
+
+    Differences with segmentation_pipeline6():
+      * The cropped histology for the correction network is resized in uint8 rather than float32 format, to reduce
+        the amount of data sent between processes.
+      * The colour correction is clipped to [0, 255].
+
+    :param histo_file: Path to histology slide that can be opened with OpenSlide.
+    :param tiles: pandas.DataFrame with one row per tile, e.g. from cytometer.utils.get_all_rois_to_process(). It must
+    have columns 'first_row', 'last_row', 'first_col', 'last_col' (full resolution window) and, if lores_mask is
+    provided, 'lores_first_row', 'lores_last_row', 'lores_first_col', 'lores_last_col' (window in lores_mask).
+    Optional columns 'core_first_row', 'core_last_row', 'core_first_col', 'core_last_col' define the core regions.
+    :param dmap_model: Filename of the dmap model (see segmentation_pipeline6()).
+    :param contour_model: Filename of the contour model.
+    :param classifier_model: Filename of the tissue classifier model.
+    :param correction_model: Filename of the segmentation correction model.
+    :param annotations_file: Path to .json AIDA file for the non-overlap contours.
+    :param annotations_corrected_file: Path to .json AIDA file for the corrected contours.
+    :param f_area2quantile: Function to map areas to quantiles for the contour colours (see
+    cytometer.data.area2quantile()).
+    :param lores_mask: (def None) Low resolution tissue mask, e.g. from rough_foreground_mask(). If provided, objects
+    that don't overlap enough with the mask are removed (see clean_segmentation()).
+    :param colour_offset: (def None) (r, g, b) values added to each tile to correct its tint.
+    :param xres: (def None) Pixel size in the x-coordinate (um). By default, it's read from the slide.
+    :param yres: (def None) Pixel size in the y-coordinate (um). By default, it's read from the slide.
+    :param min_cell_area: (def 0) See clean_segmentation().
+    :param max_cell_area: (def 200e3) See clean_segmentation().
+    :param remove_edge_labels: (def True) See clean_segmentation().
+    :param min_mask_overlap: (def 0.8) See clean_segmentation().
+    :param phagocytosis: (def True) See clean_segmentation().
+    :param min_class_prop: (def 0.0) See clean_segmentation().
+    :param correction_window_len: (def 401) See segmentation_pipeline6().
+    :param correction_smoothing: (def 11) See correct_segmentation().
+    :param batch_size: (def 16) Batch size for the neural networks.
+    :param tiles_per_batch: (def None) Maximum number of tiles read from the queue and stacked for the dmap, contour
+    and classifier networks (see segment_dmap_contour_v6_batch()). Tiles are only stacked if they have the same size,
+    as most windows from get_all_rois_to_process() do, or the same bucket shape with shape_buckets. By default,
+    batch_size.
+    :param contour_downsample_factor: (def 0.1) Factor to resample the contours written to AIDA.
+    :param bspline_k: (def 1) Degree of the spline to resample the contours. For linear interpolation (bspline_k=1), all
+    contours are resampled together with resample_contours(). Otherwise, with bspline_resample().
+    :param model_cache: (def None) cytometer.models.ModelCache. By default, a new cache is created, so that models are
+    only loaded once.
+    :param shape_buckets: (def None) See segment_dmap_contour_v6().
+    :param num_workers: (def None) Number of post-processing processes. By default, the number of CPUs. Ignored if
+    executor is provided.
+    :param executor: (def None) concurrent.futures.ProcessPoolExecutor for the post-processing, created with the 'spawn'
+    start method. The caller owns the pool, so that it can be reused for several calls (see run_worker()). By
+    default, a pool of num_workers processes is created, and shut down before returning.
+    :param prefetch: (def 4) Maximum number of tiles read in advance.
+    :param max_pending: (def 4) Maximum number of tiles waiting for post-processing before the inference stage waits.
+    :param annotations_mode: (def 'w') Mode to open the annotations files (see AidaAnnotationWriter).
+    :param number_of_attempts: (def 5) Number of attempts for network filesystem operations.
+    :param job_state: (def None) cytometer.data.SlideJobState to resume the job. Tiles already in the log are skipped,
+    the annotations files are opened in mode 'a' and rolled back to the last tile in the log, and a record is appended
+    after writing each tile. If job_state is provided and has records, annotations_mode is ignored.
+    :param cells_file: (def None) If provided, path to a .npz file where the cell table of the slide is saved (see
+    cytometer.data.cell_table() and write_cell_table()), with the same contours as the annotations files, and extra
+    columns 'slide', 'tile' (row index in tiles), 'cell_id' and 'corrected' (False for the contours in annotations_file,
+    True for those in annotations_corrected_file). The file is written when all tiles have been processed. With
+    job_state, the cell table of each tile is also saved as it's written, to a fragment in directory
+    cells_file + '.tiles' (see _cells_fragment_file()), so that a resumed run keeps the rows of the tiles completed
+    before a crash. Completed tiles without a fragment are taken from an existing cells_file (e.g. if all tiles had been
+    completed), and a warning is raised if neither is available. The fragments are deleted once cells_file is written.
+    :param sketch_file: (def None) If provided, path to a .npz file where the cytometer.data.QuantileSketch of the
+    corrected cell areas (um^2) of the slide is saved after each tile. With job_state, the sketch of each tile is also
+    logged, so that a resumed run starts from the sketches of the completed tiles.
+    :return:
+    * tiles_out: Copy of tiles with extra columns 'num_objects' (number of objects written) and 'time' (seconds from
+      the beginning of the tile's inference to the end of the writing).
+    """
+
+    tiles = tiles.reset_index(drop=True)
+
+    # skip tiles completed in a previous run
+    layer_item_counts = {'annotations': None, 'annotations_corrected': None}
+    tiles_todo = tiles
+    if job_state is not None:
+        done = job_state.completed_tiles()
+        is_done = [tuple(x) in done for x in tiles[['first_row', 'last_row', 'first_col', 'last_col']].values.tolist()]
+        tiles_todo = tiles[~np.array(is_done, dtype=bool)]
+        last = job_state.last('annotations')
+        if last is not None:
+            annotations_mode = 'a'
+            layer_item_counts = {key: last[key] for key in layer_item_counts}
+
+    # quantile sketch of cell areas, starting from the tiles completed in a previous run
+    sketch = None
+    if sketch_file is not None:
+        sketch = cytometer.data.QuantileSketch()
+        if job_state is not None:
+            k_todo = set(tiles_todo.index)
+            records = {tuple(record['tile']): record for record in job_state.records
+                       if record.get('area_sketch') is not None}
+            for k, x in zip(tiles.index, tiles[['first_row', 'last_row', 'first_col', 'last_col']].values.tolist()):
+                if k not in k_todo and tuple(x) in records:
+                    sketch.merge(cytometer.data.QuantileSketch.from_dict(records[tuple(x)]['area_sketch']))
+
+    # pixel size
+    if xres is None or yres is None:
+        im = openslide.OpenSlide(histo_file)
+        xres = float(im.properties['openslide.mpp-x'])  # um/pixel
+        yres = float(im.properties['openslide.mpp-y'])  # um/pixel
+        im.close()
+
+    if model_cache is None:
+        model_cache = cytometer.models.ModelCache()
+
+    # start workers before TensorFlow runs anything in this process
+    ctx = multiprocessing.get_context('spawn')
+    tile_queue = ctx.Queue(maxsize=prefetch)
+    reader = ctx.Process(target=_read_tiles, args=(histo_file, tiles_todo, lores_mask, colour_offset, tile_queue),
+                         daemon=True)
+    reader.start()
+    if executor is None:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, mp_context=ctx)
+    else:
+        pool = executor
+
+    annotations_writer = \
+        cytometer.data.AidaAnnotationWriter(annotations_file, mode=annotations_mode,
+                                            number_of_attempts=number_of_attempts,
+                                            layer_item_counts=layer_item_counts['annotations'])
+    annotations_corrected_writer = \
+        cytometer.data.AidaAnnotationWriter(annotations_corrected_file, mode=annotations_mode,
+                                            number_of_attempts=number_of_attempts,
+                                            layer_item_counts=layer_item_counts['annotations_corrected'])
+
+    # the writer thread gets the post-processing futures in tile order
+    write_queue = queue.Queue(maxsize=max_pending)
+    results = {}
+    writer_errors = []
+    writer = threading.Thread(target=_write_tiles,
+                              args=(write_queue, annotations_writer, annotations_corrected_writer, results,
+                                    writer_errors, tiles, job_state, cells_file is not None, sketch, sketch_file,
+                                    cells_file if job_state is not None else None))
+    writer.start()
+
+    has_core = all([x in tiles.columns for x in ['core_first_row', 'core_last_row', 'core_first_col', 'core_last_col']])
+    if tiles_per_batch is None:
+        tiles_per_batch = batch_size
+
+    try:
+
+        # tiles waiting for clean_segmentation() and one_image_per_label_v2(): (k, time_start, future)
+        pending = collections.deque()
+        reading = True
+        while reading or len(pending) > 0:
+
+            if len(writer_errors) > 0:
+                raise writer_errors[0]
+
+            # stage 2: dmap, contour and classifier networks, on a batch of tiles
+            if reading:
+                batch = []
+                while reading and len(batch) < tiles_per_batch:
+                    item = _get_tile(tile_queue, reader, histo_file)
+                    if item is None:
+                        reading = False
+                    elif isinstance(item, str):
+                        raise RuntimeError('Error reading tiles from ' + histo_file + ':\n' + item)
+                    else:
+                        batch.append(item)
+                if len(batch) > 0:
+                    time_start = time.time()
+                    labels_list, labels_class_list, _ = \
+                        cytometer.utils.segment_dmap_contour_v6_batch([tile for _, tile, _ in batch],
+                                                                      dmap_model=dmap_model,
+                                                                      contour_model=contour_model,
+                                                                      classifier_model=classifier_model,
+                                                                      border_dilation=0, batch_size=batch_size,
+                                                                      model_cache=model_cache,
+                                                                      shape_buckets=shape_buckets, executor=pool)
+                    for (k, tile, mask_tile), labels, labels_class in zip(batch, labels_list, labels_class_list):
+                        if has_core:
+                            core = tiles.loc[k, ['first_row', 'first_col', 'core_first_row', 'core_last_row',
+                                                 'core_first_col', 'core_last_col']].values
+                        else:
+                            core = None
+                        future = pool.submit(_clean_and_crop, tile, labels, labels_class, mask_tile, core,
+                                             min_cell_area, max_cell_area, remove_edge_labels, min_mask_overlap,
+                                             phagocytosis, min_class_prop, correction_window_len)
+                        pending.append((k, time_start, future))
+
+            # stage 2 (cont.): correction network, for tiles in order. We only wait for the post-processing if there's nothing
+            # else to do, or too many tiles are pending
+            while len(pending) > 0 and (pending[0][2].done() or not reading or len(pending) >= max_pending):
+                k, time_start, future = pending.popleft()
+                (window_labels, window_im, window_labels_class), index_list, scaling_factor_list = future.result()
+
+                if len(index_list) > 0:
+                    window_im = window_im.astype(np.float32)
+                    window_im /= 255
+                    window_labels_corrected = \
+                        cytometer.utils.correct_segmentation(im=window_im, seg=window_labels,
+                                                             correction_model=correction_model, model_type='-1_1',
+                                                             smoothing=correction_smoothing, batch_size=batch_size,
+                                                             model_cache=model_cache)
+                else:
+                    window_labels_corrected = window_labels
+
+                first_row, last_row, first_col, last_col = \
+                    tiles.loc[k, ['first_row', 'last_row', 'first_col', 'last_col']].values
+                rectangle = (int(first_col), int(first_row), int(last_col - first_col), int(last_row - first_row))
+
+                # stage 3: contours
+                future = pool.submit(_contours_to_items, window_labels, window_labels_corrected, window_labels_class,
+                                     index_list, scaling_factor_list, rectangle, f_area2quantile, xres, yres,
+                                     contour_downsample_factor, bspline_k,
+                                     cells_file is not None or sketch_file is not None)
+                write_queue.put((k, time_start, future))
+
+            # clear the keras session if too many models have been built
+            model_cache.check_session()
+
+    finally:
+
+        # stop the writer after the last tile, and wait for it to finish
+        write_queue.put(None)
+        writer.join()
+        annotations_writer.close()
+        annotations_corrected_writer.close()
+        if executor is None:
+            pool.shutdown(wait=True)
+        if reader.is_alive():
+            reader.terminate()
+        reader.join()
+
+    if len(writer_errors) > 0:
+        raise writer_errors[0]
+
+    # summary of processed tiles, including those from previous runs
+    if job_state is not None:
+        k_todo = set(tiles_todo.index)
+        records = {tuple(record['tile']): record for record in job_state.records if record.get('tile') is not None}
+        for k, x in zip(tiles.index, tiles[['first_row', 'last_row', 'first_col', 'last_col']].values.tolist()):
+            if k not in k_todo and tuple(x) in records:
+                results[k] = {'num_objects': records[tuple(x)].get('num_objects', np.nan),
+                              'time': records[tuple(x)].get('time', np.nan)}
+    tiles_out = tiles.copy()
+
+    # cell table, in tile order. Tiles completed in a previous run are read from their fragments or, failing that,
+    # from the cells_file of the previous run
+    if cells_file is not None:
+        slide_id = os.path.splitext(os.path.basename(histo_file))[0]
+        for k in tiles.index:
+            if k in results and 'cells' in results[k]:
+                results[k]['cells'][0].insert(0, 'tile', k)
+                results[k]['cells'][0].insert(0, 'slide', slide_id)
+        if job_state is not None:
+            k_missing = []
+            for k in tiles.index[~tiles.index.isin(tiles_todo.index)]:
+                fragment_file = _cells_fragment_file(cells_file, tiles.loc[k])
+                if os.path.isfile(fragment_file):
+                    table, xy, offsets = cytometer.data.read_cell_table(fragment_file)
+                    table.insert(0, 'tile', k)
+                    table.insert(0, 'slide', slide_id)
+                    results.setdefault(k, {})['cells'] = (table, xy, offsets)
+                else:
+                    k_missing.append(k)
+            if len(k_missing) > 0 and os.path.isfile(cells_file):
+                table, xy, offsets = cytometer.data.read_cell_table(cells_file)
+                table = table.drop(columns='cell_id')
+                contours = cytometer.data.unpack_contours(xy, offsets)
+                for k in k_missing:
+                    keep = table['tile'].values == k
+                    results.setdefault(k, {})['cells'] = \
+                        (table[keep].reset_index(drop=True),) \
+                        + cytometer.data.pack_contours([c for c, x in zip(contours, keep) if x])
+            elif len(k_missing) > 0:
+                warnings.warn('Resuming ' + histo_file + ' with ' + str(len(k_missing)) + ' completed tiles without '
+                              + 'cell table fragments or previous cells_file. Their cells are missing from '
+                              + cells_file)
+        cells = [results[k]['cells'] for k in tiles.index if k in results and 'cells' in results[k]]
+        table, xy, offsets = cytometer.data.concat_cell_tables(cells)
+        table.insert(min(2, len(table.columns)), 'cell_id', np.arange(len(table)))
+        cytometer.data.write_cell_table(cells_file, table, xy, offsets)
+        if os.path.isdir(cells_file + '.tiles'):
+            shutil.rmtree(cells_file + '.tiles', ignore_errors=True)
+
+    # quantile sketch, also if all the tiles were completed in a previous run
+    if sketch is not None:
+        sketch.save(sketch_file)
+
+    tiles_out['num_objects'] = [results[k]['num_objects'] if k in results else np.nan for k in tiles.index]
+    tiles_out['time'] = [results[k]['time'] if k in results else np.nan for k in tiles.index]
+
+    return tiles_out
+
+
+def _read_tiles(histo_file, tiles, lores_mask, colour_offset, tile_queue):
+    """
+    Stage 1: Read tiles from slide and put them in the queue as (k, tile, mask_tile), followed by None. If there's an
+    error, the traceback is put in the queue as a string.
+    """
+
+    try:
+        im = openslide.OpenSlide(histo_file)
+        for k in tiles.index:
+            first_row, last_row, first_col, last_col = \
+                tiles.loc[k, ['first_row', 'last_row', 'first_col', 'last_col']].values.astype(int)
+
+            # load window from full resolution slide
+            tile = im.read_region(location=(first_col, first_row), level=0,
+                                  size=(last_col - first_col, last_row - first_row))
+            tile = np.array(tile)
+            tile = tile[:, :, 0:3]
+
+            # correct tint of the tile
+            if colour_offset is not None:
+                tile = np.clip(tile.astype(np.int16) + np.array(colour_offset, dtype=np.int16), 0, 255) \
+                    .astype(np.uint8)
+
+            # interpolate coarse tissue segmentation to full resolution
+            if lores_mask is not None:
+                lores_first_row, lores_last_row, lores_first_col, lores_last_col = \
+                    tiles.loc[k, ['lores_first_row', 'lores_last_row', 'lores_first_col', 'lores_last_col']] \
+                        .values.astype(int)
+                mask_tile = lores_mask[lores_first_row:lores_last_row, lores_first_col:lores_last_col]
+                mask_tile = cytometer.utils.resize(mask_tile, size=(last_col - first_col, last_row - first_row),
+                                                   resample=Image.NEAREST)
+            else:
+                mask_tile = None
+
+            tile_queue.put((k, tile, mask_tile))
+        im.close()
+        tile_queue.put(None)
+    except:
+        tile_queue.put(traceback.format_exc())
+
+
+def _get_tile(tile_queue, reader, histo_file, timeout=5.0):
+    """
+    Get the next item from the reader's queue. Instead of blocking forever, raise an error if the reader process dies
+    without putting its end or error message in the queue, e.g. if it's killed by the OOM killer.
+    """
+
+    while True:
+        try:
+            return tile_queue.get(timeout=timeout)
+        except queue.Empty:
+            if not reader.is_alive():
+                # the reader may have put its last item just before exiting
+                try:
+                    return tile_queue.get(timeout=timeout)
+                except queue.Empty:
+                    raise RuntimeError('Tile reader process for ' + histo_file + ' died with exit code '
+                                       + str(reader.exitcode))
+
+
+def _clean_and_crop(tile, labels, labels_class, mask, core, min_cell_area, max_cell_area, remove_edge_labels,
+                    min_mask_overlap, phagocytosis, min_class_prop, correction_window_len):
+    """
+    Post-processing between the segmentation and correction networks: Clean the segmentation and crop one image per
+    object.
+    """
+
+    # remove labels that are too small or too large, don't overlap enough with the tissue mask, are fully surrounded by
+    # another label or are not white adipose tissue. We may also remove cells that touch the edge
+    labels, _ = cytometer.utils.clean_segmentation(labels, min_cell_area=min_cell_area, max_cell_area=max_cell_area,
+                                                   remove_edge_labels=remove_edge_labels,
+                                                   mask=mask, min_mask_overlap=min_mask_overlap,
+                                                   phagocytosis=phagocytosis,
+                                                   labels_class=labels_class, min_class_prop=min_class_prop)
+
+    # keep only labels with the centroid in the tile's core region
+    if core is not None:
+        first_row, first_col, core_first_row, core_last_row, core_first_col, core_last_col = core
+        labels_flat = labels.ravel()
+        count = np.bincount(labels_flat)
+        rows, cols = np.divmod(np.arange(labels_flat.size), labels.shape[1])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            centroid_row = first_row + np.bincount(labels_flat, weights=rows) / count
+            centroid_col = first_col + np.bincount(labels_flat, weights=cols) / count
+        in_core = (centroid_row >= core_first_row) & (centroid_row < core_last_row) \
+                  & (centroid_col >= core_first_col) & (centroid_col < core_last_col)
+        in_core[0] = True
+        labels = labels * in_core[labels]
+
+    if np.count_nonzero(labels) == 0:
+        return (np.array([]), np.array([]), np.array([])), [], []
+
+    # split image into individual labels
+    return cytometer.utils.one_image_per_label_v2((labels, tile, labels_class),
+                                                  resize_to=(correction_window_len, correction_window_len),
+                                                  resample=(Image.NEAREST, Image.LINEAR, Image.NEAREST),
+                                                  only_central_label=True, return_bbox=True)
+
+
+def _contours_to_items(window_labels, window_labels_corrected, window_labels_class, index_list, scaling_factor_list,
+                       rectangle, f_area2quantile, xres, yres, contour_downsample_factor, bspline_k, return_cells=False):
+    """
+    Post-processing after the correction network: Convert the cropped segmentations to contours in slide coordinates,
+    and then to AIDA items.
+
+    :return: rectangle_items, contour_items, contour_items_corrected, and if return_cells=True, the (table, xy, offsets)
+    cell table of the tile's contours (see cytometer.data.cell_table()).
+    """
+
+    rectangle_items = cytometer.data.aida_rectangle_items([rectangle, ])
+    if len(index_list) == 0:
+        if return_cells:
+            return rectangle_items, [], [], cytometer.data.concat_cell_tables([])
+        return rectangle_items, [], []
+
+    # offset of the crops in the slide. index_list: [i, lab, r0, c0, rend, cend]
+    index_list = np.vstack(index_list)
+    offset_xy = index_list[:, [3, 2]]
+    first_col, first_row = rectangle[0:2]
+
+    items = []
+    cells = []
+    for labels in (window_labels, window_labels_corrected):
+
+        # "white adipocyte" probability for each object
+        cell_prob = np.sum(labels * window_labels_class, axis=(1, 2)) / np.sum(labels, axis=(1, 2))
+
+        # convert labels in cropped images to contours (points) in the tile
+        contours = cytometer.utils.labels2contours_batch(labels, offset_xy=offset_xy,
+                                                         scaling_factor_xy=scaling_factor_list)
+
+        # downsample contours for AIDA annotations file, and add tile offset
+        if bspline_k == 1:
+            lores_contours = cytometer.utils.resample_contours(contours, factor=contour_downsample_factor, min_n=10,
+                                                               is_closed=True)
+        else:
+            lores_contours = [cytometer.utils.bspline_resample(c, factor=contour_downsample_factor, min_n=10,
+                                                               k=bspline_k, is_closed=True) for c in contours]
+        for lores_c in lores_contours:
+            lores_c[:, 0] += first_col
+            lores_c[:, 1] += first_row
+
+        items.append(cytometer.data.aida_contour_items(lores_contours, f_area2quantile, cell_prob=cell_prob,
+                                                       xres=xres, yres=yres))
+        if return_cells:
+            cells.append(cytometer.data.cell_table(lores_contours, xres=xres, yres=yres, cell_prob=cell_prob,
+                                                   corrected=len(cells) > 0))
+
+    if return_cells:
+        return rectangle_items, items[0], items[1], cytometer.data.concat_cell_tables(cells)
+    return rectangle_items, items[0], items[1]
+
+
+def _write_tiles(write_queue, annotations_writer, annotations_corrected_writer, results, errors, tiles=None,
+                 job_state=None, keep_cells=True, sketch=None, sketch_file=None, cells_file=None):
+    """
+    Stage 4: Write the items of each tile to the annotations files, in the order of the queue, update the quantile
+    sketch of cell areas, save the cell table fragment of the tile (if cells_file is provided), and log the tile in the
+    job state. The fragment is saved before the tile is logged, so that every logged tile has its fragment.
+    """
+
+    while True:
+        job = write_queue.get()
+        if job is None:
+            break
+        if len(errors) > 0:
+            # drain the queue after an error, so that the main process doesn't block
+            continue
+        k, time_start, future = job
+        try:
+            result = future.result()
+            rectangle_items, contour_items, contour_items_corrected = result[0:3]
+            if len(contour_items) > 0:
+                annotations_writer.write_new_items(rectangle_items, mode='append_to_last_layer')
+                annotations_writer.write_new_items(contour_items, mode='append_new_layer')
+                annotations_corrected_writer.write_new_items(rectangle_items, mode='append_to_last_layer')
+                annotations_corrected_writer.write_new_items(contour_items_corrected, mode='append_new_layer')
+            results[k] = {'num_objects': len(contour_items), 'time': time.time() - time_start}
+            if len(result) > 3 and keep_cells:
+                results[k]['cells'] = result[3]
+                if cells_file is not None:
+                    os.makedirs(cells_file + '.tiles', exist_ok=True)
+                    cytometer.data.write_cell_table(_cells_fragment_file(cells_file, tiles.loc[k]), *result[3])
+            record = {}
+            if sketch is not None:
+                table = result[3][0]
+                tile_sketch = cytometer.data.QuantileSketch(relative_accuracy=sketch.relative_accuracy)
+                if len(table) > 0:
+                    tile_sketch.update(table.loc[table['corrected'], 'area_um2'].values)
+                sketch.merge(tile_sketch)
+                sketch.save(sketch_file)
+                record['area_sketch'] = tile_sketch.to_dict()
+            if job_state is not None:
+                job_state.append({'tile': tiles.loc[k, ['first_row', 'last_row', 'first_col', 'last_col']].tolist(),
+                                  'num_objects': results[k]['num_objects'], 'time': results[k]['time'],
+                                  'annotations': annotations_writer.layer_item_counts(),
+                                  'annotations_corrected': annotations_corrected_writer.layer_item_counts(),
+                                  **record})
+            if DEBUG:
+                print('Tile ' + str(k) + ': ' + str(len(contour_items)) + ' objects')
+        except Exception as e:
+            errors.append(e)
+
+
+def _cells_fragment_file(cells_file, tile):
+    """
+    Path of the cell table fragment of a tile, named after the tile's window, so that it doesn't depend on the row
+    index of the tile.
+    """
+    return os.path.join(cells_file + '.tiles', '_'.join([str(int(tile[key])) for key in
+                                                          ['first_row', 'last_row', 'first_col', 'last_col']]) + '.npz')
+
+
+def _write_json_atomic(filename, obj):
+    """
+    Write object to a JSON file via a temporary file, so that other processes never see a partially written file.
+    """
+    tmp_file = filename + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_file, 'w') as fp:
+        ujson.dump(obj, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_file, filename)
+
+
+class TileWorkQueue(object):
+    """
+    Work queue of slide tiles on a shared filesystem, so that any number of worker processes on any number of cluster
+    nodes can segment a cohort of slides without a broker.
+
+    Each slide is split into work items of tiles_per_item tiles. The queue is a directory with this layout:
+
+        queue_dir/slides/<slide_id>.json            slide parameters and number of items
+        queue_dir/slides/<slide_id>.npz             low resolution tissue mask (optional)
+        queue_dir/todo/<slide_id>.<i>.json          work items waiting to be claimed
+        queue_dir/claimed/<slide_id>.<i>.json       work items being processed
+        queue_dir/done/<slide_id>.<i>.json          work item results (number of objects and time per tile)
+        queue_dir/results/<slide_id>.<i>.json       annotations of each work item (and cell table and area sketch,
+                                                    if requested)
+        queue_dir/merging/<slide_id>.json           slides being merged
+        queue_dir/merged/<slide_id>.json            slides whose annotations have been merged
+        queue_dir/leases/<name>.<worker>            lease of each claimed item or slide being merged
+
+    Work items are claimed by renaming them from todo/ to claimed/. os.rename() is atomic, so only one worker can claim
+    each item, also on NFS. Slides are merged the same way, by renaming the slide file to merging/, and then to merged/
+    after all the merged files have been written.
+
+    Before trying to claim an item, the worker creates a lease file with its own name, and it touches it regularly with
+    heartbeat() while it processes the item. The modification time of the lease, not of the claimed file (os.rename()
+    keeps the modification time of the todo file), tells requeue_stale() whether the worker is still alive. If a worker
+    dies, its claimed items stay in claimed/ until requeue_stale() moves them back to todo/ and removes the lease.
+
+    Each worker writes its results to its own files (see result_files()), and complete() moves them to the item's
+    result files only if the worker still holds the lease, so that a worker whose item was requeued can't overwrite
+    the results of the worker that took it over.
+
+    Usage:
+
+        # submit node
+        work_queue = cytometer.pipeline.TileWorkQueue(queue_dir)
+        for histo_file in histo_files_list:
+            tiles = cytometer.utils.get_all_rois_to_process(...)
+            work_queue.add_slide(histo_file, tiles, annotations_file, annotations_corrected_file, lores_mask=...)
+
+        # any number of worker jobs, e.g. an SGE array job
+        cytometer.pipeline.run_worker(queue_dir, dmap_model, contour_model, classifier_model, correction_model,
+                                      f_area2quantile)
+    """
+
+    _subdirs = ['slides', 'todo', 'claimed', 'done', 'results', 'merging', 'merged', 'leases']
+
+    def __init__(self, queue_dir, worker_id=None):
+        """
+        Open a work queue, creating its directories if they don't exist.
+
+        :param queue_dir: String with path to the queue directory on a shared filesystem.
+        :param worker_id: (def None) String that identifies this worker in the lease files. By default, the host name,
+        process id and a random number.
+        """
+        self.queue_dir = queue_dir
+        if worker_id is None:
+            worker_id = socket.gethostname() + '-' + str(os.getpid()) + '-' + uuid.uuid4().hex[:8]
+        self.worker_id = worker_id.replace('.', '-')
+        for subdir in self._subdirs:
+            os.makedirs(os.path.join(queue_dir, subdir), exist_ok=True)
+
+    def _path(self, subdir, name):
+        return os.path.join(self.queue_dir, subdir, name)
+
+    def _list(self, subdir):
+        return sorted([x for x in os.listdir(os.path.join(self.queue_dir, subdir)) if x.endswith('.json')])
+
+    def _lease(self, name):
+        return self._path('leases', name + '.' + self.worker_id)
+
+    def _leases(self, name):
+        """
+        Lease files of all the workers for an item or slide file name.
+        """
+        return [self._path('leases', x) for x in os.listdir(os.path.join(self.queue_dir, 'leases'))
+                if x.startswith(name + '.')]
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+    def _merge_file(self, filename):
+        """
+        Temporary file where this worker writes a merged file, with the same extension.
+        """
+        root, ext = os.path.splitext(filename)
+        return root + '.' + self.worker_id + '.merge' + ext
+
+    def _acquire(self, name, subdir_from, subdir_to):
+        """
+        Create this worker's lease for a file, and move the file from subdir_from to subdir_to.
+
+        :return:
+        * True if the file was moved by this worker, False if another worker moved it first.
+        """
+
+        # the lease exists before the claim, so that requeue_stale() never sees a claim without a fresh lease
+        with open(self._lease(name), 'w'):
+            pass
+        try:
+            os.rename(self._path(subdir_from, name), self._path(subdir_to, name))
+        except FileNotFoundError:
+            self._remove(self._lease(name))
+            return False
+        return True
+
+    def has_lease(self, name):
+        """
+        Whether this worker still holds the lease of a claimed item, i.e. the item hasn't been requeued.
+
+        :param name: Item file name returned by claim().
+        :return:
+        * Bool.
+        """
+        return os.path.isfile(self._lease(name))
+
+    def heartbeat(self, name):
+        """
+        Refresh the lease of a claimed item or slide being merged, so that requeue_stale() doesn't requeue it.
+
+        :param name: Item file name returned by claim().
+        :return:
+        * True if the lease was refreshed, False if it had been lost.
+        """
+        try:
+            os.utime(self._lease(name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def add_slide(self, histo_file, tiles, annotations_file, annotations_corrected_file, slide_id=None,
+                  lores_mask=None, colour_offset=None, tiles_per_item=16, cells_file=None, sketch_file=None):
+        """
+        Add the tiles of a slide to the queue.
+
+        :param histo_file: String with path to the histology slide.
+        :param tiles: pandas.DataFrame with one row per tile (see segment_slide()).
+        :param annotations_file: String with path to the merged annotations file.
+        :param annotations_corrected_file: String with path to the merged annotations file with corrected contours.
+        :param slide_id: (def None) Unique name of the slide in the queue. By default, the basename of histo_file
+        without extension.
+        :param lores_mask: (def None) Low resolution tissue mask (see segment_slide()).
+        :param colour_offset: (def None) (r, g, b) values added to each tile to correct its tint.
+        :param tiles_per_item: (def 16) Number of tiles in each work item.
+        :param cells_file: (def None) String with path to the merged cell table (see segment_slide()).
+        :param sketch_file: (def None) String with path to the merged quantile sketch of cell areas (see
+        segment_slide()).
+        :return:
+        * slide_id: String.
+        """
+
+        if slide_id is None:
+            slide_id = os.path.splitext(os.path.basename(histo_file))[0]
+        if any([os.path.isfile(self._path(subdir, slide_id + '.json')) for subdir in ['slides', 'merging', 'merged']]):
+            raise ValueError('Slide already in the queue: ' + slide_id)
+
+        tiles = tiles.reset_index(drop=True)
+        num_items = int(np.ceil(len(tiles) / tiles_per_item))
+
+        # the slide file is written last, so that workers don't try to merge a slide with items missing
+        if lores_mask is not None:
+            np.savez_compressed(self._path('slides', slide_id + '.tmp.npz'), lores_mask=lores_mask)
+            os.replace(self._path('slides', slide_id + '.tmp.npz'), self._path('slides', slide_id + '.npz'))
+        for i in range(num_items):
+            chunk = tiles.iloc[i * tiles_per_item:(i + 1) * tiles_per_item]
+            item = {'slide_id': slide_id, 'item': i,
+                    'tiles': {col: chunk[col].tolist() for col in chunk.columns}}
+            _write_json_atomic(self._path('todo', slide_id + '.' + '{:06d}'.format(i) + '.json'), item)
+        _write_json_atomic(self._path('slides', slide_id + '.json'),
+                           {'slide_id': slide_id, 'histo_file': histo_file, 'annotations_file': annotations_file,
+                            'annotations_corrected_file': annotations_corrected_file,
+                            'has_lores_mask': lores_mask is not None,
+                            'colour_offset': None if colour_offset is None else [float(x) for x in colour_offset],
+                            'cells_file': cells_file, 'sketch_file': sketch_file,
+                            'tiles_per_item': tiles_per_item, 'num_items': num_items})
+
+        return slide_id
+
+    def claim(self):
+        """
+        Claim the next work item in the queue.
+
+        :return:
+        * (name, item), where name is the item file name and item a dictionary with keys 'slide_id', 'item' and
+          'tiles'. None if there are no items left to claim.
+        """
+
+        for name in self._list('todo'):
+            if not self._acquire(name, 'todo', 'claimed'):
+                # another worker claimed this item first
+                continue
+            try:
+                with open(self._path('claimed', name)) as fp:
+                    return name, ujson.load(fp)
+            except FileNotFoundError:
+                # the item was requeued meanwhile
+                self._remove(self._lease(name))
+                continue
+        return None
+
+    def complete(self, name, tiles_out):
+        """
+        Mark a claimed work item as done, and move this worker's result files to the item's result files.
+
+        If the item was requeued by requeue_stale() while this worker was processing it, this worker's results are
+        discarded, as another worker is processing or has processed the item.
+
+        :param name: Item file name returned by claim().
+        :param tiles_out: pandas.DataFrame returned by segment_slide() for the item.
+        :return:
+        * True if the item was completed by this worker, False if the claim had been lost.
+        """
+
+        if not self.has_lease(name):
+            for filename in self.result_files(name, worker=True):
+                self._remove(filename)
+            return False
+
+        for filename_worker, filename in zip(self.result_files(name, worker=True), self.result_files(name)):
+            if os.path.isfile(filename_worker):
+                os.replace(filename_worker, filename)
+        _write_json_atomic(self._path('done', name),
+                           {'num_objects': tiles_out['num_objects'].tolist(), 'time': tiles_out['time'].tolist()})
+        self._remove(self._path('claimed', name))
+        self._remove(self._lease(name))
+        return True
+
+    def release(self, name):
+        """
+        Put a claimed work item back in the queue, e.g. after an error.
+
+        :param name: Item file name returned by claim().
+        """
+        if self.has_lease(name):
+            try:
+                os.rename(self._path('claimed', name), self._path('todo', name))
+            except FileNotFoundError:
+                pass
+            self._remove(self._lease(name))
+        for filename in self.result_files(name, worker=True):
+            self._remove(filename)
+
+    def requeue_stale(self, max_age):
+        """
+        Put back in the queue work items whose lease hasn't been refreshed for more than max_age seconds, e.g. because
+        their workers died, and slides whose merge was interrupted.
+
+        :param max_age: Time in seconds. It should be several times the interval between heartbeat() calls.
+        :return:
+        * List of requeued item and slide file names.
+        """
+
+        requeued = []
+        now = time.time()
+        for subdir_from, subdir_to in [('claimed', 'todo'), ('merging', 'slides')]:
+            for name in self._list(subdir_from):
+                leases = self._leases(name)
+                age = np.inf
+                for lease in leases:
+                    try:
+                        age = min(age, now - os.path.getmtime(lease))
+                    except FileNotFoundError:
+                        # the item was completed meanwhile
+                        age = 0
+                if age <= max_age:
+                    continue
+                try:
+                    os.rename(self._path(subdir_from, name), self._path(subdir_to, name))
+                except FileNotFoundError:
+                    # the item was completed meanwhile
+                    continue
+                # only the stale leases are removed, as a new worker may have already claimed the requeued item
+                for lease in leases:
+                    self._remove(lease)
+                requeued.append(name)
+        return requeued
+
+    def slides(self):
+        """
+        Slides that haven't been merged yet.
+
+        :return:
+        * List of slide_id strings.
+        """
+        return [os.path.splitext(name)[0] for name in self._list('slides')]
+
+    def slide(self, slide_id):
+        """
+        Load the slide parameters.
+
+        :param slide_id: String.
+        :return:
+        * slide: Dictionary with the parameters passed to add_slide(), plus 'lores_mask' (array or None).
+        """
+
+        for subdir in ['slides', 'merging', 'merged']:
+            try:
+                with open(self._path(subdir, slide_id + '.json')) as fp:
+                    slide = ujson.load(fp)
+                break
+            except FileNotFoundError:
+                # the slide file is moved between directories while it's being merged
+                continue
+        else:
+            raise FileNotFoundError('Slide not in the queue: ' + slide_id)
+        if slide['has_lores_mask']:
+            with np.load(self._path('slides', slide_id + '.npz')) as aux:
+                slide['lores_mask'] = aux['lores_mask']
+        else:
+            slide['lores_mask'] = None
+        return slide
+
+    def result_files(self, name, worker=False):
+        """
+        Annotations files where a worker writes the results of a work item.
+
+        :param name: Item file name returned by claim().
+        :param worker: (def False) If True, the files where this worker writes the results while it processes the
+        item, that are moved to the item's result files by complete().
+        :return:
+        * (annotations_file, annotations_corrected_file, cells_file, sketch_file)
+        """
+        name = os.path.splitext(name)[0]
+        if worker:
+            name += '.' + self.worker_id
+        return self._path('results', name + '.json'), self._path('results', name + '_corrected.json'), \
+            self._path('results', name + '_cells.npz'), self._path('results', name + '_area_sketch.npz')
+
+    def status(self):
+        """
+        Number of work items in each state, and number of slides being merged and merged.
+
+        :return:
+        * Dictionary {'todo': int, 'claimed': int, 'done': int, 'merging': int, 'merged': int}.
+        """
+        return {subdir: len(self._list(subdir)) for subdir in ['todo', 'claimed', 'done', 'merging', 'merged']}
+
+    def merge_slide(self, slide_id, number_of_attempts=5):
+        """
+        Merge the annotations of all the work items of a slide into the slide's annotations files, if all the items
+        are done and no other worker is merging or has merged them.
+
+        Each work item's annotations have a 'Blocks' layer and a 'White adipocyte' layer per tile with objects (see
+        segment_slide()). The merged files keep that structure, with the tiles in the order they were added.
+
+        The slide is moved to merging/ while it's being merged, and to merged/ only after all the merged files have
+        been written. If the worker dies during the merge, requeue_stale() moves the slide back to slides/, so that
+        another worker can merge it.
+
+        The merged files are first written to temporary files of this worker (see _merge_file()), and moved to the
+        slide's files only if this worker still holds the lease of the merge. Thus, if a slow merge is requeued and
+        taken over by another worker, the two workers don't write to the same files. The lease is also checked before
+        each file, so that a worker that lost it stops early.
+
+        :param slide_id: String.
+        :param number_of_attempts: (def 5) Number of attempts for network filesystem operations.
+        :return:
+        * True if the slide was merged by this call, False otherwise.
+        """
+
+        name = slide_id + '.json'
+        try:
+            with open(self._path('slides', name)) as fp:
+                num_items = ujson.load(fp)['num_items']
+        except FileNotFoundError:
+            # slide already merged, or being merged
+            return False
+
+        names = [slide_id + '.' + '{:06d}'.format(i) + '.json' for i in range(num_items)]
+        if not all([os.path.isfile(self._path('done', x)) for x in names]):
+            return False
+
+        # claim the merge
+        if not self._acquire(name, 'slides', 'merging'):
+            return False
+        slide = self.slide(slide_id)
+        keys = [key for key in ['annotations_file', 'annotations_corrected_file', 'cells_file', 'sketch_file']
+                if slide.get(key) is not None]
+
+        try:
+
+            for i_file, key in enumerate(['annotations_file', 'annotations_corrected_file']):
+                if not self.has_lease(name):
+                    return False
+                with cytometer.data.AidaAnnotationWriter(self._merge_file(slide[key]), mode='w',
+                                                         number_of_attempts=number_of_attempts) as writer:
+                    for x in names:
+                        self.heartbeat(name)
+                        with open(self.result_files(x)[i_file]) as fp:
+                            layers = ujson.load(fp)['layers']
+
+                        # rectangles of tiles go to the last blocks layer, and each tile's contours to a new layer
+                        for layer in sorted(layers, key=lambda x: int(x['name'].split(' ')[-1])):
+                            if len(layer['items']) == 0:
+                                continue
+                            if layer['items'][0]['type'] == 'rectangle':
+                                writer.write_new_items(layer['items'], mode='append_to_last_layer', flush=False)
+                            else:
+                                writer.write_new_items(layer['items'], mode='append_new_layer', flush=False)
+                        writer.flush()
+
+            # concatenate the cell tables, with the item's tile indices converted to slide tile indices
+            if slide['cells_file'] is not None:
+                if not self.has_lease(name):
+                    return False
+                cells = []
+                for i, x in enumerate(names):
+                    table, xy, offsets = cytometer.data.read_cell_table(self.result_files(x)[2])
+                    if 'tile' in table.columns:
+                        table['tile'] += i * slide['tiles_per_item']
+                    cells.append((table.drop(columns='cell_id'), xy, offsets))
+                table, xy, offsets = cytometer.data.concat_cell_tables(cells)
+                table.insert(min(2, len(table.columns)), 'cell_id', np.arange(len(table)))
+                cytometer.data.write_cell_table(self._merge_file(slide['cells_file']), table, xy, offsets)
+
+            # merge the quantile sketches of cell areas
+            if slide.get('sketch_file') is not None:
+                if not self.has_lease(name):
+                    return False
+                sketch = cytometer.data.QuantileSketch.load(self.result_files(names[0])[3])
+                for x in names[1:]:
+                    sketch.merge(cytometer.data.QuantileSketch.load(self.result_files(x)[3]))
+                sketch.save(self._merge_file(slide['sketch_file']))
+
+            # the merged files are moved into place, and the slide marked as merged, only if the merge hasn't been
+            # requeued. Otherwise, another worker will write the merged files again
+            if not self.has_lease(name):
+                return False
+            for key in keys:
+                os.replace(self._merge_file(slide[key]), slide[key])
+            os.rename(self._path('merging', name), self._path('merged', name))
+            self._remove(self._lease(name))
+            return True
+
+        finally:
+            for key in keys:
+                self._remove(self._merge_file(slide[key]))
+
+
+def run_worker(queue_dir, dmap_model, contour_model, classifier_model, correction_model, f_area2quantile,
+               max_items=None, model_cache=None, number_of_attempts=5, heartbeat_interval=60, max_age=600, **kwargs):
+    """
+    Process work items from a TileWorkQueue until the queue is empty, merging the annotations of each slide after its
+    last item is done.
+
+    Several workers can run this function at the same time on the same queue_dir, e.g. as the tasks of an SGE array
+    job.
+
+    :param queue_dir: String with path to the queue directory (see TileWorkQueue).
+    :param dmap_model: See segment_slide().
+    :param contour_model: See segment_slide().
+    :param classifier_model: See segment_slide().
+    :param correction_model: See segment_slide().
+    :param f_area2quantile: See segment_slide().
+    :param max_items: (def None) Stop after processing this number of work items. By default, process items until
+    the queue is empty.
+    :param model_cache: (def None) cytometer.models.ModelCache shared by all work items. By default, a new cache is
+    created, so that models are only loaded once per worker.
+    :param number_of_attempts: (def 5) Number of attempts for network filesystem operations.
+    :param heartbeat_interval: (def 60) Seconds between refreshes of the lease of the item being processed.
+    :param max_age: (def 600) Items and merges whose lease hasn't been refreshed for max_age seconds are requeued
+    before claiming a new item (see TileWorkQueue.requeue_stale()). If None, items are not requeued.
+    :param kwargs: Other parameters passed to segment_slide(), e.g. batch_size, num_workers. The post-processing pool
+    of num_workers processes is created once and shared by all the work items.
+    :return:
+    * Number of work items processed by this worker.
+    """
+
+    work_queue = TileWorkQueue(queue_dir)
+    if model_cache is None:
+        model_cache = cytometer.models.ModelCache()
+    if kwargs.get('executor') is None:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=kwargs.pop('num_workers', None),
+                                                      mp_context=multiprocessing.get_context('spawn'))
+        kwargs['executor'] = pool
+    else:
+        pool = None
+
+    def heartbeat(name, stop):
+        while not stop.wait(heartbeat_interval):
+            work_queue.heartbeat(name)
+
+    try:
+
+        num_items = 0
+        slide_id = None
+        slide = None
+        while max_items is None or num_items < max_items:
+
+            # put back items of workers that died
+            if max_age is not None:
+                work_queue.requeue_stale(max_age)
+
+            claimed = work_queue.claim()
+            if claimed is None:
+                break
+            name, item = claimed
+
+            # consecutive items usually belong to the same slide
+            if item['slide_id'] != slide_id:
+                slide_id = item['slide_id']
+                slide = work_queue.slide(slide_id)
+
+            # keep the lease fresh while the item is processed
+            stop = threading.Event()
+            heartbeat_thread = threading.Thread(target=heartbeat, args=(name, stop), daemon=True)
+            heartbeat_thread.start()
+
+            annotations_file, annotations_corrected_file, cells_file, sketch_file = \
+                work_queue.result_files(name, worker=True)
+            try:
+                tiles_out = segment_slide(slide['histo_file'], pd.DataFrame(item['tiles']), dmap_model, contour_model,
+                                          classifier_model, correction_model, annotations_file,
+                                          annotations_corrected_file, f_area2quantile, lores_mask=slide['lores_mask'],
+                                          colour_offset=slide['colour_offset'], model_cache=model_cache,
+                                          annotations_mode='w', number_of_attempts=number_of_attempts,
+                                          cells_file=cells_file if slide['cells_file'] is not None else None,
+                                          sketch_file=sketch_file if slide.get('sketch_file') is not None else None,
+                                          **kwargs)
+            except BaseException:
+                work_queue.release(name)
+                raise
+            finally:
+                stop.set()
+                heartbeat_thread.join()
+            if work_queue.complete(name, tiles_out):
+                num_items += 1
+
+            work_queue.merge_slide(slide_id, number_of_attempts=number_of_attempts)
+
+        # merge slides whose last item was done by a worker that died before merging
+        for slide_id in work_queue.slides():
+            work_queue.merge_slide(slide_id, number_of_attempts=number_of_attempts)
+
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    return num_items
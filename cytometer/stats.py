@@ -9,6 +9,11 @@ import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
 import scipy.stats as stats
+import itertools
+import multiprocessing
+import concurrent.futures
+import statsmodels.api as sm
+from statsmodels.stats.multitest import multipletests
 # imports for sped up hdquantiles_sd
 from numpy import float_, int_, ndarray
 import numpy.ma as ma
@@ -132,49 +137,45 @@ def models_coeff_ci_pval(models, extra_hypotheses=None, model_names=None):
     output dataframe.
     :return: df_coeff, df_ci_lo, df_ci_hi, df_pval
     """
+    rows = [_model_coeff_ci_pval(model, extra_hypotheses) for model in models]
+    return _coeff_ci_pval_tables(rows, model_names)
+
+
+def _model_coeff_ci_pval(model, extra_hypotheses=None):
+    """
+    Coefficients, confidence intervals and p-values of one fitted model, for models_coeff_ci_pval().
+
+    :return: (coeff, ci_lo, ci_hi, pval) tuple of dictionaries {coefficient or hypothesis name: value}.
+    """
+    conf_int = model.conf_int()
+    coeff = dict(model.params)
+    ci_lo = dict(conf_int[0])
+    ci_hi = dict(conf_int[1])
+    pval = dict(model.pvalues)
+
+    # extra p-values
     if extra_hypotheses is not None:
         hypotheses_labels = extra_hypotheses.replace(' ', '').split(',')
-    df_coeff_tot = pd.DataFrame()
-    df_ci_lo_tot = pd.DataFrame()
-    df_ci_hi_tot = pd.DataFrame()
-    df_pval_tot = pd.DataFrame()
-    for model in models:
-        # values of coefficients
-        df_coeff = pd.DataFrame(data=model.params).transpose()
-        # values of coefficient's confidence interval
-        df_ci_lo = pd.DataFrame(data=model.conf_int()[0]).transpose().reset_index()
-        df_ci_hi = pd.DataFrame(data=model.conf_int()[1]).transpose().reset_index()
-        # p-values
-        df_pval = pd.DataFrame(data=model.pvalues).transpose()
-        # extra p-values
-        if extra_hypotheses is not None:
-            extra_tests = model.t_test(extra_hypotheses)
-
-            df = pd.DataFrame(data=[extra_tests.effect], columns=hypotheses_labels)
-            df_coeff = pd.concat([df_coeff, df], axis='columns')
-
-            df = pd.DataFrame(data=[extra_tests.conf_int()[:, 0]], columns=hypotheses_labels)
-            df_ci_lo = pd.concat([df_ci_lo, df], axis='columns')
-
-            df = pd.DataFrame(data=[extra_tests.conf_int()[:, 1]], columns=hypotheses_labels)
-            df_ci_hi = pd.concat([df_ci_hi, df], axis='columns')
-
-            df = pd.DataFrame(data=[extra_tests.pvalue], columns=hypotheses_labels)
-            df_pval = pd.concat([df_pval, df], axis='columns')
-
-        df_coeff_tot = pd.concat((df_coeff_tot, df_coeff))
-        df_ci_lo_tot = pd.concat((df_ci_lo_tot, df_ci_lo))
-        df_ci_hi_tot = pd.concat((df_ci_hi_tot, df_ci_hi))
-        df_pval_tot = pd.concat((df_pval_tot, df_pval))
-
-    df_coeff_tot = df_coeff_tot.reset_index()
-    df_ci_lo_tot = df_ci_lo_tot.reset_index()
-    df_ci_hi_tot = df_ci_hi_tot.reset_index()
-    df_pval_tot = df_pval_tot.reset_index()
-    df_coeff_tot.drop(labels='index', axis='columns', inplace=True)
-    df_ci_lo_tot = df_ci_lo_tot[df_coeff_tot.columns].copy()
-    df_ci_hi_tot = df_ci_hi_tot[df_coeff_tot.columns].copy()
-    df_pval_tot = df_pval_tot[df_coeff_tot.columns].copy()
+        extra_tests = model.t_test(extra_hypotheses)
+        extra_conf_int = extra_tests.conf_int()
+        coeff.update(zip(hypotheses_labels, np.atleast_1d(extra_tests.effect)))
+        ci_lo.update(zip(hypotheses_labels, extra_conf_int[:, 0]))
+        ci_hi.update(zip(hypotheses_labels, extra_conf_int[:, 1]))
+        pval.update(zip(hypotheses_labels, np.atleast_1d(extra_tests.pvalue)))
+
+    return coeff, ci_lo, ci_hi, pval
+
+
+def _coeff_ci_pval_tables(rows, model_names=None):
+    """
+    Build the output dataframes of models_coeff_ci_pval() in one go from the rows of _model_coeff_ci_pval().
+
+    Columns are all the coefficients and hypotheses in order of appearance, with NaN for those not in a model.
+    """
+    df_coeff_tot = pd.DataFrame([row[0] for row in rows])
+    df_ci_lo_tot = pd.DataFrame([row[1] for row in rows], columns=df_coeff_tot.columns)
+    df_ci_hi_tot = pd.DataFrame([row[2] for row in rows], columns=df_coeff_tot.columns)
+    df_pval_tot = pd.DataFrame([row[3] for row in rows], columns=df_coeff_tot.columns)
 
     if model_names is not None:
         df_coeff_tot['model'] = model_names
@@ -187,6 +188,95 @@ def models_coeff_ci_pval(models, extra_hypotheses=None, model_names=None):
         df_pval_tot = df_pval_tot.set_index('model')
     return df_coeff_tot, df_ci_lo_tot, df_ci_hi_tot, df_pval_tot
 
+
+def _fit_model_spec(spec, extra_hypotheses=None, return_model=False):
+    """
+    Fit the model of one specification, for fit_models_coeff_ci_pval().
+
+    :return: (coeff, ci_lo, ci_hi, pval) as in _model_coeff_ci_pval(), and the fitted model if return_model=True.
+    """
+    spec = dict(spec)
+    formula = spec.pop('formula')
+    data = spec.pop('data')
+    estimator = spec.pop('estimator', 'OLS')
+    spec.pop('name', None)
+    extra_hypotheses = spec.pop('extra_hypotheses', extra_hypotheses)
+    fit_kwargs = spec.pop('fit_kwargs', {})
+    if isinstance(estimator, str):
+        estimator = getattr(sm, estimator)
+
+    # remaining keys are passed to the model, e.g. subset, M (RLM) or family (GLM)
+    model = estimator.from_formula(formula, data=data, **spec).fit(**fit_kwargs)
+    row = _model_coeff_ci_pval(model, extra_hypotheses)
+    if return_model:
+        return row + (model,)
+    else:
+        return row
+
+
+def fit_models_coeff_ci_pval(specs, extra_hypotheses=None, num_workers=0, multitest_method=None, alpha=0.05,
+                             return_models=False):
+    """
+    Fit a batch of statsmodels models and extract their betas (coefficients), confidence intervals and p-values, as
+    in models_coeff_ci_pval(), optionally in parallel and with multiple test correction of the p-values.
+
+    * Example of specifications:
+
+    specs = [{'name': 'gwat_q1', 'formula': 'area_Q1 ~ DW * C(Genotype)', 'data': df_slides,
+              'subset': df_slides['depot'] == 'gWAT'},
+             {'name': 'gwat_q1_rlm', 'formula': 'area_Q1 ~ DW * C(Genotype)', 'data': df_slides, 'estimator': 'RLM',
+              'M': sm.robust.norms.HuberT(), 'subset': df_slides['depot'] == 'gWAT'},
+             ('area_Q2 ~ DW * C(Genotype)', df_slides, 'OLS')]
+
+    :param specs: List of model specifications. Each one is a tuple (formula, data, estimator), or a dictionary with
+    keys 'formula', 'data' and optionally 'estimator' (def 'OLS'), 'name', 'extra_hypotheses' (overrides the
+    extra_hypotheses parameter), 'fit_kwargs' (dictionary of parameters for fit()) and any other parameters for
+    from_formula(), e.g. 'subset', 'M' or 'family'. The estimator is the name of a model class in statsmodels.api
+    ('OLS', 'RLM', 'WLS', 'GLM'...) or the class itself.
+    :param extra_hypotheses: (def None) String with new hypotheses to t-test in each model (see
+    models_coeff_ci_pval()).
+    :param num_workers: (def 0) Number of processes the models are fitted in. If num_workers=0, models are fitted in
+    the current process. If None, the number of CPUs.
+    :param multitest_method: (def None) If provided, method for statsmodels.stats.multitest.multipletests, e.g.
+    'fdr_tsbky'. The p-values of each column (coefficient or hypothesis) are corrected across models, ignoring models
+    without that column.
+    :param alpha: (def 0.05) Error rate for the multiple test correction.
+    :param return_models: (def False) Also return the list of fitted models.
+    :return: df_coeff, df_ci_lo, df_ci_hi, df_pval as in models_coeff_ci_pval(), with the spec names as index if all
+    specs have a name. If multitest_method is provided, also df_corrected_pval. If return_models=True, also the list
+    of fitted models.
+    """
+    specs = [spec if isinstance(spec, dict) else dict(zip(['formula', 'data', 'estimator'], spec)) for spec in specs]
+    model_names = [spec.get('name') for spec in specs]
+    if any([name is None for name in model_names]):
+        model_names = None
+
+    args = (specs, itertools.repeat(extra_hypotheses), itertools.repeat(return_models))
+    if num_workers == 0:
+        rows = list(map(_fit_model_spec, *args))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers,
+                                                    mp_context=multiprocessing.get_context('spawn')) as executor:
+            rows = list(executor.map(_fit_model_spec, *args))
+
+    out = _coeff_ci_pval_tables(rows, model_names)
+
+    if multitest_method is not None:
+        df_corrected_pval = out[3].copy()
+        for col in df_corrected_pval.columns:
+            idx = df_corrected_pval[col].notna()
+            if np.any(idx):
+                _, df_corrected_pval.loc[idx, col], _, _ = multipletests(df_corrected_pval.loc[idx, col],
+                                                                         method=multitest_method, alpha=alpha,
+                                                                         returnsorted=False)
+        out += (df_corrected_pval,)
+
+    if return_models:
+        out += ([row[4] for row in rows],)
+
+    return out
+
+
 # likelihood ratio test by Joanna Diong
 stats.chisqprob = lambda chisq, df: stats.chi2.sf(chisq, df)
 def lrtest(llmin, llmax):
@@ -326,11 +416,15 @@ def inverse_variance_method(x, se):
     return x_hat, se_hat
 
 # originally copied from scipy/stats/mstats_extras.py
-# I have edited this to speed it up by a factor of ~537x for a data vector with 60,000 elements
-def hdquantiles_sd(data, prob=list([.25,.5,.75]), axis=None):
+# I have edited this to speed it up by a factor of ~537x for a data vector with 60,000 elements, and then rewritten the
+# jackknife with cumulative sums, so that it's O(n) per quantile instead of O(n^2)
+def hdquantiles_sd(data, prob=list([.25,.5,.75]), axis=None, max_n=None):
     """
     The standard error of the Harrell-Davis quantile estimates by jackknife.
 
+    The leave-one-out estimates are computed for all quantiles at once from cumulative sums of the weighted differences
+    between consecutive sorted values, rather than with one dot product per left-out element.
+
     Parameters
     ----------
     data : array_like
@@ -340,6 +434,10 @@ def hdquantiles_sd(data, prob=list([.25,.5,.75]), axis=None):
     axis : int, optional
         Axis along which to compute the quantiles. If None, use a flattened
         array.
+    max_n : int, optional
+        If the data has more than max_n elements, the standard error is
+        approximated from max_n evenly spaced order statistics, and scaled by
+        sqrt(max_n / n). If None, all the data is used.
 
     Returns
     -------
@@ -359,17 +457,31 @@ def hdquantiles_sd(data, prob=list([.25,.5,.75]), axis=None):
         hdsd = np.empty(len(prob), float_)
         if n < 2:
             hdsd.flat = np.nan
+            return hdsd
+
+        # approximation for large samples: the standard error decreases as 1/sqrt(n)
+        scaling = 1.0
+        if (max_n is not None) and (n > max_n):
+            xsorted = xsorted[np.round(np.linspace(0, n - 1, max_n)).astype(int_)]
+            scaling = np.sqrt(max_n / float(n))
+            n = max_n
 
         vv = np.arange(n) / float(n-1)
-        betacdf = beta.cdf
-
-        for (i,p) in enumerate(prob):
-            _w = betacdf(vv, (n+1)*p, (n+1)*(1-p))
-            w = _w[1:] - _w[:-1]
-            mx_ = np.fromiter([w[:k] @ xsorted[:k] + w[k:] @ xsorted[k+1:]
-                               for k in range(n)], dtype=float_)
-            mx_var = np.array(mx_.var(), copy=False, ndmin=1) * n / float(n-1)
-            hdsd[i] = float(n-1) * np.sqrt(np.diag(mx_var).diagonal() / float(n))
+        dx = np.diff(xsorted)
+
+        # quantiles are processed in chunks to bound the memory used by the weights
+        chunk_size = max(1, 2**24 // n)
+        for i in range(0, len(prob), chunk_size):
+            p = prob[i:i+chunk_size, np.newaxis]
+            _w = beta.cdf(vv, (n+1)*p, (n+1)*(1-p))
+            w = _w[:, 1:] - _w[:, :-1]
+            # leaving out element k replaces x_j by x_{j+1} for j >= k, so up to a constant that doesn't change the
+            # variance, the leave-one-out estimate is sum_{j>=k} w_j (x_{j+1} - x_j). The last element leaves the
+            # estimate unchanged
+            mx_ = np.zeros(shape=(len(p), n), dtype=float_)
+            mx_[:, :-1] = np.cumsum((w * dx)[:, ::-1], axis=1)[:, ::-1]
+            mx_var = mx_.var(axis=1) * n / float(n-1)
+            hdsd[i:i+chunk_size] = float(n-1) * np.sqrt(mx_var / float(n)) * scaling
         return hdsd
 
     # Initialization & checks
@@ -5,25 +5,33 @@ SPDX-License-Identifier: Apache-2.0
 Author: Ramon Casero <rcasero@gmail.com>
 """
 
+import os
+import hashlib
 import warnings
+import itertools
+import collections
+import multiprocessing
+import concurrent.futures
 import openslide
 import cv2
 import numpy as np
 import six
 import matplotlib.pyplot as plt
 from PIL import Image, ImageEnhance, TiffImagePlugin
-from scipy.stats import mode
+from scipy.stats import mode, beta
 from scipy.interpolate import RectBivariateSpline, splev
-from scipy.ndimage import median_filter
+from scipy.ndimage import median_filter, find_objects, maximum_filter, minimum_filter
 from scipy.ndimage.filters import gaussian_filter
 from scipy.ndimage.morphology import binary_fill_holes, generate_binary_structure
-from scipy.sparse import dok_matrix
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.optimize import linear_sum_assignment
 from scipy.interpolate import splprep
 from scipy.signal import fftconvolve
 from skimage import measure
 from skimage.morphology import watershed, remove_small_objects, remove_small_holes, binary_closing, \
     binary_erosion, thin
-from skimage.future.graph import rag_mean_color, show_rag, merge_hierarchical
+from skimage.future.graph import rag_mean_color, show_rag
 from skimage.measure import regionprops, find_contours
 from skimage.segmentation import clear_border
 from skimage.transform import EuclideanTransform, AffineTransform, warp, matrix_transform
@@ -38,10 +46,10 @@ import keras.backend as K
 import keras
 import tensorflow as tf
 from cytometer.models import change_input_size, load_model_with_retries
-from cytometer.CDF_confidence import CDF_error_DKW_band, CDF_error_beta
 from statsmodels.distributions.empirical_distribution import ECDF, monotone_fn_inverter
 from statsmodels.stats.multitest import multipletests
 import shapely
+import shapely.strtree
 
 DEBUG = False
 
@@ -133,10 +141,133 @@ def paint_labels(labels, paint_labs, paint_values):
     return lut[labels]
 
 
+def colour_histograms(im, mask=None):
+    """
+    Histogram of each colour channel of a uint8 image, computed with np.bincount().
+
+    :param im: (rows, cols, channels)-np.array with dtype=np.uint8.
+    :param mask: (def None) (rows, cols) boolean mask. If provided, only pixels within the mask are counted.
+    :return:
+    * hist: (channels, 256)-np.array with the number of pixels with each intensity value in each channel.
+    """
+
+    if im.dtype != np.uint8:
+        raise TypeError('im must have dtype=np.uint8')
+    hist = np.zeros(shape=(im.shape[2], 256), dtype=np.int64)
+    for c in range(im.shape[2]):
+        channel = im[:, :, c]
+        if mask is not None:
+            channel = channel[mask]
+        hist[c, :] = np.bincount(channel.ravel(), minlength=256)
+    return hist
+
+
+def histogram_mode_std(hist):
+    """
+    Mode and standard deviation of each colour channel from its histogram (see colour_histograms()). If there are
+    several modes, the smallest value is returned.
+
+    :param hist: (channels, 256)-np.array with the number of pixels with each intensity value in each channel.
+    :return:
+    * colour_mode: (channels,)-np.array with dtype=np.uint8.
+    * colour_std: (channels,)-np.array.
+    """
+
+    values = np.arange(hist.shape[1])
+    n = hist.sum(axis=1)
+    mean = np.dot(hist, values) / n
+    colour_std = np.sqrt(np.sum(hist * (values - mean[:, np.newaxis]) ** 2, axis=1) / n)
+    return np.argmax(hist, axis=1).astype(np.uint8), colour_std
+
+
+def colour_mode_std(im, mask=None):
+    """
+    Mode and standard deviation of each colour channel of an image.
+
+    For uint8 images, both are computed from the histogram of each channel, which is much faster than
+    scipy.stats.mode() and doesn't need a copy of the image. As with scipy.stats.mode(), if there are several modes, the
+    smallest value is returned.
+
+    :param im: (rows, cols, channels)-np.array.
+    :param mask: (def None) (rows, cols) boolean mask. If provided, only pixels within the mask are used.
+    :return:
+    * colour_mode: (channels,)-np.array with the same dtype as im.
+    * colour_std: (channels,)-np.array.
+    """
+
+    if im.dtype == np.uint8:
+        return histogram_mode_std(colour_histograms(im, mask=mask))
+
+    # other types: one column per colour channel
+    if mask is None:
+        mask = np.ones(shape=im.shape[0:2], dtype=bool)
+    im_mat = im[mask]
+    return mode(im_mat, axis=0).mode.reshape(-1).astype(im.dtype), np.std(im_mat, axis=0)
+
+
+def slide_statistics(filename, downsample_factor=16.0, cache_dir=None):
+    """
+    Downsampled image and colour statistics of a histology slide, cached on disk.
+
+    Several steps of the pipeline need the downsampled slide or its colour statistics (rough_foreground_mask(), the
+    tint correction in the *_full_slide_pipeline_v8.py scripts). Reading the downsampled level from the slide and
+    computing the statistics is done once, and saved to a cache file keyed by the slide's path, modification time and
+    pyramid level. If the slide file changes, the cache is ignored and overwritten.
+
+    :param filename: Path and filename of the slide, in a format understood by OpenSlide.
+    :param downsample_factor: (def 16.0) The level with the closest downsample factor in the multilevel pyramid is
+    used.
+    :param cache_dir: (def None) Directory for the cache files. If None, nothing is cached.
+    :return:
+    * stats: Dictionary with
+        'im_downsampled': (rows, cols, 3)-np.array (uint8) with the downsampled RGB image.
+        'level', 'downsample_factor': Level of the pyramid and its actual downsample factor.
+        'mode', 'std': (3,)-np.array with the mode and standard deviation of each colour channel.
+        'histogram': (3, 256)-np.array with the number of pixels with each intensity value in each channel.
+        'ecdf': (3, 256)-np.array with the empirical cumulative distribution function of each channel, i.e.
+        ecdf[c, v] = P(channel_c <= v). Quantiles can be computed e.g. as np.searchsorted(ecdf[c, :], p).
+    """
+
+    im = openslide.OpenSlide(filename)
+    level = int(np.argmin(np.abs(np.array(im.level_downsamples) - downsample_factor)))
+
+    # cache file, unique for each path, modification time and level
+    cache_file = None
+    if cache_dir is not None:
+        key = os.path.abspath(filename) + '|' + str(os.stat(filename).st_mtime_ns) + '|' + str(level)
+        cache_file = os.path.splitext(os.path.basename(filename))[0] + '_stats_' \
+                     + hashlib.sha1(key.encode('utf-8')).hexdigest()[0:16] + '.npz'
+        cache_file = os.path.join(cache_dir, cache_file)
+        if os.path.isfile(cache_file):
+            im.close()
+            with np.load(cache_file) as aux:
+                stats = {k: aux[k] for k in aux.files}
+            stats['level'] = stats['level'].item()
+            stats['downsample_factor'] = stats['downsample_factor'].item()
+            return stats
+
+    im_downsampled = im.read_region(location=(0, 0), level=level, size=im.level_dimensions[level])
+    im_downsampled = np.array(im_downsampled)[:, :, 0:3]
+    stats = {'im_downsampled': im_downsampled, 'level': level, 'downsample_factor': im.level_downsamples[level]}
+    im.close()
+
+    stats['histogram'] = colour_histograms(im_downsampled)
+    stats['mode'], stats['std'] = colour_mode_std(im_downsampled)
+    stats['ecdf'] = np.cumsum(stats['histogram'], axis=1) / stats['histogram'].sum(axis=1, keepdims=True)
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(cache_file + '.tmp.npz', **stats)
+        os.replace(cache_file + '.tmp.npz', cache_file)
+
+    return stats
+
+
 def rough_foreground_mask(filename, downsample_factor=8.0, dilation_size=25,
                           component_size_threshold=1e6, hole_size_treshold=8000, std_k=1.0,
                           return_im=False, enhance_contrast=None, clear_border=[0, 0, 0, 0],
-                          ignore_white_threshold=None, ignore_black_threshold=None, ignore_violet_border=None):
+                          ignore_white_threshold=None, ignore_black_threshold=None, ignore_violet_border=None,
+                          cache_dir=None):
     """
     Rough segmentation of large segmentation objects in a microscope image with a format that can be read
     by OpenSlice. The objects are darker than the background.
@@ -179,13 +310,22 @@ def rough_foreground_mask(filename, downsample_factor=8.0, dilation_size=25,
     will be included in the coarse mask. If ignore_violet_border=x, pixels with R channel < ignore_violet_border will be
     ignored for the segmentation. E.g. ignore_white_threshold=0 will ignore pixels with colour (0, ..., ...) after
     contrast enhancement.
+    :param cache_dir: (def None) If filename is a path, directory where the downsampled image is cached by
+    slide_statistics(), so that it's not read from the slide again in the next call.
     :return:
     seg: downsampled segmentation mask.
     [im_downsampled]: if return_im=True, this is the downsampled image in filename. This is the image without contrast
     enhancement or masking applied to it.
     """
 
-    if isinstance(filename, six.string_types):  # filename provided
+    if isinstance(filename, six.string_types) and cache_dir is not None:  # filename provided, with cache
+
+        stats = slide_statistics(filename, downsample_factor=downsample_factor, cache_dir=cache_dir)
+        if stats['downsample_factor'] != downsample_factor:
+            warnings.warn('File does not contain level with downsample factor ' + str(downsample_factor))
+        im_downsampled = stats['im_downsampled']
+
+    elif isinstance(filename, six.string_types):  # filename provided
 
         # load file
         im = openslide.OpenSlide(filename)
@@ -244,26 +384,17 @@ def rough_foreground_mask(filename, downsample_factor=8.0, dilation_size=25,
     # contrast enhancement
     nchan = im_downsampled.shape[2]
     if (enhance_contrast is not None) and (enhance_contrast != 1.0):
-        colour_mode = np.zeros((nchan,), dtype=im_downsampled.dtype)
+        colour_mode, _ = colour_mode_std(im_downsampled, mask=enhancer_mask)
         # replace black/white pixels with median-colour pixels
         for c in range(nchan):
             channel = im_downsampled[:, :, c]
-            colour_mode[c] = mode(channel[enhancer_mask]).mode
             channel[~enhancer_mask] = colour_mode[c]
         # enhance contrast
         enhancer = ImageEnhance.Contrast(Image.fromarray(im_downsampled))
         im_downsampled = np.array(enhancer.enhance(enhance_contrast))
 
-    # reshape image to matrix with one column per colour channel, only pixels within the enhancer_mask
-    im_downsampled_mat = []
-    for c in range(nchan):
-        channel = im_downsampled_bak[:, :, c]
-        im_downsampled_mat.append(channel[enhancer_mask])
-    im_downsampled_mat = np.vstack(im_downsampled_mat).T
-
-    # background colour mode and typical variability after contrast correction
-    background_colour = mode(im_downsampled_mat, axis=0).mode[0]
-    background_colour_std = np.std(im_downsampled_mat, axis=0)
+    # background colour mode and typical variability, only pixels within the enhancer_mask
+    background_colour, background_colour_std = colour_mode_std(im_downsampled_bak, mask=enhancer_mask)
 
     # mask out violet border
     if ignore_violet_border is not None:
@@ -325,6 +456,206 @@ def rough_foreground_mask(filename, downsample_factor=8.0, dilation_size=25,
         return seg
 
 
+def rough_foreground_mask_fast(filename, downsample_factor=8.0, dilation_size=25,
+                               component_size_threshold=1e6, hole_size_treshold=8000, std_k=1.0,
+                               return_im=False, enhance_contrast=None, clear_border=[0, 0, 0, 0],
+                               ignore_white_threshold=None, ignore_black_threshold=None, ignore_violet_border=None,
+                               strip_height=1024, morphology_downsample=1, return_colour_stats=False):
+    """
+    Faster, lower memory version of rough_foreground_mask() for large slides.
+
+    rough_foreground_mask() reads the whole downsampled level with one read_region() call (RGBA), and computes the
+    colour statistics and contrast enhancement on full-size copies of the image. This function:
+
+      * Reads the downsampled level in strips of strip_height rows. The whole RGB image is only kept in memory if
+        return_im=True. Otherwise, the strips are read again from the slide in each pass.
+      * Computes the background colour mode and standard deviation from per-channel uint8 histograms accumulated over
+        the strips (see colour_mode_std()).
+      * Does the contrast enhancement and thresholding strip by strip. The contrast enhancement uses the mean gray level
+        of the whole image, so the result is the same as PIL.ImageEnhance.Contrast() on the whole image.
+      * Optionally, does the morphological operations on a mask reduced by morphology_downsample, with the sizes and
+        area thresholds scaled accordingly. A reduced pixel is foreground if any of its pixels is foreground. The
+        thresholded strips are reduced as they are computed, so the only full-size mask is the output.
+
+    With morphology_downsample=1, the result is the same as rough_foreground_mask(). With morphology_downsample > 1, the
+    mask is an approximation with blocky edges, which is usually enough for a rough tissue mask.
+
+    The colour statistics of the whole downsampled image (e.g. the mode used for the tint correction in the
+    *_full_slide_pipeline_v8.py scripts) can be returned with return_colour_stats=True, so that the image doesn't need
+    to be kept in memory to compute them.
+
+    :param filename: Path and filename of the microscope image, in a format understood by OpenSlide.
+    :param downsample_factor: See rough_foreground_mask().
+    :param dilation_size: See rough_foreground_mask().
+    :param component_size_threshold: See rough_foreground_mask().
+    :param hole_size_treshold: See rough_foreground_mask().
+    :param std_k: See rough_foreground_mask().
+    :param return_im: See rough_foreground_mask().
+    :param enhance_contrast: See rough_foreground_mask().
+    :param clear_border: See rough_foreground_mask().
+    :param ignore_white_threshold: See rough_foreground_mask().
+    :param ignore_black_threshold: See rough_foreground_mask().
+    :param ignore_violet_border: See rough_foreground_mask().
+    :param strip_height: (def 1024) Number of rows of the downsampled level read at a time.
+    :param morphology_downsample: (def 1) Integer reduction factor of the mask for the morphological operations.
+    :param return_colour_stats: (def False) If True, also return the colour statistics of all the pixels of the
+    downsampled image.
+    :return:
+    seg: downsampled segmentation mask.
+    [im_downsampled]: if return_im=True, the downsampled image in filename.
+    [colour_stats]: if return_colour_stats=True, dictionary with 'mode', 'std' ((3,)-np.array with the mode and standard
+    deviation of each colour channel, as computed by colour_mode_std(im_downsampled)) and 'histogram'
+    ((3, 256)-np.array, see colour_histograms()).
+    """
+
+    im = openslide.OpenSlide(filename)
+
+    # level that corresponds to the downsample factor
+    downsample_level = np.argmin(np.abs(np.array(im.level_downsamples) - downsample_factor))
+    if im.level_downsamples[downsample_level] != downsample_factor:
+        warnings.warn('File does not contain level with downsample factor ' + str(downsample_factor)
+                      + '.\nAvailable levels: ' + str(im.level_downsamples))
+    downsample_factor = im.level_downsamples[downsample_level]
+    ncols, nrows = im.level_dimensions[downsample_level]
+
+    # strips are aligned with the blocks of the reduced mask
+    d = int(morphology_downsample)
+    strip_height = int(np.ceil(strip_height / d)) * d
+    strips = [(i, min(i + strip_height, nrows)) for i in range(0, nrows, strip_height)]
+
+    # the downsampled image is only kept if it's going to be returned. Otherwise, strips are read again from the slide
+    if return_im:
+        im_downsampled = np.zeros(shape=(nrows, ncols, 3), dtype=np.uint8)
+    else:
+        im_downsampled = None
+
+    def read_strip(first_row, last_row):
+        strip = im.read_region(location=(0, int(round(first_row * downsample_factor))), level=downsample_level,
+                               size=(ncols, last_row - first_row))
+        return np.array(strip)[:, :, 0:3]
+
+    def ignore_mask(strip):
+        # mask of the pixels that are not white or black
+        enhancer_mask = np.ones(shape=strip.shape[0:2], dtype=bool)
+        if ignore_white_threshold is not None:
+            enhancer_mask &= np.any(strip < ignore_white_threshold, axis=2)
+        if ignore_black_threshold is not None:
+            enhancer_mask &= np.any(strip > ignore_black_threshold, axis=2)
+        return enhancer_mask
+
+    # read the image in strips, and accumulate the histograms of the pixels within the enhancer mask (and of all the
+    # pixels, for the colour statistics of the image)
+    hist = np.zeros(shape=(3, 256), dtype=np.int64)
+    hist_all = np.zeros(shape=(3, 256), dtype=np.int64)
+    for first_row, last_row in strips:
+        strip = read_strip(first_row, last_row)
+        if return_im:
+            im_downsampled[first_row:last_row, :, :] = strip
+        hist += colour_histograms(strip, mask=ignore_mask(strip))
+        if return_colour_stats:
+            hist_all += colour_histograms(strip)
+
+    # background colour mode and typical variability
+    values = np.arange(256)
+    background_colour, background_colour_std = histogram_mode_std(hist)
+
+    def get_strip(first_row, last_row):
+        if return_im:
+            return im_downsampled[first_row:last_row, :, :].copy()
+        else:
+            return read_strip(first_row, last_row)
+
+    def masked_strip(first_row, last_row):
+        # strip with black/white pixels replaced by the colour mode
+        strip = get_strip(first_row, last_row)
+        strip[~ignore_mask(strip), :] = background_colour
+        return strip
+
+    # mean gray level of the whole image, as computed by PIL.ImageEnhance.Contrast()
+    is_enhanced = (enhance_contrast is not None) and (enhance_contrast != 1.0)
+    if is_enhanced:
+        gray_hist = np.zeros(shape=(256,), dtype=np.int64)
+        for first_row, last_row in strips:
+            gray_hist += Image.fromarray(masked_strip(first_row, last_row)).convert('L').histogram()
+        gray_mean = int(np.dot(gray_hist, values) / gray_hist.sum() + 0.5)
+
+    # threshold segmentation, strip by strip, directly into the (optionally reduced) mask for the morphological
+    # operations
+    nrows_reduced = int(np.ceil(nrows / d))
+    ncols_reduced = int(np.ceil(ncols / d))
+    seg = np.zeros(shape=(nrows_reduced, ncols_reduced), dtype=np.uint8)
+    for first_row, last_row in strips:
+        if is_enhanced:
+            strip = Image.fromarray(masked_strip(first_row, last_row))
+            degenerate = Image.new('L', strip.size, gray_mean).convert(strip.mode)
+            strip = np.array(Image.blend(degenerate, strip, enhance_contrast))
+        else:
+            strip = get_strip(first_row, last_row)
+
+        # mask out violet border
+        if ignore_violet_border is not None:
+            strip[strip[:, :, 0] <= ignore_violet_border, :] = background_colour
+
+        seg_strip = np.ones(shape=strip.shape[0:2], dtype=bool)
+        for c in range(3):
+            seg_strip &= strip[:, :, c] < background_colour[c] - std_k * background_colour_std[c]
+
+        # a reduced pixel is foreground if any of its pixels is foreground
+        if d > 1:
+            seg_strip_reduced = np.zeros(shape=(int(np.ceil(seg_strip.shape[0] / d)) * d, ncols_reduced * d),
+                                         dtype=bool)
+            seg_strip_reduced[0:seg_strip.shape[0], 0:ncols] = seg_strip
+            seg_strip = seg_strip_reduced.reshape(seg_strip_reduced.shape[0] // d, d, ncols_reduced, d).any(axis=(1, 3))
+        seg[first_row // d:first_row // d + seg_strip.shape[0], :] = seg_strip
+    im.close()
+    seg[seg == 1] = 255
+
+    # sizes and area thresholds in the reduced mask
+    if d > 1:
+        dilation_size = int(np.round(dilation_size / d))
+        hole_size_treshold = hole_size_treshold / d ** 2
+        component_size_threshold = component_size_threshold / d ** 2
+
+    # closing to fill gaps within tissue
+    if dilation_size != 0:
+        kernel = np.ones((dilation_size, dilation_size), np.uint8)
+        seg = cv2.dilate(seg, kernel, iterations=1)
+        seg = cv2.erode(seg, kernel, iterations=1)
+
+    # fill small holes
+    if hole_size_treshold != 0:
+        seg = remove_small_holes(seg > 0, area_threshold=hole_size_treshold).astype(seg.dtype)
+
+    # remove segmentation noise
+    seg = remove_small_objects(seg > 0, min_size=component_size_threshold).astype(seg.dtype)
+
+    # back to the size of the downsampled image
+    if d > 1:
+        seg = np.repeat(np.repeat(seg, d, axis=0)[0:nrows, :], d, axis=1)[:, 0:ncols]
+
+    # remove borders
+    if any(np.array(clear_border) < 0):
+        raise ValueError('clear_border has negative values')
+    [left, right, top, bottom] = clear_border
+    seg[:, 0:left] = 0
+    if right > 0:
+        seg[:, -right:] = 0
+    seg[0:top, :] = 0
+    if bottom > 0:
+        seg[-bottom:, :] = 0
+
+    out = (seg,)
+    if return_im:
+        out += (im_downsampled,)
+    if return_colour_stats:
+        colour_mode, colour_std = histogram_mode_std(hist_all)
+        out += ({'mode': colour_mode, 'std': colour_std, 'histogram': hist_all},)
+    if len(out) == 1:
+        return seg
+    else:
+        return out
+
+
 def get_next_roi_to_process_old(seg, downsample_factor=1.0, max_window_size=[1001, 1001], border=[65, 65]):
     """
     Note: This function is deprecated by get_next_roi_to_process(), but we keep its functionality here because it was
@@ -585,6 +916,116 @@ def get_next_roi_to_process(seg, im=None, max_window_size=[1001, 1001], border=[
     return location_all, size_all
 
 
+def get_all_rois_to_process(seg, downsample_factor=1.0, max_window_size=[2751, 2751], border=[65, 65],
+                            image_size=None):
+    """
+    Compute all the rectangular regions of interest (ROIs) or windows needed to process the tissue in a mask, in one
+    pass.
+
+    This is an alternative to calling get_next_roi_to_process() repeatedly, which needs to convolve the whole mask twice
+    to find each window. Here, the bounding box of the mask is split into a regular grid of "core" regions of size
+    max_window_size - 2 * border. Core regions with no mask pixels are discarded. The processing window of each core
+    region starts border pixels before it, and has size max_window_size, cropped only where it overflows the image.
+    Thus, all windows have the same size except those on the edges of the image, so that the neural networks can be
+    applied to batches of tiles, and models of the same input size can be reused (see cytometer.models.ModelCache).
+
+    Core regions don't overlap, but windows do, by 2 * border. Thus, border should be large enough to account for the
+    effective receptive field of the neural network plus the size of the largest object, so that objects crossing the
+    edge of a core region are fully contained in the window. To avoid processing the same object twice, each object
+    should be assigned to the tile whose core region contains the object's centroid.
+
+    Because the tiles are computed in advance, they can be scheduled in any order, processed in parallel, or skipped
+    if they were already processed by a previous run.
+
+    All coordinates follow the same convention as get_next_roi_to_process(), i.e. the window is
+    im[first_row:last_row, first_col:last_col].
+
+    :param seg: np.ndarray with downsampled segmentation mask, e.g. computed by rough_foreground_mask().
+    :param downsample_factor: (def 1.0) Scalar factor. seg is assumed to have been downsampled by this factor.
+    :param max_window_size: (def [2751, 2751]) Vector with (row, column) size of high resolution output window,
+    including the border. If the window were to overflow the image, it gets cropped to the image size.
+    :param border: (def [65, 65]) Vector with how many (rows, columns) of the high resolution output window are a
+    border around the core region.
+    :param image_size: (def None) (rows, cols) size of the high resolution image. By default, it's estimated as
+    seg.shape * downsample_factor.
+    :return:
+    * tiles: pandas.DataFrame with one row per tile, sorted by rows and then columns. Columns:
+      * 'first_row', 'last_row', 'first_col', 'last_col': Window in the high resolution image.
+      * 'core_first_row', 'core_last_row', 'core_first_col', 'core_last_col': Core region in the high resolution image.
+      * 'lores_first_row', 'lores_last_row', 'lores_first_col', 'lores_last_col': Window in seg.
+    """
+
+    columns = ['first_row', 'last_row', 'first_col', 'last_col',
+               'core_first_row', 'core_last_row', 'core_first_col', 'core_last_col',
+               'lores_first_row', 'lores_last_row', 'lores_first_col', 'lores_last_col']
+
+    # convert to np.array so that we can use algebraic operators
+    max_window_size = np.round(np.array(max_window_size)).astype(int)
+    border = np.round(np.array(border)).astype(int)
+    core_size = max_window_size - 2 * border
+    if np.any(core_size <= 0):
+        raise ValueError('max_window_size must be larger than 2 * border')
+
+    seg = seg != 0
+    if image_size is None:
+        image_size = np.round(np.array(seg.shape) * downsample_factor).astype(int)
+    else:
+        image_size = np.array(image_size[0:2]).astype(int)
+
+    if np.count_nonzero(seg) == 0:
+        warnings.warn('Empty segmentation')
+        return pd.DataFrame(np.zeros(shape=(0, len(columns)), dtype=int), columns=columns)
+
+    # bounding box of the mask in the high resolution image
+    lores_rows = np.nonzero(np.any(seg, axis=1))[0]
+    lores_cols = np.nonzero(np.any(seg, axis=0))[0]
+    bbox_first = np.floor(np.array((lores_rows[0], lores_cols[0])) * downsample_factor).astype(int)
+    bbox_last = np.minimum(image_size,
+                           np.ceil(np.array((lores_rows[-1] + 1, lores_cols[-1] + 1)) * downsample_factor).astype(int))
+
+    # edges of the grid of core regions in the high resolution image, and corresponding edges in the low resolution
+    # mask. The low resolution cells are a partition of the mask bounding box
+    edges = []
+    lores_edges = []
+    for d, lores_idx in enumerate((lores_rows, lores_cols)):
+        e = np.arange(bbox_first[d], bbox_last[d], core_size[d])
+        e = np.append(e, bbox_last[d])
+        edges.append(e)
+        lores_e = np.floor(e / downsample_factor).astype(int)
+        lores_e[0] = lores_idx[0]
+        lores_e[-1] = lores_idx[-1] + 1
+        lores_edges.append(lores_e)
+
+    # number of mask pixels in each cell of the grid, using the integral image of the mask
+    seg_integral = np.zeros(shape=(seg.shape[0] + 1, seg.shape[1] + 1), dtype=np.int64)
+    seg_integral[1:, 1:] = np.cumsum(np.cumsum(seg, axis=0), axis=1)
+    r, c = lores_edges
+    count = seg_integral[np.ix_(r[1:], c[1:])] - seg_integral[np.ix_(r[:-1], c[1:])] \
+            - seg_integral[np.ix_(r[1:], c[:-1])] + seg_integral[np.ix_(r[:-1], c[:-1])]
+
+    tiles = []
+    for i, j in zip(*np.nonzero(count)):
+
+        # core region
+        core_first = np.array((edges[0][i], edges[1][j]))
+        core_last = np.array((edges[0][i + 1], edges[1][j + 1]))
+
+        # fixed-size window with a border around the core region (the last core regions of the grid can be smaller
+        # than core_size, but their window keeps the same size), cropped to the image
+        first = np.maximum(0, core_first - border)
+        last = np.minimum(image_size, core_first - border + max_window_size)
+
+        # window in the low resolution mask
+        lores_first = np.floor(first / downsample_factor).astype(int)
+        lores_last = np.minimum(seg.shape, np.ceil(last / downsample_factor).astype(int))
+
+        tiles.append([first[0], last[0], first[1], last[1],
+                      core_first[0], core_last[0], core_first[1], core_last[1],
+                      lores_first[0], lores_last[0], lores_first[1], lores_last[1]])
+
+    return pd.DataFrame(np.array(tiles, dtype=int).reshape(-1, len(columns)), columns=columns)
+
+
 def principal_curvatures_range_image(img, sigma=10):
     """
     Compute Gaussian, Mean and principal curvatures of an image with depth values. Examples of such images
@@ -750,20 +1191,6 @@ def segment_dmap_contour(dmap, contour=None,
     :return: labels, labels_borders
     """
 
-    # auxiliary functions for merge_hierarchical() taken from
-    # https://scikit-image.org/docs/dev/auto_examples/segmentation/plot_rag_merge.html#sphx-glr-auto-examples-segmentation-plot-rag-merge-py
-    #
-    # For the purpose of this function, the details of what they do are not very important
-    def _weight_mean_color(graph, src, dst, n):
-        diff = graph.node[dst]['mean color'] - graph.node[n]['mean color']
-        diff = np.linalg.norm(diff)
-        return {'weight': diff}
-
-    def merge_mean_color(graph, src, dst):
-        graph.node[dst]['total color'] += graph.node[src]['total color']
-        graph.node[dst]['pixel count'] += graph.node[src]['pixel count']
-        graph.node[dst]['mean color'] = (graph.node[dst]['total color'] / graph.node[dst]['pixel count'])
-
     # check size of inputs
     if dmap.ndim != 2:
         raise ValueError('dmap array must have 2 dimensions')
@@ -859,45 +1286,16 @@ def segment_dmap_contour(dmap, contour=None,
         # For every pair of adjacent labels, we want to find out whether both belong to different cells (i.e.
         # they have a membrane between them), or they belong to the same cell and should be merged.
         #
-        # To do this efficiently, we are going to use a Region Adjacency Graph (RAG) that will create a graph
-        # where each node corresponds to one label, and edges indicate that two labels are adjacent.
-        #
-        # The edge weight = norm([la, la, la] - [lb, lb, lb]), where la, lb are the two labels. This is how it's
-        # implemented in rag_mean_color(). We don't care about the value of the weight as long as it's > 0.
-        #
-        # Then, we are going to check pairs of adjacent labels. If they should be merge, we make the edge weight = 0.
         # The criterion to decide whether labels should be merged is to check whether on the kissing points between
-        # both labels we have a membrane or not.
+        # both labels we have a membrane or not. The kissing points of labels a and b are the pixels that have both a
+        # and b in their 3x3 neighbourhood (i.e. the intersection of both labels dilated with a 3x3 kernel).
         #
-        # Once all edges have been examined, the graph can be simplified in one go with merge_hierarchical().
+        # To do this efficiently, we find the kissing points and contour values of all pairs of labels in one pass,
+        # and then merge all pairs of labels without a membrane with a union-find relabelling.
 
         if len(np.unique(labels)) > 1:
 
-            # compute the Region Adjacency Graph using mean colours (the weights from the mean colours will be ignored)
-            rag = rag_mean_color(labels, labels, mode='distance')
-
-            # iterate pairs of adjacent labels (note that if rag.edges has (1,2), it doesn't also have (2,1))
-            for lab_a, lab_b in rag.edges:
-
-                # dilate each label so that they overlap wherever they are adjacent
-                labels_a = (labels == lab_a).astype(np.uint8)
-                labels_b = (labels == lab_b).astype(np.uint8)
-                labels_a = cv2.dilate(labels_a, kernel=np.ones(shape=(3, 3), dtype=np.uint8))
-                labels_b = cv2.dilate(labels_b, kernel=np.ones(shape=(3, 3), dtype=np.uint8))
-
-                # boundary pixels that are common to both labels (kissing points)
-                common = np.logical_and(labels_a, labels_b)
-
-                # if the 90-percentile of the contour values along the kissing points is small, that means that the
-                # separation between the two labels is spurious, because there's probably no membrane between them
-                if np.percentile(contour[common], 90) <= boundary_threshold:
-                    if DEBUG:
-                        print('Merging ' + str((lab_a, lab_b)))
-                    nx.set_edge_attributes(rag, {(lab_a, lab_b): {'weight': 0}})
-
-            # update the labels by greedy merging
-            labels = merge_hierarchical(labels, rag, thresh=0.1, rag_copy=False, in_place_merge=True,
-                                        merge_func=merge_mean_color, weight_func=_weight_mean_color)
+            labels = _merge_labels_without_membrane(labels, contour, boundary_threshold=boundary_threshold)
 
         if DEBUG:
             plt.subplot(224)
@@ -918,6 +1316,100 @@ def segment_dmap_contour(dmap, contour=None,
     return labels, labels_borders
 
 
+def _merge_labels_without_membrane(labels, contour, boundary_threshold=0.1):
+    """
+    Merge adjacent labels that have no membrane between them. Auxiliary function for segment_dmap_contour().
+
+    Two labels are adjacent if they have 8-connected neighbour pixels. The kissing points between labels a and b are
+    the pixels with both a and b in their 3x3 neighbourhood. If the 90-percentile of the contour values along the
+    kissing points <= boundary_threshold, both labels are merged.
+
+    :param labels: (row, col) np.ndarray with segmentation labels.
+    :param contour: (row, col) np.ndarray with contour values.
+    :param boundary_threshold: (def 0.1) Threshold for the 90-percentile of contour values along the kissing points.
+    :return: labels: (row, col) np.ndarray where each group of merged labels has been replaced by its smallest label.
+    """
+
+    nrows, ncols = labels.shape
+    n_labels = np.max(labels) + 1
+
+    # pairs of 8-adjacent labels, found by comparing each pixel with its neighbour to the right, bottom, bottom-right
+    # and bottom-left
+    adjacent_a = []
+    adjacent_b = []
+    for x, y in ((labels[:, :-1], labels[:, 1:]), (labels[:-1, :], labels[1:, :]),
+                 (labels[:-1, :-1], labels[1:, 1:]), (labels[:-1, 1:], labels[1:, :-1])):
+        idx = x != y
+        adjacent_a.append(np.minimum(x[idx], y[idx]))
+        adjacent_b.append(np.maximum(x[idx], y[idx]))
+    adjacent = np.unique(np.concatenate(adjacent_a).astype(np.int64) * n_labels + np.concatenate(adjacent_b))
+    if len(adjacent) == 0:
+        return labels
+
+    # boundary pixels, i.e. pixels with more than one label in their 3x3 neighbourhood
+    is_boundary = maximum_filter(labels, size=3, mode='nearest') != minimum_filter(labels, size=3, mode='nearest')
+    r, c = np.nonzero(is_boundary)
+    contour_boundary = contour[r, c]
+
+    # 3x3 neighbourhood of each boundary pixel, with -1 for neighbours outside the image
+    labels_pad = np.pad(labels.astype(np.int64), 1, mode='constant', constant_values=-1)
+    neighbours = np.stack([labels_pad[r + dr, c + dc] for dr in range(3) for dc in range(3)], axis=1)
+
+    # remove repeated labels in each neighbourhood, so that each pair of labels is counted once per pixel
+    neighbours = np.sort(neighbours, axis=1)
+    neighbours[:, 1:][neighbours[:, 1:] == neighbours[:, :-1]] = -1
+
+    # kissing points of all pairs of labels: (pair, contour value)
+    pairs = []
+    values = []
+    for k in range(8):
+        for l in range(k + 1, 9):
+            idx = (neighbours[:, k] != -1) & (neighbours[:, l] != -1)
+            a = neighbours[idx, k]
+            b = neighbours[idx, l]
+            pairs.append(np.minimum(a, b) * n_labels + np.maximum(a, b))
+            values.append(contour_boundary[idx])
+    pairs = np.concatenate(pairs)
+    values = np.concatenate(values)
+
+    # only pairs of adjacent labels are considered for merging
+    idx = np.isin(pairs, adjacent)
+    pairs = pairs[idx]
+    values = values[idx]
+
+    # 90-percentile of the contour values for each pair (linear interpolation, as np.percentile)
+    idx = np.lexsort((values, pairs))
+    pairs = pairs[idx]
+    values = values[idx]
+    pairs_unique, pairs_first, pairs_count = np.unique(pairs, return_index=True, return_counts=True)
+    pos = 0.9 * (pairs_count - 1)
+    pos_lo = np.floor(pos).astype(np.int64)
+    pos_hi = np.minimum(pos_lo + 1, pairs_count - 1)
+    values_lo = values[pairs_first + pos_lo]
+    values_hi = values[pairs_first + pos_hi]
+    percentile_90 = values_lo + (pos - pos_lo) * (values_hi - values_lo)
+
+    # if the 90-percentile of the contour values along the kissing points is small, that means that the separation
+    # between the two labels is spurious, because there's probably no membrane between them
+    to_merge = pairs_unique[percentile_90 <= boundary_threshold]
+    if len(to_merge) == 0:
+        return labels
+    merge_a, merge_b = np.divmod(to_merge, n_labels)
+    if DEBUG:
+        for lab_a, lab_b in zip(merge_a, merge_b):
+            print('Merging ' + str((lab_a, lab_b)))
+
+    # union-find: groups of merged labels are the connected components of the graph of pairs to merge. Each group is
+    # relabelled with its smallest label
+    graph = coo_matrix((np.ones(shape=merge_a.shape), (merge_a, merge_b)), shape=(n_labels, n_labels))
+    _, group = connected_components(graph, directed=False)
+    group_min = np.full(shape=(np.max(group) + 1,), fill_value=n_labels, dtype=np.int64)
+    np.minimum.at(group_min, group, np.arange(n_labels))
+    lut = group_min[group].astype(labels.dtype)
+
+    return lut[labels]
+
+
 def segment_dmap_contour_v3(im, contour_model, dmap_model, classifier_model=None,
                             local_threshold_block_size=41, border_dilation=0):
     """
@@ -1125,7 +1617,43 @@ def segment_dmap_contour_v3(im, contour_model, dmap_model, classifier_model=None
     return labels_all, labels_borders_all
 
 
-def segment_dmap_contour_v6(im, dmap_model, contour_model, classifier_model=None, border_dilation=0, batch_size=None):
+def shape_bucket(shape, shape_buckets):
+    """
+    Find the smallest canonical shape (bucket) that an image fits into.
+
+    Fully convolutional networks can process images of any size, but each different input size requires rebuilding the
+    model (see cytometer.models.change_input_size()). Padding images up to a small set of canonical shapes means that
+    only one model per bucket needs to be built.
+
+    :param shape: (rows, cols, ...) shape of the image. Only the first two values are used.
+    :param shape_buckets: Canonical shapes. Accepted types are
+      * scalar or (step_r, step_c): rows and cols are rounded up to the next multiple of step_r, step_c.
+      * list of (rows, cols): the bucket with the smallest area that the image fits into is chosen. If the image
+        doesn't fit into any bucket, the image shape is returned unchanged.
+    :return:
+    * (rows, cols) tuple with the bucket shape.
+    """
+
+    rows, cols = int(shape[0]), int(shape[1])
+
+    if np.isscalar(shape_buckets):
+        shape_buckets = (shape_buckets, shape_buckets)
+
+    if len(shape_buckets) == 2 and np.isscalar(shape_buckets[0]):
+        # round up to the next multiple of the step
+        step_r, step_c = int(shape_buckets[0]), int(shape_buckets[1])
+        return (int(np.ceil(rows / step_r) * step_r), int(np.ceil(cols / step_c) * step_c))
+
+    # buckets that are large enough for the image
+    buckets = [(int(b[0]), int(b[1])) for b in shape_buckets if b[0] >= rows and b[1] >= cols]
+    if len(buckets) == 0:
+        return (rows, cols)
+    else:
+        return min(buckets, key=lambda b: b[0] * b[1])
+
+
+def segment_dmap_contour_v6(im, dmap_model, contour_model, classifier_model=None, border_dilation=0, batch_size=None,
+                            model_cache=None, shape_buckets=None, executor=None):
     """
     Segment cells in histology using the architecture pipeline v6:
       * distance transformation is estimated from histology using CNN.
@@ -1143,6 +1671,17 @@ def segment_dmap_contour_v6(im, dmap_model, contour_model, classifier_model=None
     :param batch_size: (def None) Scalar batch_size passed to keras correction model. Maximum number of images processed
     at the same time by the GPUs. A larger number produces faster processing, but it also requires larger GPU memory. If
     batch_size is None, then batch_size is the number of images for the correction model.
+    :param model_cache: (def None) cytometer.models.ModelCache. If provided, models given as filenames are obtained
+    from the cache, with their input layers already adapted to the size of im, instead of being loaded from file.
+    :param shape_buckets: (def None) Canonical shapes for the networks' inputs (see shape_bucket()). If provided, im is
+    zero-padded on the bottom and right to its bucket shape before the networks are applied, and the networks' outputs
+    are cropped back to the size of im. Combined with model_cache, this means that only one model per bucket is built,
+    instead of one per tile size. Note that the networks' outputs within half a receptive field of the bottom and right
+    edges can be slightly different from the unpadded case, but labels touching the edges are usually discarded anyway
+    (see clean_segmentation()).
+    :param executor: (def None) concurrent.futures.Executor to compute the labels of each image in parallel, e.g.
+    concurrent.futures.ThreadPoolExecutor (most of the per-image operations release the GIL) or ProcessPoolExecutor. By
+    default, images are processed serially. The output is the same either way.
     :return:
       If classifier_model=None:
       * labels: np.array (rows, cols) Labels, one label per cell.
@@ -1154,6 +1693,138 @@ def segment_dmap_contour_v6(im, dmap_model, contour_model, classifier_model=None
       * labels_borders: np.array (n, rows, cols) Label edges.
     """
 
+    im, contour_pred, class_pred = \
+        _segment_dmap_contour_v6_networks(im, dmap_model=dmap_model, contour_model=contour_model,
+                                          classifier_model=classifier_model, batch_size=batch_size,
+                                          model_cache=model_cache, shape_buckets=shape_buckets)
+
+    # allocate memory for outputs
+    labels_all = np.zeros(shape=im.shape[0:3], dtype=np.int32)
+    labels_borders_all = np.zeros(shape=im.shape[0:3], dtype=np.bool)
+
+    # loop images
+    if executor is None:
+        for i in range(im.shape[0]):
+            labels_all[i, :, :], labels_borders_all[i, :, :] = \
+                _segment_dmap_contour_v6_labels(contour_pred[i, :, :, 0], border_dilation=border_dilation,
+                                                im=im[i, ...])
+    else:
+        # map() returns the results in the same order as the images
+        results = executor.map(_segment_dmap_contour_v6_labels, [contour_pred[i, :, :, 0] for i in range(im.shape[0])],
+                               [border_dilation] * im.shape[0])
+        for i, (labels, labels_borders) in enumerate(results):
+            labels_all[i, :, :], labels_borders_all[i, :, :] = labels, labels_borders
+
+    if classifier_model is not None:
+        return labels_all, class_pred, labels_borders_all
+    else:
+        return labels_all, labels_borders_all
+
+
+def segment_dmap_contour_v6_batch(tiles, dmap_model, contour_model, classifier_model=None, border_dilation=0,
+                                  batch_size=None, model_cache=None, shape_buckets=None, executor=None):
+    """
+    Segment a list of histology tiles using the architecture pipeline v6 (see segment_dmap_contour_v6()), stacking the
+    tiles into batches for the networks.
+
+    Tiles with the same input shape for the networks (their own shape, or their bucket shape if shape_buckets is
+    provided) are stacked into one (n, rows, cols, 3) array, zero-padding them on the bottom and right to the bucket
+    shape if needed, and run through each network once. Tiles with different shapes go through the networks in
+    separate batches. get_all_rois_to_process() computes windows of size max_window_size, except where they are cropped
+    by the edges of the image, so without shape_buckets, most of the tiles of a slide can be stacked together. The seed
+    labelling and watershed of each tile, which run on CPU, can be computed in parallel by an executor owned by the
+    caller, so that the same pool is reused across calls (see cytometer.pipeline.segment_slide()).
+
+    :param tiles: List of histology tiles, np.array (rows_i, cols_i, 3), dtype=np.uint8 with values in [0, 255] or
+    dtype=np.float32 with values in [0.0, 1.0].
+    :param dmap_model: Keras CNN model, or file path to it. See segment_dmap_contour_v6().
+    :param contour_model: Keras CNN model, or file path to it.
+    :param classifier_model: (def None) Keras CNN model, or file path to it.
+    :param border_dilation: (def 0) Number of iterations of the border dilation algorithm.
+    :param batch_size: (def None) Scalar batch_size passed to keras models.
+    :param model_cache: (def None) cytometer.models.ModelCache. See segment_dmap_contour_v6().
+    :param shape_buckets: (def None) Canonical shapes for the networks' inputs (see shape_bucket()).
+    :param executor: (def None) concurrent.futures.Executor to compute the labels of each tile in parallel, e.g.
+    concurrent.futures.ProcessPoolExecutor. If it's a process pool, use the 'spawn' start method, because forking a
+    process after TensorFlow has been initialised is not safe. By default, tiles are processed serially. The output is
+    the same either way.
+    :return:
+      If classifier_model=None:
+      * labels: List of np.array (rows_i, cols_i) Labels, one label per cell.
+      * labels_borders: List of np.array (rows_i, cols_i) Label edges.
+
+      If classifier_model provided:
+      * labels: List of np.array (rows_i, cols_i) Labels, one label per cell.
+      * class: List of np.array (rows_i, cols_i) Pixel-wise tissue classification (0: Other, 1: white adipocyte tissue).
+      * labels_borders: List of np.array (rows_i, cols_i) Label edges.
+    """
+
+    labels_list = [None] * len(tiles)
+    class_list = [None] * len(tiles)
+    labels_borders_list = [None] * len(tiles)
+
+    # group tiles by the input shape of the networks
+    groups = collections.OrderedDict()
+    for j, tile in enumerate(tiles):
+        if tile.ndim != 3 or tile.shape[2] != 3:
+            raise ValueError('Each tile must be a (row, col, 3) array')
+        if shape_buckets is None:
+            shape = tuple(tile.shape[0:2])
+        else:
+            shape = shape_bucket(tile.shape[0:2], shape_buckets)
+        groups.setdefault(shape, []).append(j)
+
+    futures = []
+    for shape, idx in groups.items():
+
+        # stack tiles, converted to float32 [0.0, 1.0] and zero-padded
+        im = np.zeros(shape=(len(idx),) + shape + (3,), dtype=np.float32)
+        for k, j in enumerate(idx):
+            tile = tiles[j]
+            if tile.dtype == np.uint8:
+                tile = tile.astype(np.float32) / 255
+            im[k, 0:tile.shape[0], 0:tile.shape[1], :] = tile
+
+        # run networks on the whole batch
+        _, contour_pred, class_pred = \
+            _segment_dmap_contour_v6_networks(im, dmap_model=dmap_model, contour_model=contour_model,
+                                              classifier_model=classifier_model, batch_size=batch_size,
+                                              model_cache=model_cache)
+
+        # crop outputs back to the size of each tile, and compute labels
+        for k, j in enumerate(idx):
+            nrows, ncols = tiles[j].shape[0:2]
+            contour = np.ascontiguousarray(contour_pred[k, 0:nrows, 0:ncols, 0])
+            if class_pred is not None:
+                class_list[j] = class_pred[k, 0:nrows, 0:ncols, 0]
+            if executor is None:
+                labels_list[j], labels_borders_list[j] = \
+                    _segment_dmap_contour_v6_labels(contour, border_dilation=border_dilation)
+            else:
+                futures.append((j, executor.submit(_segment_dmap_contour_v6_labels, contour,
+                                                   border_dilation=border_dilation)))
+
+    for j, future in futures:
+        labels_list[j], labels_borders_list[j] = future.result()
+
+    if classifier_model is not None:
+        return labels_list, class_list, labels_borders_list
+    else:
+        return labels_list, labels_borders_list
+
+
+def _segment_dmap_contour_v6_networks(im, dmap_model, contour_model, classifier_model=None, batch_size=None,
+                                      model_cache=None, shape_buckets=None):
+    """
+    Auxiliary function for segment_dmap_contour_v6(). Apply the dmap, contour and classifier networks to the histology.
+    See segment_dmap_contour_v6() for the parameters.
+
+    :return:
+      * im: np.array (n, rows, cols, 3), dtype=np.float32, values in [0.0, 1.0].
+      * contour_pred: np.array (n, rows, cols, 1) Output of the contour model.
+      * class_pred: np.array (n, rows, cols, 1) Pixel-wise tissue classification, or None if there's no classifier model.
+    """
+
     # convert usual im types to float32 [0.0, 1.0]
     if type(im) == TiffImagePlugin.TiffImageFile or im.dtype == np.uint8:
         im = np.array(im, dtype=np.float32)
@@ -1171,7 +1842,22 @@ def segment_dmap_contour_v6(im, dmap_model, contour_model, classifier_model=None
     else:
         raise ValueError('Input im_array must be (n, row, col, 3) or (row, col, 3)')
 
+    # pad image up to its bucket shape for the networks
+    nrows, ncols = im.shape[1:3]
+    im_pad = im
+    if shape_buckets is not None:
+        bucket_rows, bucket_cols = shape_bucket(im.shape[1:3], shape_buckets)
+        if (bucket_rows, bucket_cols) != (nrows, ncols):
+            im_pad = np.pad(im, ((0, 0), (0, bucket_rows - nrows), (0, bucket_cols - ncols), (0, 0)), mode='constant')
+
     # load models if they are provided as filenames
+    if model_cache is not None:
+        if isinstance(dmap_model, six.string_types):
+            dmap_model = model_cache.get(dmap_model, input_shape=im_pad.shape)
+        if isinstance(contour_model, six.string_types):
+            contour_model = model_cache.get(contour_model, input_shape=dmap_model.output_shape)
+        if isinstance(classifier_model, six.string_types):
+            classifier_model = model_cache.get(classifier_model, input_shape=im_pad.shape)
     if isinstance(dmap_model, six.string_types):
         dmap_model = load_model_with_retries(dmap_model, number_of_attempts=5)
     if isinstance(contour_model, six.string_types):
@@ -1180,15 +1866,15 @@ def segment_dmap_contour_v6(im, dmap_model, contour_model, classifier_model=None
         classifier_model = load_model_with_retries(classifier_model, number_of_attempts=5)
 
     # set models' input layers to the appropriate sizes if necessary
-    if dmap_model.input_shape[1:3] != im.shape[1:3]:
-        dmap_model = change_input_size(dmap_model, batch_shape=im.shape)
+    if dmap_model.input_shape[1:3] != im_pad.shape[1:3]:
+        dmap_model = change_input_size(dmap_model, batch_shape=im_pad.shape)
     if contour_model.input_shape[1:3] != dmap_model.output_shape[1:3]:
         contour_model = change_input_size(contour_model, batch_shape=dmap_model.output_shape)
-    if classifier_model is not None and classifier_model.input_shape[1:3] != im.shape[1:3]:
-        classifier_model = change_input_size(classifier_model, batch_shape=im.shape)
+    if classifier_model is not None and classifier_model.input_shape[1:3] != im_pad.shape[1:3]:
+        classifier_model = change_input_size(classifier_model, batch_shape=im_pad.shape)
 
     # run histology image through distance transformation model
-    dmap_pred = dmap_model.predict(im, batch_size=batch_size)
+    dmap_pred = dmap_model.predict(im_pad, batch_size=batch_size)
 
     if DEBUG:
         i = 0
@@ -1204,7 +1890,7 @@ def segment_dmap_contour_v6(im, dmap_model, contour_model, classifier_model=None
 
     if classifier_model is not None:
         # compute tissue classification of histology
-        class_pred = classifier_model.predict(im, batch_size=batch_size)
+        class_pred = classifier_model.predict(im_pad, batch_size=batch_size)[:, 0:nrows, 0:ncols, :]
 
         if DEBUG:
             plt.subplot(231)
@@ -1227,7 +1913,7 @@ def segment_dmap_contour_v6(im, dmap_model, contour_model, classifier_model=None
         class_pred = np.logical_not(class_pred)
 
     # estimate contours from the dmap
-    contour_pred = contour_model.predict(dmap_pred, batch_size=batch_size)
+    contour_pred = contour_model.predict(dmap_pred, batch_size=batch_size)[:, 0:nrows, 0:ncols, :]
 
     if DEBUG:
         plt.subplot(234)
@@ -1237,82 +1923,87 @@ def segment_dmap_contour_v6(im, dmap_model, contour_model, classifier_model=None
         plt.axis('off')
         plt.tight_layout()
 
-    # allocate memory for outputs
-    labels_all = np.zeros(shape=im.shape[0:3], dtype=np.int32)
-    labels_borders_all = np.zeros(shape=im.shape[0:3], dtype=np.bool)
+    if classifier_model is None:
+        class_pred = None
 
-    # loop images
-    for i in range(im.shape[0]):
+    return im, contour_pred, class_pred
 
-        # threshold to get the insides of cells
-        seg = (contour_pred[i, :, :, 0] == 0).astype(np.uint8)
 
-        # remove small holes from the segmentation of insides of cells
-        seg = remove_small_holes(seg.astype(np.bool), area_threshold=10e3).astype(np.uint8)
+def _segment_dmap_contour_v6_labels(contour, border_dilation=0, im=None):
+    """
+    Auxiliary function for segment_dmap_contour_v6(). Compute the labels of one image from the output of the contour
+    model. This is a module-level function so that it can be run in a process pool.
 
-        if DEBUG:
-            plt.subplot(235)
-            plt.cla()
-            plt.imshow(seg)
-            plt.title('Object seeds')
-            plt.axis('off')
+    :param contour: np.array (rows, cols) Output of the contour model.
+    :param border_dilation: (def 0) Number of iterations of the border dilation algorithm.
+    :param im: (def None) np.array (rows, cols, 3) Histology, only used for debugging plots.
+    :return:
+      * labels: np.array (rows, cols) Labels, one label per cell.
+      * labels_borders: np.array (rows, cols) Label edges.
+    """
 
-        # assign different label to each connected components
-        # Note: cv2.connectedComponentsWithStats is 10x faster than skimage.measure.label
-        nlabels, labels, stats, centroids = cv2.connectedComponentsWithStats(seg.astype(np.uint8))
+    # threshold to get the insides of cells
+    seg = (contour == 0).astype(np.uint8)
 
-        if DEBUG:
-            plt.subplot(235)
-            plt.cla()
-            plt.imshow(labels)
-            plt.title('Object labels')
-            plt.axis('off')
+    # remove small holes from the segmentation of insides of cells
+    seg = remove_small_holes(seg.astype(np.bool), area_threshold=10e3).astype(np.uint8)
 
-        # remove seeds that are very small
-        lblareas = stats[:, cv2.CC_STAT_AREA]
-        lab_remove = np.where(lblareas < 400)[0]
-        lab_remove = np.isin(labels, lab_remove)
-        labels[lab_remove] = 0
+    if DEBUG:
+        plt.subplot(235)
+        plt.cla()
+        plt.imshow(seg)
+        plt.title('Object seeds')
+        plt.axis('off')
 
-        # use watershed to expand the seeds
-        labels = watershed(contour_pred[i, :, :, 0], labels, watershed_line=False)
+    # assign different label to each connected components
+    # Note: cv2.connectedComponentsWithStats is 10x faster than skimage.measure.label
+    nlabels, labels, stats, centroids = cv2.connectedComponentsWithStats(seg.astype(np.uint8))
 
-        if DEBUG:
-            plt.subplot(236)
-            plt.cla()
-            plt.imshow(labels)
-            plt.title('Watershed expansion')
-            plt.axis('off')
+    if DEBUG:
+        plt.subplot(235)
+        plt.cla()
+        plt.imshow(labels)
+        plt.title('Object labels')
+        plt.axis('off')
 
-            plt.subplot(231)
-            plt.cla()
-            plt.imshow(im[i, ...])
-            plt.contour(labels, levels=np.unique(labels), colors='black')
-            plt.axis('off')
+    # remove seeds that are very small
+    lblareas = stats[:, cv2.CC_STAT_AREA]
+    lab_remove = np.where(lblareas < 400)[0]
+    lab_remove = np.isin(labels, lab_remove)
+    labels[lab_remove] = 0
 
-        # extract borders of watershed regions for plots
-        labels_borders = borders(labels)
+    # use watershed to expand the seeds
+    labels = watershed(contour, labels, watershed_line=False)
 
-        # dilate borders for easier visualization
-        if border_dilation > 0:
-            kernel = np.ones((3, 3), np.uint8)
-            labels_borders = cv2.dilate(labels_borders.astype(np.uint8), kernel=kernel, iterations=border_dilation) > 0
+    if DEBUG:
+        plt.subplot(236)
+        plt.cla()
+        plt.imshow(labels)
+        plt.title('Watershed expansion')
+        plt.axis('off')
 
-        if DEBUG:
-            plt.subplot(231)
-            plt.cla()
-            plt.imshow(im[i, ...])
-            plt.contour(labels_borders, levels=np.unique(labels_borders), colors='black')
-            plt.axis('off')
+        plt.subplot(231)
+        plt.cla()
+        plt.imshow(im)
+        plt.contour(labels, levels=np.unique(labels), colors='black')
+        plt.axis('off')
 
-        # copy results to output list
-        labels_all[i, :, :] = labels
-        labels_borders_all[i, :, :] = labels_borders
+    # extract borders of watershed regions for plots
+    labels_borders = borders(labels)
 
-    if classifier_model is not None:
-        return labels_all, class_pred, labels_borders_all
-    else:
-        return labels_all, labels_borders_all
+    # dilate borders for easier visualization
+    if border_dilation > 0:
+        kernel = np.ones((3, 3), np.uint8)
+        labels_borders = cv2.dilate(labels_borders.astype(np.uint8), kernel=kernel, iterations=border_dilation) > 0
+
+    if DEBUG:
+        plt.subplot(231)
+        plt.cla()
+        plt.imshow(im)
+        plt.contour(labels_borders, levels=np.unique(labels_borders), colors='black')
+        plt.axis('off')
+
+    return labels, labels_borders
 
 
 def match_overlapping_contours(contours_ref, contours_test, allow_repeat_ref=False, return_unmatched_refs=False,
@@ -1362,32 +2053,49 @@ def match_overlapping_contours(contours_ref, contours_test, allow_repeat_ref=Fal
     # scale polygons from e.g. pixel to um units
     contours_ref = [shapely.affinity.scale(x, xfact=xres, yfact=yres, origin=(0, 0)) for x in contours_ref]
     contours_test = [shapely.affinity.scale(x, xfact=xres, yfact=yres, origin=(0, 0)) for x in contours_test]
-
+    ref_areas = np.array([x.area for x in contours_ref])
+
+    # spatial index of the reference contours, so that each test contour is only compared to the ref contours with
+    # overlapping bounding boxes. shapely < 2.0 returns geometries instead of indices from a query, so we also need to
+    # map geometries to indices
+    tree = shapely.strtree.STRtree(contours_ref)
+    ref_idx_by_id = {id(x): j for j, x in enumerate(contours_ref)}
+
+    # results are collected in lists, and the dataframe is created at the end
+    test_idx_list = []
+    test_area_list = []
+    ref_idx_list = []
+    dice_list = []
+    hausdorff_list = []
     for i, contour_test in enumerate(contours_test):
 
-        df.loc[i, 'test_idx'] = i
-        df.loc[i, 'test_area'] = contour_test.area
+        # candidate ref contours, sorted by index so that ties are resolved as in an exhaustive search
+        candidates = [x if isinstance(x, (int, np.integer)) else ref_idx_by_id[id(x)]
+                      for x in tree.query(contour_test)]
+        if len(candidates) == 0:
+            continue
+        candidates = np.sort(candidates)
 
-        # compute the Dice coefficient of current test contour with each of the reference contours
-        dices = []
-        ref_areas = []
-        for contour_ref in contours_ref:
-            intersection_area = contour_test.intersection(contour_ref).area
-            ref_area = contour_ref.area
-            ref_areas.append(ref_area)
-            dices.append(2 * intersection_area / (ref_area + df.loc[i, 'test_area']))
+        # compute the Dice coefficient of current test contour with each of the candidate reference contours
+        test_area = contour_test.area
+        intersection_areas = np.array([contour_test.intersection(contours_ref[j]).area for j in candidates])
+        dices = 2 * intersection_areas / (ref_areas[candidates] + test_area)
 
         # find best match as the ref contour with the highest Dice coefficient
-        dices = np.array(dices)
         if np.any(dices > 0):
-            best_match_idx = np.argmax(dices)
-            df.loc[i, 'ref_idx'] = best_match_idx
-            df.loc[i, 'ref_area'] = ref_areas[best_match_idx]
-            df.loc[i, 'dice'] = dices[best_match_idx]
-            df.loc[i, 'hausdorff'] = contour_test.hausdorff_distance(contours_ref[best_match_idx])
-
-    # drop rows with test contours that have no ref match
-    df.dropna(subset=['ref_idx'], inplace=True)
+            best_match_idx = candidates[np.argmax(dices)]
+            test_idx_list.append(i)
+            test_area_list.append(test_area)
+            ref_idx_list.append(best_match_idx)
+            dice_list.append(np.max(dices))
+            hausdorff_list.append(contour_test.hausdorff_distance(contours_ref[best_match_idx]))
+
+    # test contours that have no ref match are not included
+    df = pd.DataFrame({'test_idx': test_idx_list, 'test_area': test_area_list, 'ref_idx': ref_idx_list,
+                       'ref_area': ref_areas[np.array(ref_idx_list, dtype=np.int64)], 'dice': dice_list,
+                       'hausdorff': hausdorff_list},
+                      columns=['test_idx', 'test_area', 'ref_idx', 'ref_area', 'dice', 'hausdorff'],
+                      index=test_idx_list)
 
     # if the same ref contour is matched to several test contours, only the best match is kept
     if not allow_repeat_ref:
@@ -1405,13 +2113,13 @@ def match_overlapping_contours(contours_ref, contours_test, allow_repeat_ref=Fal
         df_unmatched = pd.DataFrame(columns=df.columns)
         df_unmatched['ref_idx'] = list(set(range(len(contours_ref))) - set(df['ref_idx']))
         if len(df_unmatched['ref_idx']) > 0:
-            df_unmatched['ref_area'] = np.array(ref_areas)[np.array(df_unmatched['ref_idx'])]
+            df_unmatched['ref_area'] = ref_areas[np.array(df_unmatched['ref_idx'])]
         df = df.append(df_unmatched, ignore_index=True)
 
     return df
 
 
-def match_overlapping_labels(labels_ref, labels_test, allow_repeat_ref=False):
+def match_overlapping_labels(labels_ref, labels_test, allow_repeat_ref=False, method='greedy'):
     """
     Match estimated segmentations to ground truth segmentations and compute Dice coefficients.
 
@@ -1448,12 +2156,17 @@ def match_overlapping_labels(labels_ref, labels_test, allow_repeat_ref=False):
     Then test and ref and removed from the matrix, so that they cannot be selected again. The next maximum
     Dice value is selected, and so on.
 
+    Alternatively, with method='hungarian', the one-to-one correspondences are found with the Hungarian algorithm, so
+    that the sum of Dice coefficients is maximised.
+
     :param labels_ref: np.ndarray matrix, some integer type. All pixels with the same label
     correspond to the same object.
     :param labels_test: np.ndarray matrix, some integer type. All pixels with the same label
     correspond to the same object.
     :param allow_repeat_ref: (def False) Flag to allow that reference labels can be assigned multiple times. When False,
     each returned pair is unique. When True, 2+ test labels can correspond to the same ref label.
+    :param method: (def 'greedy') 'greedy' or 'hungarian' method to find the correspondences. allow_repeat_ref=True can
+    only be used with 'greedy'.
     :return: structured array out:
      out['lab_test']: (N,) np.ndarray with unique list of labels in the test image.
      out['lab_ref']: (N,) np.ndarray with labels that best align with the test labels.
@@ -1462,9 +2175,10 @@ def match_overlapping_labels(labels_ref, labels_test, allow_repeat_ref=False):
      out['dice']: (N,) np.ndarray with Dice coefficient for each pair of corresponding labels.
     """
 
-    # nomenclature to make array slicing more clear
-    test = 0
-    ref = 1
+    if method not in ['greedy', 'hungarian']:
+        raise ValueError('Unknown method: ' + str(method))
+    if method == 'hungarian' and allow_repeat_ref:
+        raise ValueError('allow_repeat_ref=True cannot be used with method=\'hungarian\'')
 
     # unique labels in the reference and test images, and number of pixels in each label
     labels_test_unique, labels_test_unique_count = np.unique(labels_test, return_counts=True)
@@ -1479,80 +2193,82 @@ def match_overlapping_labels(labels_ref, labels_test, allow_repeat_ref=False):
     labels_ref_unique = labels_ref_unique[idx]
     labels_ref_unique_count = labels_ref_unique_count[idx]
 
-    # look up tables to speed up searching for object sizes
-    labels_test_unique_count_lut = np.zeros(shape=(np.max(labels_test_unique) + 1, ),
-                                            dtype=labels_test_unique_count.dtype)
-    labels_ref_unique_count_lut = np.zeros(shape=(np.max(labels_ref_unique) + 1, ),
-                                           dtype=labels_ref_unique_count.dtype)
-
-    labels_test_unique_count_lut[labels_test_unique] = labels_test_unique_count
-    labels_ref_unique_count_lut[labels_ref_unique] = labels_ref_unique_count
-
-    # form pairs of values between reference labels and test labels. This is going to
-    # produce pairs of all overlapping labels, e.g. if label 5 in the test image
-    # overlaps with labels 1, 12 and 4 in the reference image,
-    # label_pairs_by_pixel = [..., 5,  5, 5, ...] (test)
-    #                        [..., 1, 12, 4, ...] (ref)
-    aux = np.stack((labels_test.flatten(), labels_ref.flatten()))  # row 0 = TEST, row 1 = REF
-    label_pairs_by_pixel, label_pairs_by_pixel_count = np.unique(aux, axis=1, return_counts=True)
-
-    # remove 0 labels
-    idx = np.logical_and(label_pairs_by_pixel[test, :] != 0, label_pairs_by_pixel[ref, :] != 0)
-    label_pairs_by_pixel = label_pairs_by_pixel[:, idx]
-    label_pairs_by_pixel_count = label_pairs_by_pixel_count[idx]
-
-    # matrix to make searchers of label overlap faster, correspondence[test, ref], and to store Dice coefficient
-    # values
-    dice = dok_matrix((np.max(labels_test_unique) + 1, np.max(labels_ref_unique) + 1),
-                      dtype='float32')
-
-    # iterate pairs of overlapping labels and compute Dice coefficient values
-    for i in range(label_pairs_by_pixel.shape[1]):
-        lab_test = label_pairs_by_pixel[test, i]
-        lab_ref = label_pairs_by_pixel[ref, i]
-
-        # to compute the Dice coefficient we need to know:
-        # * |A| number of pixels in the test label
-        # * |B| number of pixels in the corresponding ref label
-        # * |A ∩ B| = intersection_count: number of pixels in the intersection of both labels
-        # DICE = 2 * |A ∩ B| / (|A| + |B|)
-
-        a = labels_test_unique_count_lut[lab_test]
-        b = labels_ref_unique_count_lut[lab_ref]
-        dice[lab_test, lab_ref] = 2 * label_pairs_by_pixel_count[i] / (a + b)
-
     # prepare output as structured array
-    out = np.zeros((0,), dtype=[('lab_test', labels_test_unique.dtype),
-                                ('lab_ref', labels_ref_unique.dtype),
-                                ('area_test', np.int64),
-                                ('area_ref', np.int64),
-                                ('dice', dice.dtype)])
-
-    # starting from the highest Dice values, start finding one-to-one correspondences between test and ref labels
-    while dice.nnz > 0:
+    out_dtype = [('lab_test', labels_test_unique.dtype),
+                 ('lab_ref', labels_ref_unique.dtype),
+                 ('area_test', np.int64),
+                 ('area_ref', np.int64),
+                 ('dice', np.float32)]
+    if len(labels_test_unique) == 0 or len(labels_ref_unique) == 0:
+        return np.zeros((0,), dtype=out_dtype)
+
+    # form pairs of values between reference labels and test labels in one pass. Labels are replaced by their index in
+    # labels_*_unique (0 for background), and each pair (test, ref) is encoded as a single integer. This is going to
+    # produce pairs of all overlapping labels, e.g. if label 5 in the test image overlaps with labels 1, 12 and 4 in
+    # the reference image,
+    # idx_test = [..., 5,  5, 5, ...]
+    # idx_ref =  [..., 1, 12, 4, ...]
+    idx_test_by_pixel = np.searchsorted(labels_test_unique, labels_test.ravel()) + 1
+    idx_test_by_pixel[labels_test.ravel() == 0] = 0
+    idx_ref_by_pixel = np.searchsorted(labels_ref_unique, labels_ref.ravel()) + 1
+    idx_ref_by_pixel[labels_ref.ravel() == 0] = 0
+    n_ref = len(labels_ref_unique) + 1
+    pairs, intersection_count = np.unique(idx_test_by_pixel.astype(np.int64) * n_ref + idx_ref_by_pixel,
+                                          return_counts=True)
+    idx_test, idx_ref = np.divmod(pairs, n_ref)
 
-        # convert Dice matrix to a format with faster slicing
-        dice = dice.tocsc()
+    # remove 0 labels
+    idx = np.logical_and(idx_test != 0, idx_ref != 0)
+    idx_test = idx_test[idx] - 1
+    idx_ref = idx_ref[idx] - 1
+    intersection_count = intersection_count[idx]
+
+    # to compute the Dice coefficient we need to know:
+    # * |A| number of pixels in the test label
+    # * |B| number of pixels in the corresponding ref label
+    # * |A ∩ B| = intersection_count: number of pixels in the intersection of both labels
+    # DICE = 2 * |A ∩ B| / (|A| + |B|)
+    area_test = labels_test_unique_count[idx_test]
+    area_ref = labels_ref_unique_count[idx_ref]
+    dice = (2 * intersection_count / (area_test + area_ref)).astype(np.float32)
+
+    if method == 'greedy':
+
+        # starting from the highest Dice values, find one-to-one correspondences between test and ref labels. Ties are
+        # broken by the smallest ref label, then the smallest test label
+        idx_sorted = np.lexsort((idx_test, idx_ref, -dice))
+        is_test_used = np.zeros(shape=(len(labels_test_unique),), dtype=np.bool)
+        is_ref_used = np.zeros(shape=(len(labels_ref_unique),), dtype=np.bool)
+        idx_out = []
+        for j in idx_sorted:
+            if is_test_used[idx_test[j]] or is_ref_used[idx_ref[j]]:
+                continue
+            idx_out.append(j)
 
-        # labels with the largest Dice coefficient
-        idx = dice.argmax()
-        (lab_test, lab_ref) = np.unravel_index(idx, dice.shape)
+            # remove the labels so that they cannot be selected again
+            is_test_used[idx_test[j]] = True
+            if not allow_repeat_ref:
+                is_ref_used[idx_ref[j]] = True
+        idx_out = np.array(idx_out, dtype=np.int64)
 
-        # areas of the labels
-        area_test = labels_test_unique_count_lut[lab_test]
-        area_ref = labels_ref_unique_count_lut[lab_ref]
+    else:  # method == 'hungarian'
 
-        # add this pair to the output
-        out = np.append(out, np.array([(lab_test, lab_ref, area_test, area_ref, dice[lab_test, lab_ref])],
-                                      dtype=out.dtype))
+        # optimal assignment that maximises the sum of Dice coefficients
+        dice_matrix = coo_matrix((dice, (idx_test, idx_ref)),
+                                 shape=(len(labels_test_unique), len(labels_ref_unique)))
+        row, col = linear_sum_assignment(-dice_matrix.toarray())
 
-        # convert Dice matrix to a format with faster change of sparsity
-        dice = dice.tolil()
+        # keep only overlapping pairs, sorted from highest to lowest Dice coefficient
+        pair_to_idx = dict(zip(zip(idx_test, idx_ref), range(len(dice))))
+        idx_out = np.array([pair_to_idx[(r, c)] for r, c in zip(row, col) if (r, c) in pair_to_idx], dtype=np.int64)
+        idx_out = idx_out[np.lexsort((idx_test[idx_out], idx_ref[idx_out], -dice[idx_out]))]
 
-        # remove the labels from the matrix so that they cannot be selected again
-        dice[lab_test, :] = 0
-        if not allow_repeat_ref:
-            dice[:, lab_ref] = 0
+    out = np.zeros((len(idx_out),), dtype=out_dtype)
+    out['lab_test'] = labels_test_unique[idx_test[idx_out]]
+    out['lab_ref'] = labels_ref_unique[idx_ref[idx_out]]
+    out['area_test'] = area_test[idx_out]
+    out['area_ref'] = area_ref[idx_out]
+    out['dice'] = dice[idx_out]
 
     # check that all Dice values are in [0.0, 1.0]
     assert(all(out['dice'] >= 0.0) and all(out['dice'] <= 1.0))
@@ -1861,6 +2577,23 @@ def bounding_box_with_margin(label, inc=0.0, coordinates='xy'):
     # box enclosing segmentation
     bbox = props[0]['bbox']
 
+    # make the box square, and increase or decrease its size
+    (bbox_r0, bbox_c0, bbox_rend, bbox_cend) = _square_bbox_with_margin(bbox, inc=inc)
+
+    if coordinates == 'xy':
+        return np.float64(bbox_c0), np.float64(bbox_r0), np.float64(bbox_cend - 1), np.float64(bbox_rend - 1)
+    elif coordinates == 'rc':
+        return np.int64(bbox_r0), np.int64(bbox_c0), np.int64(bbox_rend), np.int64(bbox_cend)
+    else:
+        raise ValueError('Unknown "coordinates" value.')
+
+
+def _square_bbox_with_margin(bbox, inc=0.0):
+    """
+    Make a (r0, c0, rend, cend) bounding box square, and increase (or decrease with negative value) its size 100*inc%.
+    See bounding_box_with_margin().
+    """
+
     # ease nomenclature of box corners
     (bbox_r0, bbox_c0, bbox_rend, bbox_cend) = bbox
 
@@ -1881,12 +2614,7 @@ def bounding_box_with_margin(label, inc=0.0, coordinates='xy'):
     bbox_rend = bbox_r0 + bbox_len
     bbox_cend = bbox_c0 + bbox_len
 
-    if coordinates == 'xy':
-        return np.float64(bbox_c0), np.float64(bbox_r0), np.float64(bbox_cend - 1), np.float64(bbox_rend - 1)
-    elif coordinates == 'rc':
-        return np.int64(bbox_r0), np.int64(bbox_c0), np.int64(bbox_rend), np.int64(bbox_cend)
-    else:
-        raise ValueError('Unknown "coordinates" value.')
+    return bbox_r0, bbox_c0, bbox_rend, bbox_cend
 
 
 def extract_bbox(im, bbox):
@@ -1949,7 +2677,7 @@ def extract_bbox(im, bbox):
 
 
 def one_image_per_label_v2(vols, resize_to=None, resample=None, bbox_inc=1.0, only_central_label=False,
-                           return_bbox=False):
+                           return_bbox=False, num_workers=None):
     """
     Crop a squared bounding box around each label in a segmentation array. Optionally, more volumes of the same size
     can be provided and they will be cropped according to the same labels (this is useful if e.g. you want to also crop
@@ -1988,6 +2716,7 @@ def one_image_per_label_v2(vols, resize_to=None, resample=None, bbox_inc=1.0, on
     :param only_central_label: (def False) If True, delete the labels that are around the central label.
     :param return_bbox: (def False) If True, return the four coordinates of the bounding box in the index_list output
     argument as (r0, c0, rend, cend).
+    :param num_workers: (def None) If > 1, number of threads used to crop and resize the labels.
 
     First, the bounding box is computed as the tightest square that contains the label. Then, this size is increased by
     bbox_inc*100%. For example, bbox_inc=0.2 will increase the size by 20%. By default, bbox_inc=1.0 increases the size
@@ -1996,7 +2725,8 @@ def one_image_per_label_v2(vols, resize_to=None, resample=None, bbox_inc=1.0, on
     :return:
     * vols_crop: tuple with the cropped windows, e.g. (labels_crop, vol0_crop, vol1_crop, vol2_crop).
 
-        If resize_to=None, each element in the tuple is a list with the different-sized crops.
+        If resize_to=None, each element in the tuple is a list with the different-sized crops, each crop with shape
+        (1, row, col, ...).
 
         If resize_to had some value, e.g. (401, 401), each list has been collapsed into an array, e.g.
 
@@ -2026,24 +2756,26 @@ def one_image_per_label_v2(vols, resize_to=None, resample=None, bbox_inc=1.0, on
         # if labels are (row, col), convert all volumes to (1, row, col, ...)
         for i, vol in enumerate(vols):
             vols[i] = np.expand_dims(vol, axis=0)
-    # init empty lists to place crops of vols
-    vols_crop = [[] for foo in range(len(vols))]
+    labels = vols[0]
     if resize_to is not None and resample is None:
         resample = (Image.NEAREST, ) * len(vols)
 
-    # loop labels in each image (we could also use regionprops() and reuse code from one_image_per_label, but this way
-    # the code is a lot shorter and clearer)
+    # get the bounding boxes of all labels in each image with one pass, instead of one pass per label
     index_list = []
     scaling_factor_rc_list = []
+    bbox_list = []
     for i in range(labels.shape[0]):
-        for lab in np.unique(labels[i, :, :]):
+        for j, bbox in enumerate(find_objects(labels[i, :, :])):
 
-            if lab == 0:
-                # skip background label
+            if bbox is None:
+                # label not present in the image
                 continue
+            lab = labels.dtype.type(j + 1)
 
-            # bounding box for current label: bbox_rc = (r0, c0, rend, cend)
-            bbox_rc = bounding_box_with_margin(labels[i, :, :] == lab, inc=bbox_inc, coordinates='rc')
+            # squared bounding box for current label: bbox_rc = (r0, c0, rend, cend)
+            bbox_rc = _square_bbox_with_margin((bbox[0].start, bbox[1].start, bbox[0].stop, bbox[1].stop),
+                                               inc=bbox_inc)
+            bbox_rc = tuple(np.int64(x) for x in bbox_rc)
 
             # compute scaling factor
             if resize_to is None:
@@ -2059,28 +2791,62 @@ def one_image_per_label_v2(vols, resize_to=None, resample=None, bbox_inc=1.0, on
                 index_list.append((i, lab) + bbox_rc)
             else:
                 index_list.append((i, lab))
+            bbox_list.append((i, lab, bbox_rc))
 
-            # loop vols
-            for k, vol in enumerate(vols):
+    def crop_label(j):
+        """
+        Crop and resize all volumes for the j-th label.
+        """
+        i, lab, bbox_rc = bbox_list[j]
+        vol_crop = []
+        for k, vol in enumerate(vols):
 
-                # crop image with bounding box
-                vol_bbox = extract_bbox(vol[i, ...], bbox_rc)
+            # crop image with bounding box
+            vol_bbox = extract_bbox(vol[i, ...], bbox_rc)
 
-                # mask central label
-                if only_central_label and k == 0:
-                    vol_bbox = (vol_bbox == lab).astype(vol_bbox.dtype)
+            # mask central label
+            if only_central_label and k == 0:
+                vol_bbox = (vol_bbox == lab).astype(vol_bbox.dtype)
 
-                if resize_to is not None:
-                    # resize the image to target window size
-                    vol_bbox = resize(vol_bbox, size=resize_to, resample=resample[k])
+            if resize_to is not None:
+                # resize the image to target window size
+                vol_bbox = resize(vol_bbox, size=resize_to, resample=resample[k])
 
-                # append results to output
-                vols_crop[k].append(np.expand_dims(vol_bbox, axis=0))
+            vol_crop.append(vol_bbox)
+        return vol_crop
 
-    # if all crops are resized to the same size, they can be collapsed into an array
-    if resize_to is not None:
-        for k, vol_crop in enumerate(vols_crop):
-            vols_crop[k] = np.concatenate(vols_crop[k], axis=0)
+    def put_label(j, vol_crop):
+        for k in range(len(vols)):
+            if resize_to is None:
+                # different-sized crops are returned as a list of (1, row, col, ...) arrays
+                vols_crop[k][j] = np.expand_dims(vol_crop[k], axis=0)
+            else:
+                vols_crop[k][j] = vol_crop[k]
+
+    # init outputs. If all crops are resized to the same size, they can be collapsed into an array, which we preallocate
+    # from the first crop, so that it has the output type of resize()
+    n = len(bbox_list)
+    if n == 0:
+        if resize_to is None:
+            vols_crop = [[] for foo in range(len(vols))]
+        else:
+            vols_crop = [np.zeros(shape=(0,) + tuple(resize_to) + vol.shape[3:], dtype=vol.dtype) for vol in vols]
+    else:
+        vol_crop = crop_label(0)
+        if resize_to is None:
+            vols_crop = [[None] * n for foo in range(len(vols))]
+        else:
+            vols_crop = [np.zeros(shape=(n,) + x.shape, dtype=x.dtype) for x in vol_crop]
+        put_label(0, vol_crop)
+
+        # crop the rest of labels, optionally in parallel (PIL releases the GIL when resizing)
+        if num_workers is not None and num_workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+                for j, vol_crop in enumerate(executor.map(crop_label, range(1, n)), start=1):
+                    put_label(j, vol_crop)
+        else:
+            for j in range(1, n):
+                put_label(j, crop_label(j))
 
     # if the input was a single array, we return an array too, not a list with a single array
     if not vols_islist:
@@ -2339,121 +3105,97 @@ def clean_segmentation(labels,
     is_removed_edge_label = np.zeros(shape=labels.shape, dtype=np.bool)
     for i in range(labels.shape[0]):  # loop label images
 
+        aux = labels[i, :, :]
+
         if DEBUG:
             plt.clf()
             plt.subplot(221)
-            plt.imshow(labels[i, :, :])
-
-        # remove labels that are too small
-        labels[i, :, :] = remove_small_objects(labels[i, :, :], min_size=min_cell_area)
+            plt.imshow(aux)
 
-        if DEBUG:
-            plt.subplot(222)
-            plt.imshow(labels[i, :, :])
-
-        # remove labels that are not substantially within the mask
+        # per-label statistics in one pass over the image: number of pixels, number of pixels within the mask, and
+        # number of pixels of class True
+        aux_flat = aux.ravel()
+        area = np.bincount(aux_flat)
+        is_kept = area >= min_cell_area
         if mask is not None:
-
-            # count number of pixels in each label
-            prop = regionprops(labels[i, :, :])
-            prop_masked = regionprops(labels[i, :, :] * mask[i, :, :])
-
-            # create a lookup table for quick search of label area
-            max_label = np.max([p.label for p in prop])
-            area_lut = np.zeros(shape=(max_label + 1,))
-            area_masked_lut = np.zeros(shape=(max_label + 1,))
-            for p in prop:
-                area_lut[p.label] = p.area
-            for p in prop_masked:
-                area_masked_lut[p.label] = p.area
-
-            # check for each original label whether it is at least min_mask_overlap (def 80%) covered by the mask
-            for p in prop:
-                if area_masked_lut[p.label] < area_lut[p.label] * min_mask_overlap:
-                    aux = labels[i, :, :]
-                    aux[labels[i, :, :] == p.label] = 0
-
-        if DEBUG:
-            plt.subplot(223)
-            plt.imshow(labels[i, :, :])
-
-        # remove objects that don't contain enough pixels of class 1
+            # remove labels that are not substantially within the mask
+            area_masked = np.bincount(aux_flat, weights=mask[i, :, :].ravel() != 0, minlength=len(area))
+            is_kept &= area_masked >= area * min_mask_overlap
         if labels_class is not None:
-            # list of labels that are not 0
-            lab_list = np.unique(labels[i, :, :])
-            lab_list = lab_list[lab_list != 0]
-
-            # loop labels
-            for lab in lab_list:
-
-                # pixels that belong to the current label
-                aux = labels[i, :, :]
-                idx = aux == lab
-
-                # proportion of class=True pixels
-                aux_class = labels_class[i, :, :]
-                pixel_prop = np.count_nonzero(aux_class[idx]) / np.count_nonzero(idx)
-
-                # delete the label if it doesn't contain enough pixels of class True
-                if pixel_prop < min_class_prop:
-                    aux[idx] = 0
+            # remove objects that don't contain enough pixels of class 1
+            area_class = np.bincount(aux_flat, weights=labels_class[i, :, :].ravel() != 0, minlength=len(area))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                is_kept &= area_class / area >= min_class_prop
+        if not phagocytosis and max_cell_area < np.inf:
+            # without phagocytosis, labels don't change area, so we can remove large objects here too
+            is_kept &= area <= max_cell_area
+        is_kept[0] = True  # background
+
+        # remove labels with a lookup table
+        if not np.all(is_kept[area > 0]):
+            aux[~is_kept[aux]] = 0
 
         if DEBUG:
-            plt.subplot(224)
-            plt.cla()
-            plt.imshow(labels[i, :, :])
+            plt.subplot(222)
+            plt.imshow(aux)
 
         # remove labels that are completely surrounded by another label
         background = 0  # background label
-        labels_list = np.unique(labels[i, :, :])
-        n_non_background_labels = np.count_nonzero(labels_list != background)
+        n_non_background_labels = np.count_nonzero(is_kept[1:] & (area[1:] > 0))
         if phagocytosis and n_non_background_labels >= 2:
 
-            # a donut is a label with another label inside
-            there_are_donuts = True
-            while there_are_donuts:
-
-                # unless we find a donut, by default we stop
-                there_are_donuts = False
-
-                prop = regionprops(labels[i, :, :])
-                for p in prop:
-                    # if this label has another label inside
-                    there_are_donuts = p.area != p.filled_area
-                    if there_are_donuts:
-                        # fill up the donut
-                        lab = labels[i, :, :]
-                        lab[binary_fill_holes(lab == p.label)] = p.label
-                        labels[i, :, :] = lab
-                        break
+            # a donut is a label with another label inside (as regionprops' filled_area, holes are found with
+            # 8-connectivity, but filled with 4-connectivity). We look for holes of all labels at once, each one
+            # within its bounding box. After filling the donuts, only labels that changed can have new holes
+            labels_to_check = np.nonzero(area)[0]
+            while True:
+                donuts = []
+                bboxes = find_objects(aux)
+                for lab in labels_to_check:
+                    if lab == background or lab > len(bboxes) or bboxes[lab - 1] is None:
+                        continue
+                    bbox = bboxes[lab - 1]
+                    aux_bbox = aux[bbox] == lab
+                    if np.count_nonzero(binary_fill_holes(aux_bbox, structure=np.ones((3, 3)))) != area[lab]:
+                        filled = binary_fill_holes(aux_bbox)
+                        donuts.append((np.count_nonzero(filled), lab, bbox, filled))
+                if len(donuts) == 0:
+                    break
+
+                # fill up the donuts. A donut inside a larger donut's hole is filled first, so that the larger one
+                # takes over its pixels
+                for filled_area, lab, bbox, filled in sorted(donuts, key=lambda x: x[0]):
+                    aux[bbox][filled] = lab
+
+                area_before = area
+                area = np.bincount(aux.ravel(), minlength=len(area_before))
+                labels_to_check = np.nonzero((area > 0) & (area != area_before))[0]
 
         if DEBUG:
             plt.subplot(223)
-            plt.imshow(labels[i, :, :])
+            plt.imshow(aux)
 
         # remove large objects
-        if max_cell_area < np.inf:
-            aux = labels[i, :, :]
-            prop = regionprops(aux)
-            for p in prop:
-                if p.area > max_cell_area:
-                    aux[aux == p.label] = 0
+        if phagocytosis and max_cell_area < np.inf:
+            is_large = area > max_cell_area
+            is_large[0] = False
+            if np.any(is_large):
+                aux[is_large[aux]] = 0
 
         if DEBUG:
             plt.subplot(224)
             plt.cla()
-            plt.imshow(labels[i, :, :])
+            plt.imshow(aux)
 
         # remove edge segmentations, because in general they correspond to incomplete objects
         if remove_edge_labels:
-            labels_edge = edge_labels(labels[i, :, :])
-            is_removed_edge_label[i, :, :] = np.isin(labels[i, :, :], test_elements=labels_edge)  # bool of pixels on edge cells
-            aux = labels[i, :, :]
+            labels_edge = edge_labels(aux)
+            is_removed_edge_label[i, :, :] = np.isin(aux, test_elements=labels_edge)  # bool of pixels on edge cells
             aux[is_removed_edge_label[i, :, :]] = 0
 
         if DEBUG:
             plt.subplot(223)
-            plt.imshow(labels[i, :, :])
+            plt.imshow(aux)
             plt.contour(is_removed_edge_label[i, :, :], colors='w')
 
     # remove dummy dimension if the input was 2D
@@ -2464,7 +3206,8 @@ def clean_segmentation(labels,
     return labels, is_removed_edge_label
 
 
-def correct_segmentation(im, seg, correction_model, model_type='-1_1', smoothing=11, batch_size=16):
+def correct_segmentation(im, seg, correction_model, model_type='-1_1', smoothing=11, batch_size=16, model_cache=None,
+                         executor=None):
     """
     Correct histology segmentation using a fully convolutional neural network.
 
@@ -2485,16 +3228,25 @@ def correct_segmentation(im, seg, correction_model, model_type='-1_1', smoothing
     :param batch_size: (def None) Scalar batch_size passed to keras correction model. Maximum number of images processed
     at the same time by the GPUs. A larger number produces faster processing, but it also requires larger GPU memory. If
     batch_size is None, then batch_size is the number of images for the correction model.
+    :param model_cache: (def None) cytometer.models.ModelCache. If provided and correction_model is a filename, the
+    model is obtained from the cache, with its input layer already adapted to the size of im.
+    :param executor: (def None) concurrent.futures.Executor to select the largest component and smooth each
+    segmentation in parallel, e.g. concurrent.futures.ThreadPoolExecutor or ProcessPoolExecutor. By default, images are
+    processed serially. The output is the same either way.
     :return:
     * corrected_seg: (n, row, col) Corrected segmentations.
     """
 
     # if needed, load correction model
     if isinstance(correction_model, six.string_types):
-        correction_model = keras.models.load_model(correction_model)
+        if model_cache is not None:
+            correction_model = model_cache.get(correction_model, input_shape=im.shape)
+        else:
+            correction_model = keras.models.load_model(correction_model)
 
     # adapt model input size to size of image
-    correction_model = change_input_size(correction_model, batch_shape=im.shape)
+    if correction_model.input_shape[1:3] != im.shape[1:3]:
+        correction_model = change_input_size(correction_model, batch_shape=im.shape)
 
     # correct dimensions
     seg_out = seg.copy()  # to avoid changes by reference to the input segmentation
@@ -2528,40 +3280,60 @@ def correct_segmentation(im, seg, correction_model, model_type='-1_1', smoothing
     structure = np.expand_dims(structure, axis=0)  # add dummy dimension
     seg_out = binary_fill_holes(seg_out, structure=structure).astype(np.uint8)
 
-    # keep only the corrected component with the largest overlap with the input segmentation
-    for j in range(seg_out.shape[0]):
-        # connected components of corrected segmentation
-        _, labels_aux, stats_aux, _ = cv2.connectedComponentsWithStats(seg_out[j, :, :], connectivity=4)
+    # keep only the corrected component with the largest overlap with the input segmentation, and smooth it
+    selem = np.ones((smoothing, smoothing))
+    if executor is None:
+        for j in range(seg_out.shape[0]):
+            seg_out[j, :, :] = _correct_segmentation_component(seg_out[j, :, :], seg[j, ...], selem)
+    else:
+        # map() returns the results in the same order as the images
+        results = executor.map(_correct_segmentation_component, list(seg_out), list(seg), [selem] * seg_out.shape[0])
+        for j, seg_out_j in enumerate(results):
+            seg_out[j, :, :] = seg_out_j
 
-        # connected component labels within the input segmentation
-        lab, counts = np.unique(labels_aux[seg[j, ...] == 1], return_counts=True)
+    # fill holes, but only image by image
+    seg_out = binary_fill_holes(seg_out, structure=structure).astype(np.uint8)
 
-        # remove background label, if present
-        idx = lab != 0
-        lab = lab[idx]
-        counts = counts[idx]
+    return seg_out
 
-        if len(counts) > 0:
 
-            # connected component label with maximum overlap with input segmentation
-            lab_max = lab[np.argmax(counts)]
+def _correct_segmentation_component(seg_out, seg, selem):
+    """
+    Auxiliary function for correct_segmentation(). Keep only the connected component of one corrected segmentation with
+    the largest overlap with the input segmentation, and smooth it. This is a module-level function so that it can be
+    run in a process pool.
+
+    :param seg_out: (row, col) np.array, dtype=np.uint8 with the corrected segmentation.
+    :param seg: (row, col) np.array with the input segmentation.
+    :param selem: Structuring element for the binary closing.
+    :return: (row, col) np.array, dtype=np.uint8 with the selected component.
+    """
 
-            # keep only the connected component with maximum overlap
-            seg_out[j, ...] = labels_aux == lab_max
+    # connected components of corrected segmentation
+    _, labels_aux, stats_aux, _ = cv2.connectedComponentsWithStats(seg_out, connectivity=4)
 
-        else:
+    # connected component labels within the input segmentation
+    lab, counts = np.unique(labels_aux[seg == 1], return_counts=True)
 
-            seg_out[j, ...] = seg[j, ...]
+    # remove background label, if present
+    idx = lab != 0
+    lab = lab[idx]
+    counts = counts[idx]
 
-    # smooth segmentation
-    selem = np.ones((smoothing, smoothing))
-    for j in range(seg_out.shape[0]):
-        seg_out[j, :, :] = binary_closing(seg_out[j, :, :], selem=selem)
+    if len(counts) > 0:
 
-    # fill holes, but only image by image
-    seg_out = binary_fill_holes(seg_out, structure=structure).astype(np.uint8)
+        # connected component label with maximum overlap with input segmentation
+        lab_max = lab[np.argmax(counts)]
 
-    return seg_out
+        # keep only the connected component with maximum overlap
+        seg_out = (labels_aux == lab_max).astype(np.uint8)
+
+    else:
+
+        seg_out = seg.astype(np.uint8)
+
+    # smooth segmentation
+    return binary_closing(seg_out, selem=selem).astype(np.uint8)
 
 
 def segmentation_pipeline(im, contour_model, dmap_model, quality_model,
@@ -2929,7 +3701,8 @@ def segmentation_pipeline6(im,
                            mask=None, min_mask_overlap=0.8, phagocytosis=True,
                            min_class_prop=1.0,
                            correction_window_len=401, correction_smoothing=11,
-                           batch_size=None, return_bbox=False, return_bbox_coordinates='rc'):
+                           batch_size=None, return_bbox=False, return_bbox_coordinates='rc', model_cache=None,
+                           shape_buckets=None, executor=None):
     """
     White adipocyte segmentation pipeline v6 using convolution neural networks (CNNs).
 
@@ -2995,6 +3768,13 @@ def segmentation_pipeline6(im,
     :param return_bbox: (def False) If True, return the four coordinates of the bounding box in the index_list output
     argument as (r0, c0, rend, cend).
     :param return_bbox_coordinates: (def 'rc') Type of bbox_coordinates: 'rc': (row, col). 'xy': (x, y).
+    :param model_cache: (def None) cytometer.models.ModelCache. If provided, models given as filenames are obtained from
+    the cache instead of being loaded from file for each image. This is useful when the pipeline is applied to many
+    tiles of the same slide.
+    :param shape_buckets: (def None) Canonical shapes that im is padded to for the segmentation networks, so that tiles
+    of different sizes can reuse the same models. (See segment_dmap_contour_v6() and shape_bucket().)
+    :param executor: (def None) concurrent.futures.Executor to run the per-image post-processing in parallel. (See
+    segment_dmap_contour_v6() and correct_segmentation().)
     :return:
       * labels: (row, col) np.array (np.int32). Integer labels for non-overlap segmentation. All pixels with the same
         label belong to the same object.
@@ -3039,7 +3819,8 @@ def segmentation_pipeline6(im,
     labels, labels_class, _ \
         = segment_dmap_contour_v6(im,
                                   contour_model=contour_model, dmap_model=dmap_model, classifier_model=classifier_model,
-                                  border_dilation=0, batch_size=batch_size)
+                                  border_dilation=0, batch_size=batch_size, model_cache=model_cache,
+                                  shape_buckets=shape_buckets, executor=executor)
     labels = labels[0, :, :]
     labels_class = labels_class[0, :, :, 0]
 
@@ -3142,7 +3923,8 @@ def segmentation_pipeline6(im,
         window_labels_corrected = correct_segmentation(im=window_im, seg=window_labels,
                                                        correction_model=correction_model, model_type='-1_1',
                                                        smoothing=correction_smoothing,
-                                                       batch_size=batch_size)
+                                                       batch_size=batch_size, model_cache=model_cache,
+                                                       executor=executor)
     else:
         window_labels_corrected = None
 
@@ -3235,6 +4017,71 @@ def labels2contours(window_labels, offset_xy=None, scaling_factor_xy=None):
     return contours
 
 
+def labels2contours_batch(window_labels, offset_xy=None, scaling_factor_xy=None):
+    """
+    Extract one contour from each image in a stack of cropped objects.
+
+    This is a faster version of labels2contours() for the output of one_image_per_label_v2(..., only_central_label=True),
+    where each image contains one object (pixels != 0). Instead of building a binary mask for each label, the marching
+    squares are computed directly on a crop of each image around the object. The bounding boxes of all objects are
+    computed at once for the whole stack.
+
+    The contour points assume that pixel size is (1, 1).
+
+    :param window_labels: np.array (n, row, col). Each (i, ...) is a 2D image with one object.
+    :param offset_xy: (def None) np.array (n, 2). Each row contains the (x, y) coordinates of the first pixel. See
+    labels2contours().
+    :param scaling_factor_xy: (def None) List of n (sx, sy) scaling factors. See labels2contours().
+    :return:
+    * contours: List of np.array (m_i, x, y). Each np.array contains the points of a contour. Images without an object
+      don't produce a contour.
+    """
+
+    if len(window_labels) == 0:
+        return []
+
+    if offset_xy is not None:
+        if window_labels.shape[0] != offset_xy.shape[0] or offset_xy.shape[1] != 2:
+            raise ValueError('offset must have shape (n, 2) if window_labels has shape (n, row, col)')
+
+    if scaling_factor_xy is not None:
+        if window_labels.shape[0] != len(scaling_factor_xy):
+            raise ValueError('scaling factor must be a list with n elements if window_labels has shape (n, row, col)')
+
+    # bounding box of the object in each image, with a 1 pixel margin of background so that the marching squares
+    # produce the same contour as on the whole image
+    is_object = window_labels != 0
+    is_object_row = np.any(is_object, axis=2)
+    is_object_col = np.any(is_object, axis=1)
+    nrows, ncols = window_labels.shape[1:3]
+    r0 = np.maximum(np.argmax(is_object_row, axis=1) - 1, 0)
+    rend = np.minimum(nrows - np.argmax(is_object_row[:, ::-1], axis=1) + 1, nrows)
+    c0 = np.maximum(np.argmax(is_object_col, axis=1) - 1, 0)
+    cend = np.minimum(ncols - np.argmax(is_object_col[:, ::-1], axis=1) + 1, ncols)
+
+    contours = []
+    for i in np.nonzero(np.any(is_object_row, axis=1))[0]:
+
+        # convert object to contour (points) using marching squares, and then to (x, y) coordinates
+        aux = find_contours(is_object[i, r0[i]:rend[i], c0[i]:cend[i]], 0.5,
+                            fully_connected='low', positive_orientation='low')[0]
+        aux = aux[:, [1, 0]]
+        aux[:, 0] += c0[i]
+        aux[:, 1] += r0[i]
+        # undo scaling
+        if scaling_factor_xy is not None:
+            aux[:, 0] /= scaling_factor_xy[i][0]
+            aux[:, 1] /= scaling_factor_xy[i][1]
+        # add window offset
+        if offset_xy is not None:
+            aux[:, 0] = aux[:, 0] + offset_xy[i, 0]
+            aux[:, 1] = aux[:, 1] + offset_xy[i, 1]
+        # add to the list of contours
+        contours.append(aux)
+
+    return contours
+
+
 def colour_labels_with_receptive_field(labels, receptive_field):
     """
     Take a segmentation where each object has a different label, and colour them with a distance constraint:
@@ -3707,6 +4554,57 @@ def rescale_intensity(im, ignore_value=None):
     return im
 
 
+# confidence intervals of ecdf_confidence() for each (n, quantiles, confidence, estimator_name)
+_ecdf_confidence_cache = {}
+
+
+def _ecdf_confidence_intervals(n, quantiles, confidence, estimator_name, max_cache_size=4096):
+    """
+    Confidence intervals of ECDF quantiles, for ecdf_confidence().
+
+    Intervals are memoised in _ecdf_confidence_cache, and the ones not in the cache are computed with a single
+    vectorised call, that gives the same values as
+    cytometer.CDF_confidence.CDF_error_beta() / CDF_error_DKW_band() for each quantile.
+
+    :param n: (S,)-np.ndarray with the number of data points of each sample.
+    :param quantiles: (S, Q)-np.ndarray with the quantiles of each sample.
+    :param confidence: See ecdf_confidence().
+    :param estimator_name: See ecdf_confidence().
+    :param max_cache_size: (def 4096) The cache is emptied when it has more than this number of entries.
+    :return: quantile_ci_lo, quantile_ci_hi: (S, Q)-np.ndarray with np.float32 values.
+    """
+
+    ci_lo = (1.0 - confidence) / 2.0
+    ci_hi = 1.0 - ci_lo
+
+    keys = [(int(n_i), q_i.tobytes(), confidence, estimator_name) for n_i, q_i in zip(n, quantiles)]
+    idx_todo = [i for i, key in enumerate(keys) if key not in _ecdf_confidence_cache]
+
+    if len(idx_todo) > 0:
+        n_todo = np.array(n, dtype=np.float64)[idx_todo, np.newaxis]
+        q_todo = quantiles[idx_todo, :]
+        if estimator_name == 'DKW':
+            alpha_lo = 1.0 - 2.0 * np.abs(0.5 - ci_lo)
+            alpha_hi = 1.0 - 2.0 * np.abs(0.5 - ci_hi)
+            lo = np.maximum(0, q_todo - np.sqrt(np.log(2.0 / alpha_lo) / (2.0 * n_todo)))
+            hi = np.minimum(1, q_todo + np.sqrt(np.log(2.0 / alpha_hi) / (2.0 * n_todo)))
+        elif estimator_name == 'beta':
+            k = q_todo * n_todo
+            lo, hi = beta.ppf(np.array([ci_lo, ci_hi])[:, np.newaxis, np.newaxis], k, n_todo + 1 - k)
+        else:
+            raise NameError('Unknown error estimator name: ' + estimator_name)
+
+        if len(_ecdf_confidence_cache) + len(idx_todo) > max_cache_size:
+            _ecdf_confidence_cache.clear()
+        for i, lo_i, hi_i in zip(idx_todo, lo.astype(np.float32), hi.astype(np.float32)):
+            _ecdf_confidence_cache[keys[i]] = (lo_i, hi_i)
+
+    quantile_ci_lo = np.stack([_ecdf_confidence_cache[key][0] for key in keys])
+    quantile_ci_hi = np.stack([_ecdf_confidence_cache[key][1] for key in keys])
+
+    return quantile_ci_lo, quantile_ci_hi
+
+
 def ecdf_confidence(data, num_quantiles=101, equispace='quantiles', confidence=0.95, estimator_name='beta'):
     """
     Compute empirical ECDF with confidence intervals/bands.
@@ -3716,78 +4614,206 @@ def ecdf_confidence(data, num_quantiles=101, equispace='quantiles', confidence=0
 
     Derived from plot_CDF_confidence (https://github.com/wfbradley/CDF-confidence/blob/master/CDF_confidence.py).
 
-    :param data: numpy.array with the 1D data to compute the ECDF for.
-    :param num_quantiles: (def 101). Number of points the quantiles/data axes are split into for the output.
+    Several samples (e.g. one per animal) can be processed in one call. The confidence intervals are computed for all
+    of them at once, and memoised, so that samples with the same number of points reuse them.
+
+    :param data: numpy.array with the 1D data to compute the ECDF for, or 2D array with one sample per row, or list of
+    1D samples.
+    :param num_quantiles: (def 101). Number of points the quantiles/data axes are split into for the output. It's
+    limited to the number of data points + 1 of the smallest sample.
     :param equispace: 'quantiles' (def), 'data'. Choose which axis is equispaced for the output, data or quantiles.
     :param confidence: (def 0.95) 0.95 = 95-CI means confidence intervals [2.5%, 97.5%].
     :param estimator_name: (def 'beta) 'DKW' (Dvoretzky-Kiefer-Wolfowitz confidence band) or 'beta'.
     :return: data_out, quantile_out, quantile_ci_lo, quantile_ci_hi
 
     (num_quantiles,) numpy.arrays with a mapping ECDF(data_out[i]) in [quantile_ci_lo[i], quantile_ci_hi[i]], and
-    ECDF(data_out[i])
+    ECDF(data_out[i]). For several samples, (num_samples, num_quantiles) numpy.arrays, one row per sample.
     """
 
-    if len(np.shape(data)) != 1:
-        raise NameError('Data must be 1 dimensional')
-    if num_quantiles > len(data) + 1:
-        num_quantiles = len(data) + 1
-    if len(data) < 2:
+    # a list of samples, or an array-like (e.g. pandas.Series) with one sample or one sample per row
+    if isinstance(data, (list, tuple)) and len(data) > 0 and all(np.ndim(x) == 1 for x in data):
+        is_batch = True
+        data = [np.asarray(x) for x in data]
+    else:
+        data = np.asarray(data)
+        if data.ndim == 1:
+            is_batch = False
+            data = [data]
+        elif data.ndim == 2:
+            is_batch = True
+        else:
+            raise NameError('Data must be 1 dimensional, 2 dimensional or a list of 1 dimensional arrays')
+    if len(data) == 0:
+        raise NameError('Need at least 1 sample')
+    n = np.array([len(x) for x in data])
+    if num_quantiles > np.min(n) + 1:
+        num_quantiles = np.min(n) + 1
+    if np.min(n) < 2:
         raise NameError('Need at least 2 data points')
     if num_quantiles < 3:
         raise NameError('Need num_quantiles > 2')
     if confidence <= 0.0 or confidence >= 1.0:
         raise NameError('"confidence" must be between 0.0 and 1.0')
-    ci_lo = (1.0 - confidence) / 2.0
-    ci_hi = 1.0 - ci_lo
-
-    # sort the data, to make it more efficient looking for the min and max values
-    data = np.sort(data)
-
-    # compute empirical cumulative distribution (the function, not the values)
-    ecdf = ECDF(data)
-
-    # what are equispaced, the data axis or the quantile axis points?
-    if equispace == 'data':
-        # equispaced points in the data axis
-        data_out = np.linspace(data[0], data[-1], num_quantiles)
-        # corresponding quantile values
-        quantile_out = ecdf(data_out)
-    elif equispace == 'quantiles':
-        # inverse of the ECDF function
-        ecdf_inv = monotone_fn_inverter(ecdf, np.unique(data), vectorized=True)
-        # equispaced points in the quantile axis
-        quantile_out = np.linspace(ecdf(data[0]), 1.0, num_quantiles)
-        # corresponding data values
-        data_out = ecdf_inv(quantile_out)
-    else:
+    if equispace not in ['data', 'quantiles']:
         raise ValueError('"equispace" must be "data" or "quantile"')
-
-    # some estimators give confidence intervals on the *quantiles*, others give intervals on the *data*;
-    # which do we have?
-    if estimator_name == 'DKW':
-        estimator_type = 'quantile'
-        cdf_error_function = CDF_error_DKW_band
-    elif estimator_name == 'beta':
-        estimator_type = 'quantile'
-        cdf_error_function = CDF_error_beta
-    else:
+    if estimator_name not in ['DKW', 'beta']:
         raise NameError('Unknown error estimator name: ' + estimator_name)
 
+    data_out = np.zeros(shape=(len(data), num_quantiles), dtype=np.float64)
+    quantile_out = np.zeros(shape=(len(data), num_quantiles), dtype=np.float64)
+    for i, x in enumerate(data):
+
+        # sort the data, to make it more efficient looking for the min and max values
+        x = np.sort(x)
+
+        # empirical cumulative distribution values, as in statsmodels' ECDF
+        ecdf = np.linspace(1. / n[i], 1, n[i])
+
+        # what are equispaced, the data axis or the quantile axis points?
+        if equispace == 'data':
+            # equispaced points in the data axis
+            data_out[i, :] = np.linspace(x[0], x[-1], num_quantiles)
+            # corresponding quantile values
+            quantile_out[i, :] = np.concatenate(([0.0], ecdf))[np.searchsorted(x, data_out[i, :], side='right')]
+        else:
+            # equispaced points in the quantile axis, starting at the ECDF of the minimum value
+            tie_first, tie_last = _tie_indices(x)
+            quantile_out[i, :] = np.linspace(ecdf[tie_last[0]], 1.0, num_quantiles)
+            # corresponding data values, from the inverse of the ECDF function
+            data_out[i, :] = _ecdf_inverse_from_counts(x, tie_first, tie_last, np.ones(shape=(1, n[i]), dtype=np.int64),
+                                                       quantile_out[i, :])[0]
+
     # compute interval for each output point
-    quantile_ci_lo = np.zeros(shape=(num_quantiles,), dtype=np.float32)
-    quantile_ci_hi = np.zeros(shape=(num_quantiles,), dtype=np.float32)
-    if estimator_type == 'quantile':
-        for i, q in enumerate(quantile_out):
-            quantile_ci_lo[i] = cdf_error_function(len(data), q, ci_lo)
-            quantile_ci_hi[i] = cdf_error_function(len(data), q, ci_hi)
+    quantile_ci_lo, quantile_ci_hi = _ecdf_confidence_intervals(n, quantile_out, confidence, estimator_name)
+
+    if is_batch:
+        return data_out, quantile_out, quantile_ci_lo, quantile_ci_hi
     else:
-        raise NameError('Unknown error estimator type: ' + estimator_type)
+        return data_out[0, :], quantile_out[0, :], quantile_ci_lo[0, :], quantile_ci_hi[0, :]
+
+
+def _tie_indices(x_sorted):
+    """
+    First and last index of the tied values of each element of sorted data.
+
+    :param x_sorted: (n,)-np.ndarray with the data, sorted in ascending order.
+    :return: tie_first, tie_last: (n,)-np.ndarray with indices, so that x_sorted[tie_first[i]:tie_last[i]+1] are the
+    elements equal to x_sorted[i].
+    """
 
-    return data_out, quantile_out, quantile_ci_lo, quantile_ci_hi
+    n = len(x_sorted)
+    is_new = np.concatenate(([True], x_sorted[1:] != x_sorted[:-1]))
+    tie_first = np.maximum.accumulate(np.where(is_new, np.arange(n), 0))
+    tie_last = np.concatenate((np.nonzero(is_new)[0][1:], [n]))[np.cumsum(is_new) - 1] - 1
+
+    return tie_first, tie_last
+
+
+def _ecdf_inverse_from_counts(xy_sorted, tie_first, tie_last, counts, quantiles):
+    """
+    Inverse ECDF of many samples drawn from the same sorted data, for compare_ecdfs().
+
+    Each sample is given by how many times it contains each element of the sorted data, so the samples don't need to
+    be sorted, and only the elements around the quantiles are looked up. For each sample, this gives the same values
+    as monotone_fn_inverter(ECDF(sample), np.unique(sample))(quantiles), i.e. linear interpolation between the points
+    (ECDF(u), u) of the unique values u. Values are NaN for the quantiles smaller than the ECDF of the minimum value,
+    that are outside the interpolation range.
+
+    :param xy_sorted: (n,)-np.ndarray with the data, sorted in ascending order.
+    :param tie_first, tie_last: (n,)-np.ndarray with the first and last index of the tied values of each element.
+    :param counts: (B, n)-np.ndarray with the number of times each element is in each sample. All samples must have the
+    same size m = counts.sum(axis=1).
+    :param quantiles: (Q,)-np.ndarray with quantile values in [0.0, 1.0].
+    :return:
+    * (B, Q)-np.ndarray with the data values that correspond to the quantiles.
+    * (B,)-np.ndarray with the ECDF of the minimum value of each sample.
+    """
+
+    nrows, n = counts.shape
+    m = int(counts[0, :].sum())
+    ecdf = np.linspace(1. / m, 1, m)  # same ECDF values as statsmodels' ECDF
+    row = np.arange(nrows)[:, np.newaxis]
+
+    # number of sample elements up to each data element. Offsetting each row by m makes the flattened array sorted
+    cum_counts = np.cumsum(counts, axis=1)
+    cum_counts_flat = (cum_counts + row * m).ravel()
+
+    def data_index(rank):
+        # index in xy_sorted of the rank-th element (1, 2, ..., m) of each sorted sample
+        return np.searchsorted(cum_counts_flat, rank + row * m, side='left') - row * n
+
+    def num_below(i):
+        # number of sample elements smaller than the value of element i
+        return np.where(tie_first[i] > 0, cum_counts[row, tie_first[i] - 1], 0)
+
+    # j-th element of the sorted sample is the first one with ECDF >= quantile. The value of its group and of the
+    # previous group are the interpolation points around the quantile
+    j = np.minimum(np.searchsorted(ecdf, quantiles, side='left'), m - 1)
+    i_hi = data_index(np.broadcast_to(j + 1, (nrows, len(quantiles))))
+    first_j = num_below(i_hi)
+    last_j = cum_counts[row, tie_last[i_hi]] - 1
+    x_hi = ecdf[last_j]
+    y_hi = xy_sorted[i_hi]
+    x_lo = ecdf[np.maximum(first_j - 1, 0)]
+    y_lo = xy_sorted[data_index(np.maximum(first_j, 1))]
+
+    # linear interpolation, with the same arithmetic as scipy.interpolate.interp1d (np.interp), that gives the exact
+    # value at the interpolation points
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (y_hi - y_lo) / (x_hi - x_lo)
+        out = np.where(x_hi == quantiles, y_hi, slope * (quantiles - x_lo) + y_lo)
+
+    # quantiles in the first group can only be the ECDF of the minimum value
+    i_min = data_index(np.ones(shape=(nrows, 1), dtype=np.int64))
+    out = np.where(first_j == 0, xy_sorted[i_min], out)
+    ecdf_min = ecdf[cum_counts[row, tie_last[i_min]] - 1][:, 0]
+    out[quantiles < ecdf_min[:, np.newaxis]] = np.nan
+
+    return out, ecdf_min
+
+
+def _compare_ecdfs_block(xy_sorted, nx, quantiles, t, num_perms, seed, resampling_method):
+    """
+    Block of permutations or bootstrap samples for compare_ecdfs(), with its own random generator.
+
+    :return: (Q,)-np.ndarray with the number of resamplings with test statistic > t for each quantile.
+    """
+
+    rng = np.random.default_rng(seed)
+    n = len(xy_sorted)
+
+    # first and last index of the tied values of each element
+    tie_first, tie_last = _tie_indices(xy_sorted)
+
+    # samples as the number of times they contain each element of the sorted merged data
+    if resampling_method == 'permutation':
+        # random split of the merged data into two groups
+        counts_x = np.zeros(shape=(num_perms, n), dtype=np.int64)
+        for i in range(num_perms):
+            counts_x[i, rng.permutation(n)[:nx]] = 1
+        counts_y = 1 - counts_x
+    elif resampling_method == 'bootstrap':
+        # sampling with replacement from the merged data
+        offset = np.arange(num_perms)[:, np.newaxis] * n
+        counts_x = np.bincount((rng.integers(0, n, size=(num_perms, nx)) + offset).ravel(),
+                               minlength=num_perms * n).reshape(num_perms, n)
+        counts_y = np.bincount((rng.integers(0, n, size=(num_perms, n - nx)) + offset).ravel(),
+                               minlength=num_perms * n).reshape(num_perms, n)
+    else:
+        raise ValueError('Invalid resampling_method value')
+
+    x_data, x_ecdf_min = _ecdf_inverse_from_counts(xy_sorted, tie_first, tie_last, counts_x, quantiles)
+    y_data, y_ecdf_min = _ecdf_inverse_from_counts(xy_sorted, tie_first, tie_last, counts_y, quantiles)
+
+    # small quantile values are outside the interpolation range of either sample
+    ts = np.abs(x_data - y_data).astype(np.float32)
+    ts[quantiles < np.maximum(x_ecdf_min, y_ecdf_min)[:, np.newaxis]] = np.nan
+
+    return np.sum(ts > t, axis=0)
 
 
 def compare_ecdfs(x, y, alpha=0.05, num_quantiles=101, num_perms=1000, rng_seed=0,
-                  resampling_method='bootstrap', multitest_method=None):
+                  resampling_method='bootstrap', multitest_method=None, block_size=None, num_workers=0):
     """
     Compute p-values for the difference between each percentile point of the empirical cumulative distribution
     functions (ECDFs) of two samples x, y.
@@ -3829,6 +4855,13 @@ def compare_ecdfs(x, y, alpha=0.05, num_quantiles=101, num_perms=1000, rng_seed=
         - `fdr_by` : Benjamini/Yekutieli (negative)
         - `fdr_tsbh` : two stage fdr correction (non-negative)
         - `fdr_tsbky` : two stage fdr correction (non-negative)
+    :param block_size: (def None) If None, the permutations are computed one by one with statsmodels' ECDF. Otherwise,
+    the permutations are computed in blocks of block_size at once with NumPy array operations on the sorted merged
+    data, which is much faster for large samples. Each block uses its own random generator, seeded from rng_seed with
+    numpy.random.SeedSequence.spawn(), so results are reproducible and don't depend on num_workers, but they are not
+    the same random permutations as with block_size=None. Memory use is proportional to block_size * (len(x) + len(y)).
+    :param num_workers: (def 0) With block_size, number of processes the blocks are spread over. If num_workers=0,
+    blocks are computed in the current process. If None, the number of CPUs.
     :return:
     quantiles: numpy.ndarray vector with quantile values in [0.0, 1.0].
     pval: corresponding p-values for each quantile, whether adjusted or not.
@@ -3891,7 +4924,23 @@ def compare_ecdfs(x, y, alpha=0.05, num_quantiles=101, num_perms=1000, rng_seed=
     # init random generator
     rng = np.random.RandomState(rng_seed)
 
-    if resampling_method == 'bootstrap':
+    if block_size is not None:
+
+        # blocks of permutations, each one with its own seed
+        xy_sorted = np.sort(xy)
+        block_sizes = [min(block_size, num_perms - i) for i in range(0, num_perms, block_size)]
+        seeds = np.random.SeedSequence(rng_seed).spawn(len(block_sizes))
+        args = (itertools.repeat(xy_sorted), itertools.repeat(nx), itertools.repeat(quantiles), itertools.repeat(t),
+                block_sizes, seeds, itertools.repeat(resampling_method))
+        if num_workers == 0:
+            counts = list(map(_compare_ecdfs_block, *args))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers,
+                                                        mp_context=multiprocessing.get_context('spawn')) as executor:
+                counts = list(executor.map(_compare_ecdfs_block, *args))
+        pval += np.sum(counts, axis=0).astype(np.float32)
+
+    elif resampling_method == 'bootstrap':
 
         # bootstrap loop
         for i in range(num_perms):
@@ -3995,6 +5044,88 @@ def bspline_resample(xy, factor=1.0, min_n=0, k=1, is_closed=True):
     return xy_out
 
 
+def resample_contours(contours, factor=1.0, min_n=0, is_closed=True):
+    """
+    Resample a list of 2D curves with points equally spaced in arc length, using linear interpolation.
+
+    This is the same as calling bspline_resample(xy, factor=factor, min_n=min_n, k=1, is_closed=is_closed) for each
+    curve, but all curves are resampled together with vectorised operations, instead of fitting one B-spline per curve.
+
+    :param contours: List of (N_i, 2)-np.ndarray with (x,y)-coordinates.
+    :param factor: (def 1.0) The number of output points of each curve is computed as round(N_i*factor). See
+    bspline_resample().
+    :param min_n: (def 0) Minimum number of resampled points of each curve.
+    :param is_closed: (def True) Treat each curve as closed.
+    :return:
+    contours_out: List of (M_i, 2)-np.ndarray with coordinates of the resampled curves.
+    """
+
+    if len(contours) == 0:
+        return []
+
+    for xy in contours:
+        if type(xy) != np.ndarray or xy.ndim != 2 or xy.shape[1] != 2:
+            raise ValueError('Each contour must be a 2-column np.ndarray')
+
+    # concatenate all curves, and remember which curve each point belongs to
+    n_in = np.array([xy.shape[0] for xy in contours])
+    xy = np.concatenate(contours, axis=0).astype(np.float64)
+    idx_curve = np.repeat(np.arange(len(contours)), n_in)
+    idx_first = np.concatenate(([0], np.cumsum(n_in)[:-1]))
+    idx_last = idx_first + n_in - 1
+
+    # remove repeated consecutive points. For closed curves, the first point is also removed if it's the same as the
+    # last point
+    is_kept = np.ones(shape=(xy.shape[0],), dtype=np.bool)
+    is_kept[1:] = np.any(np.diff(xy, axis=0) != 0, axis=1)
+    if is_closed:
+        is_kept[idx_first] = np.any(xy[idx_first, :] != xy[idx_last, :], axis=1)
+    else:
+        is_kept[idx_first] = True
+    xy = xy[is_kept, :]
+    idx_curve = idx_curve[is_kept]
+    n_in = np.bincount(idx_curve, minlength=len(contours))
+    if np.any(n_in < 2):
+        raise ValueError('Each contour must have at least two different points')
+    idx_first = np.concatenate(([0], np.cumsum(n_in)[:-1]))
+
+    # for closed curves, add a duplicate of the first point at the end of each curve
+    if is_closed:
+        xy = np.insert(xy, np.concatenate((idx_first[1:], [xy.shape[0]])), xy[idx_first, :], axis=0)
+        idx_curve = np.repeat(np.arange(len(contours)), n_in + 1)
+        n_in += 1
+        idx_first = np.concatenate(([0], np.cumsum(n_in)[:-1]))
+
+    # arc length parameter of each point within its curve
+    seg_len = np.sqrt(np.sum(np.diff(xy, axis=0) ** 2, axis=1))
+    seg_len = np.concatenate(([0.0], seg_len))
+    seg_len[idx_first] = 0.0
+    arc = np.cumsum(seg_len)
+    arc_first = arc[idx_first]
+    arc_last = arc[idx_first + n_in - 1]
+
+    # to interpolate all curves at once, curves are placed one after another along the arc length parameter with a
+    # 1.0 gap between them
+    shift = np.cumsum(np.concatenate(([0.0], arc_last[:-1] - arc_first[:-1] + 1.0))) - arc_first
+    arc += shift[idx_curve]
+
+    # number of output points
+    n_out = np.round(n_in * factor).astype(np.int64)
+    n_out = np.maximum(n_out, min_n)
+
+    # arc length of the output points, equally spaced between the first and last point of each curve
+    idx_curve_out = np.repeat(np.arange(len(contours)), n_out)
+    idx_first_out = np.concatenate(([0], np.cumsum(n_out)[:-1]))
+    step = np.arange(len(idx_curve_out)) - idx_first_out[idx_curve_out]
+    t = step / np.maximum(n_out[idx_curve_out] - 1, 1)
+    arc_out = (arc_first + shift)[idx_curve_out] + t * (arc_last - arc_first)[idx_curve_out]
+
+    # linear interpolation
+    xy_out = np.column_stack((np.interp(arc_out, arc, xy[:, 0]), np.interp(arc_out, arc, xy[:, 1])))
+
+    return np.split(xy_out, np.cumsum(n_out)[:-1], axis=0)
+
+
 def plot_confusion_matrix(y_true, y_pred,
                           normalize=False,
                           title=None,
@@ -120,7 +120,7 @@ import time
 import openslide
 import numpy as np
 import matplotlib.pyplot as plt
-from cytometer.utils import rough_foreground_mask, bspline_resample
+from cytometer.utils import rough_foreground_mask, rough_foreground_mask_fast, bspline_resample
 import PIL
 from keras import backend as K
 import scipy.stats
@@ -171,6 +171,10 @@ hole_size_treshold = 8000
 std_k = 1.00
 enhance_contrast = 4.0
 ignore_white_threshold = 253
+# rough_foreground_mask_fast() does the morphological operations on a mask reduced by this factor, which is faster and
+# uses less memory on large GTEx slides. The mask is an approximation with blocky edges (1 gives the same mask as
+# rough_foreground_mask())
+morphology_downsample = 4
 
 # contour parameters
 contour_downsample_factor = 0.1
@@ -1254,7 +1258,11 @@ for i_file, histo_file in enumerate(histo_files_list):
         with np.load(rough_mask_file) as aux:
             lores_istissue = aux['lores_istissue']
             lores_istissue0 = aux['lores_istissue0']
-            im_downsampled = aux['im_downsampled']
+            if 'colour_mode' in aux.files:
+                colour_mode = aux['colour_mode']
+            else:
+                # rough mask file saved by a previous version of this script
+                colour_mode, _ = cytometer.utils.colour_mode_std(aux['im_downsampled'])
             step = aux['step'].item()
             perc_completed_all = list(aux['perc_completed_all'])
             time_step_all = list(aux['time_step_all'])
@@ -1267,16 +1275,21 @@ for i_file, histo_file in enumerate(histo_files_list):
 
         time_prev = time.time()
 
-        # compute the rough foreground mask of tissue vs. background
-        lores_istissue0, im_downsampled = \
-            rough_foreground_mask(histo_file, downsample_factor=downsample_factor_actual,
-                                  dilation_size=dilation_size,
-                                  component_size_threshold=component_size_threshold,
-                                  hole_size_treshold=hole_size_treshold, std_k=std_k,
-                                  return_im=True, enhance_contrast=enhance_contrast,
-                                  ignore_white_threshold=ignore_white_threshold)
+        # compute the rough foreground mask of tissue vs. background, and the colour statistics of the downsampled
+        # image, without keeping the image in memory
+        lores_istissue0, colour_stats = \
+            rough_foreground_mask_fast(histo_file, downsample_factor=downsample_factor_actual,
+                                       dilation_size=dilation_size,
+                                       component_size_threshold=component_size_threshold,
+                                       hole_size_treshold=hole_size_treshold, std_k=std_k,
+                                       return_im=False, enhance_contrast=enhance_contrast,
+                                       ignore_white_threshold=ignore_white_threshold,
+                                       morphology_downsample=morphology_downsample, return_colour_stats=True)
+        colour_mode = colour_stats['mode']
 
         if DEBUG:
+            stats = cytometer.utils.slide_statistics(histo_file, downsample_factor=downsample_factor_actual)
+            im_downsampled = stats['im_downsampled']
             enhancer = PIL.ImageEnhance.Contrast(PIL.Image.fromarray(im_downsampled))
             im_downsampled_enhanced = np.array(enhancer.enhance(enhance_contrast))
             plt.clf()
@@ -1300,7 +1313,7 @@ for i_file, histo_file in enumerate(histo_files_list):
 
         # save to the rough mask file
         np.savez_compressed(rough_mask_file, lores_istissue=lores_istissue, lores_istissue0=lores_istissue0,
-                            im_downsampled=im_downsampled, step=step, perc_completed_all=perc_completed_all,
+                            colour_mode=colour_mode, step=step, perc_completed_all=perc_completed_all,
                             prev_first_row=prev_first_row, prev_last_row=prev_last_row,
                             prev_first_col=prev_first_col, prev_last_col=prev_last_col,
                             time_step_all=time_step_all)
@@ -1319,6 +1332,8 @@ for i_file, histo_file in enumerate(histo_files_list):
           ', total time ' + "{0:.2f}".format(time_total) + ' s')
 
     if DEBUG:
+            stats = cytometer.utils.slide_statistics(histo_file, downsample_factor=downsample_factor_actual)
+            im_downsampled = stats['im_downsampled']
             plt.clf()
             plt.subplot(211)
             plt.imshow(im_downsampled)
@@ -1332,9 +1347,7 @@ for i_file, histo_file in enumerate(histo_files_list):
     # estimate the colour mode of the downsampled image, so that we can correct the image tint to match the KLF14
     # training dataset. We apply the same correction to each tile, to avoid that a tile with e.g. only muscle gets
     # overcorrected
-    mode_r_rrbe1 = scipy.stats.mode(im_downsampled[:, :, 0], axis=None).mode[0]
-    mode_g_rrbe1 = scipy.stats.mode(im_downsampled[:, :, 1], axis=None).mode[0]
-    mode_b_rrbe1 = scipy.stats.mode(im_downsampled[:, :, 2], axis=None).mode[0]
+    mode_r_rrbe1, mode_g_rrbe1, mode_b_rrbe1 = colour_mode
 
     # keep extracting histology windows until we have finished
     while np.count_nonzero(lores_istissue) > 0:
@@ -1598,7 +1611,7 @@ for i_file, histo_file in enumerate(histo_files_list):
 
         # save to the rough mask file
         np.savez_compressed(rough_mask_file, lores_istissue=lores_istissue, lores_istissue0=lores_istissue0,
-                            im_downsampled=im_downsampled, step=step, perc_completed_all=   perc_completed_all,
+                            colour_mode=colour_mode, step=step, perc_completed_all=   perc_completed_all,
                             time_step_all=time_step_all,
                             prev_first_row=prev_first_row, prev_last_row=prev_last_row,
                             prev_first_col=prev_first_col, prev_last_col=prev_last_col)
@@ -93,6 +93,7 @@ if os.path.join(home, 'Software/cytometer') not in sys.path:
     sys.path.extend([os.path.join(home, 'Software/cytometer')])
 import cytometer.utils
 import cytometer.data
+import cytometer.models
 
 # Filter out INFO & WARNING messages
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
@@ -189,6 +190,12 @@ correction_window_len = 401
 correction_smoothing = 11
 batch_size = 16
 
+# tiles are not padded for the segmentation networks, so that the results are the same as without shape buckets. To
+# build only one model per size, pad tiles to one of these sizes instead (the outputs near the bottom and right edges
+# of the tiles change slightly):
+# shape_buckets = [(r, c) for r in (1001, 2001, fullres_box_size[0]) for c in (1001, 2001, fullres_box_size[1])]
+shape_buckets = None
+
 ########################################################################################################################
 # dictionary of images and the folds they will be processing under
 ########################################################################################################################
@@ -393,6 +400,12 @@ else:
 ## Segmentation loop
 ########################################################################################################################
 
+# models are loaded once from file, and reused for all tiles and slides from the same fold
+if shape_buckets is None:
+    model_cache = cytometer.models.ModelCache()
+else:
+    model_cache = cytometer.models.ModelCache(max_models=3 * len(shape_buckets) + 4)
+
 # DEBUG: i_file = 9; histo_file = list(histo_files_list.keys())[i_file]
 for i_file, histo_file in enumerate(histo_files_list.keys()):
 
@@ -433,11 +446,21 @@ for i_file, histo_file in enumerate(histo_files_list.keys()):
     annotations_corrected_file = os.path.splitext(annotations_corrected_file)[0]
     annotations_corrected_file = os.path.join(annotations_dir, annotations_corrected_file + '_exp_0106_corrected.json')
 
-    # name of file to save rough mask, current mask, and time steps
+    # name of file to save rough mask and downsampled image
     coarse_mask_file = os.path.basename(histo_file)
     coarse_mask_file = coarse_mask_file.replace(histology_ext, '_coarse_mask.npz')
     coarse_mask_file = os.path.join(annotations_dir, coarse_mask_file)
 
+    # name of file to log the processed windows, mask updates and time steps
+    job_state_file = os.path.basename(histo_file)
+    job_state_file = job_state_file.replace(histology_ext, '_job_state.jsonl')
+    job_state_file = os.path.join(annotations_dir, job_state_file)
+
+    # name of file to save the quantile sketch of corrected cell areas, that can be merged with other slides' sketches
+    area_sketch_file = os.path.basename(histo_file)
+    area_sketch_file = area_sketch_file.replace(histology_ext, '_exp_0106_area_sketch.npz')
+    area_sketch_file = os.path.join(annotations_dir, area_sketch_file)
+
     # open full resolution histology slide
     im = openslide.OpenSlide(histo_file)
 
@@ -446,7 +469,8 @@ for i_file, histo_file in enumerate(histo_files_list.keys()):
     yres = float(im.properties['openslide.mpp-y']) # um/pixel
 
     # check whether we continue previous execution, or we start a new one
-    continue_previous = os.path.isfile(coarse_mask_file)
+    job_state = cytometer.data.SlideJobState(job_state_file, mode='a', number_of_attempts=5)
+    continue_previous = os.path.isfile(coarse_mask_file) and len(job_state) > 0
 
     # true downsampled factor as reported by histology file
     level_actual = np.abs(np.array(im.level_downsamples) - downsample_factor_goal).argmin()
@@ -459,16 +483,32 @@ for i_file, histo_file in enumerate(histo_files_list.keys()):
     if continue_previous:
 
         with np.load(coarse_mask_file) as aux:
-            lores_istissue = aux['lores_istissue']
             lores_istissue0 = aux['lores_istissue0']
             im_downsampled = aux['im_downsampled']
-            step = aux['step'].item()
-            perc_completed_all = list(aux['perc_completed_all'])
-            time_step_all = list(aux['time_step_all'])
-            prev_first_row = aux['prev_first_row'].item()
-            prev_last_row = aux['prev_last_row'].item()
-            prev_first_col = aux['prev_first_col'].item()
-            prev_last_col = aux['prev_last_col'].item()
+
+        # replay the mask updates of the previous execution
+        lores_istissue = lores_istissue0.copy()
+        step = 0
+        perc_completed_all = []
+        time_step_all = []
+        (prev_first_row, prev_last_row, prev_first_col, prev_last_col) = (0, 0, 0, 0)
+        area_sketch = cytometer.data.QuantileSketch()
+        for record in job_state.records:
+            step = record['step']
+            if 'lores' in record:
+                (lores_first_row, lores_last_row, lores_first_col, lores_last_col) = record['lores']
+                if record['lores_window'] is None:
+                    lores_istissue[lores_first_row:lores_last_row, lores_first_col:lores_last_col] = 0
+                else:
+                    lores_istissue[lores_first_row:lores_last_row, lores_first_col:lores_last_col] = \
+                        cytometer.data.SlideJobState.decode_mask(record['lores_window'])
+            if record.get('tile') is not None:
+                (prev_first_row, prev_last_row, prev_first_col, prev_last_col) = record['tile']
+            if 'time_step' in record:
+                perc_completed_all.append(record['perc_completed'])
+                time_step_all.append(record['time_step'])
+            if record.get('area_sketch') is not None:
+                area_sketch.merge(cytometer.data.QuantileSketch.from_dict(record['area_sketch']))
 
     else:
 
@@ -481,7 +521,7 @@ for i_file, histo_file in enumerate(histo_files_list.keys()):
                                   component_size_threshold=component_size_threshold,
                                   hole_size_treshold=hole_size_treshold, std_k=std_k,
                                   return_im=True, enhance_contrast=enhance_contrast,
-                                  ignore_white_threshold=ignore_white_threshold)
+                                  ignore_white_threshold=ignore_white_threshold, cache_dir=annotations_dir)
 
         if DEBUG:
             enhancer = PIL.ImageEnhance.Contrast(PIL.Image.fromarray(im_downsampled))
@@ -504,13 +544,16 @@ for i_file, histo_file in enumerate(histo_files_list.keys()):
         time_step = time.time() - time_prev
         time_step_all = [time_step,]
         (prev_first_row, prev_last_row, prev_first_col, prev_last_col) = (0, 0, 0, 0)
+        area_sketch = cytometer.data.QuantileSketch()
 
-        # save to the rough mask file
-        np.savez_compressed(coarse_mask_file, lores_istissue=lores_istissue, lores_istissue0=lores_istissue0,
-                            im_downsampled=im_downsampled, step=step, perc_completed_all=perc_completed_all,
-                            prev_first_row=prev_first_row, prev_last_row=prev_last_row,
-                            prev_first_col=prev_first_col, prev_last_col=prev_last_col,
-                            time_step_all=time_step_all)
+        # save to the rough mask file. This file is only written once per slide, and the changes to the mask in each
+        # step are appended to the job state log
+        np.savez_compressed(coarse_mask_file + '.tmp.npz', lores_istissue0=lores_istissue0,
+                            im_downsampled=im_downsampled)
+        os.replace(coarse_mask_file + '.tmp.npz', coarse_mask_file)
+        job_state.close()
+        job_state = cytometer.data.SlideJobState(job_state_file, mode='w', number_of_attempts=5)
+        job_state.append({'step': step, 'perc_completed': perc_completed_all[-1], 'time_step': time_step})
 
         # end "computing the rough foreground mask"
 
@@ -539,9 +582,18 @@ for i_file, histo_file in enumerate(histo_files_list.keys()):
     # estimate the colour mode of the downsampled image, so that we can correct the image tint to match the KLF14
     # training dataset. We apply the same correction to each tile, to avoid that a tile with e.g. only muscle gets
     # overcorrected
-    mode_r_tile = scipy.stats.mode(im_downsampled[:, :, 0], axis=None).mode[0]
-    mode_g_tile = scipy.stats.mode(im_downsampled[:, :, 1], axis=None).mode[0]
-    mode_b_tile = scipy.stats.mode(im_downsampled[:, :, 2], axis=None).mode[0]
+    (mode_r_tile, mode_g_tile, mode_b_tile), _ = cytometer.utils.colour_mode_std(im_downsampled)
+
+    # open the annotations files, so that we only need to append the new items in each step. In the first step,
+    # overwrite previous annotations files, or create new ones. Otherwise, roll back any items written after the last
+    # step in the job state log
+    last_record = job_state.last('annotations')
+    annotations_writer = cytometer.data.AidaAnnotationWriter(
+        annotations_file, mode='w' if last_record is None else 'a', number_of_attempts=5,
+        layer_item_counts=None if last_record is None else last_record['annotations'])
+    annotations_corrected_writer = cytometer.data.AidaAnnotationWriter(
+        annotations_corrected_file, mode='w' if last_record is None else 'a', number_of_attempts=5,
+        layer_item_counts=None if last_record is None else last_record['annotations_corrected'])
 
     # keep extracting histology windows until we have finished
     while np.count_nonzero(lores_istissue) > 0:
@@ -573,6 +625,10 @@ for i_file, histo_file in enumerate(histo_files_list.keys()):
             # from being wiped out, and the big edge labels keep the window selection being almost the same. Thus, we
             # wipe it out and move to another tissue area
             lores_istissue[lores_first_row:lores_last_row, lores_first_col:lores_last_col] = 0
+            job_state.append({'step': step,
+                              'lores': [int(lores_first_row), int(lores_last_row),
+                                        int(lores_first_col), int(lores_last_col)],
+                              'lores_window': None})
             continue
 
         else:
@@ -620,7 +676,8 @@ for i_file, histo_file in enumerate(histo_files_list.keys()):
                                                      correction_window_len=correction_window_len,
                                                      correction_smoothing=correction_smoothing,
                                                      return_bbox=True, return_bbox_coordinates='xy',
-                                                     batch_size=batch_size)
+                                                     batch_size=batch_size, model_cache=model_cache,
+                                                     shape_buckets=shape_buckets)
 
 
         # compute the "white adipocyte" probability for each object
@@ -633,6 +690,9 @@ for i_file, histo_file in enumerate(histo_files_list.keys()):
             window_white_adipocyte_prob = np.array([])
             window_white_adipocyte_prob_corrected = np.array([])
 
+        # quantile sketch of the corrected cell areas in this window
+        tile_area_sketch = cytometer.data.QuantileSketch()
+
         # if no cells found, wipe out current window from tissue segmentation, and go to next iteration. Otherwise we'd
         # enter an infinite loop
         if len(index_list) == 0:  # empty segmentation
@@ -757,29 +817,23 @@ for i_file, histo_file in enumerate(histo_files_list.keys()):
             rectangle = (first_col, first_row, last_col - first_col, last_row - first_row)  # (x0, y0, width, height)
             rectangle_item = cytometer.data.aida_rectangle_items([rectangle,])
 
-            # sometimes the network filesystem's server gives a ConnectionResetError. If that's the case, we try 
-            if step == 1:
-                # in the first step, overwrite previous annotations file, or create new one
-                cytometer.data.aida_write_new_items(annotations_file, rectangle_item, mode='w', number_of_attempts=5)
-                cytometer.data.aida_write_new_items(annotations_file, contour_items, mode='append_new_layer', number_of_attempts=5)
-            else:
-                # in next steps, add contours to previous layer
-                cytometer.data.aida_write_new_items(annotations_file, rectangle_item, mode='append_to_last_layer', number_of_attempts=5)
-                cytometer.data.aida_write_new_items(annotations_file, contour_items, mode='append_new_layer', number_of_attempts=5)
+            # add rectangle to the blocks layer, and contours to a new layer
+            annotations_writer.write_new_items(rectangle_item, mode='append_to_last_layer')
+            annotations_writer.write_new_items(contour_items, mode='append_new_layer')
 
             # convert corrected contours to AIDA items
             contour_items_corrected = cytometer.data.aida_contour_items(lores_contours_corrected, f_area2quantile_m,
                                                                         cell_prob=window_white_adipocyte_prob_corrected,
                                                                         xres=xres, yres=yres)
 
-            if step == 1:
-                # in the first step, overwrite previous annotations file, or create new one
-                cytometer.data.aida_write_new_items(annotations_corrected_file, rectangle_item, mode='w', number_of_attempts=5)
-                cytometer.data.aida_write_new_items(annotations_corrected_file, contour_items_corrected, mode='append_new_layer', number_of_attempts=5)
-            else:
-                # in next steps, add contours to previous layer
-                cytometer.data.aida_write_new_items(annotations_corrected_file, rectangle_item, mode='append_to_last_layer', number_of_attempts=5)
-                cytometer.data.aida_write_new_items(annotations_corrected_file, contour_items_corrected, mode='append_new_layer', number_of_attempts=5)
+            annotations_corrected_writer.write_new_items(rectangle_item, mode='append_to_last_layer')
+            annotations_corrected_writer.write_new_items(contour_items_corrected, mode='append_new_layer')
+
+            # add corrected cell areas (um^2) to the slide's quantile sketch
+            xy, offsets = cytometer.data.pack_contours(lores_contours_corrected)
+            tile_area_sketch.update(cytometer.data.polygon_metrics(xy * np.array([xres, yres]), offsets)['area'])
+            area_sketch.merge(tile_area_sketch)
+            area_sketch.save(area_sketch_file)
 
             # update the tissue segmentation mask with the current window
             if np.all(lores_istissue[lores_first_row:lores_last_row, lores_first_col:lores_last_col] == lores_todo_edge):
@@ -808,19 +862,30 @@ for i_file, histo_file in enumerate(histo_files_list.keys()):
               'time step ' + "{0:.2f}".format(time_step) + ' s' +
               ', total time ' + "{0:.2f}".format(time_total) + ' s')
 
-        # save to the rough mask file
-        np.savez_compressed(coarse_mask_file, lores_istissue=lores_istissue, lores_istissue0=lores_istissue0,
-                            im_downsampled=im_downsampled, step=step, perc_completed_all=   perc_completed_all,
-                            time_step_all=time_step_all,
-                            prev_first_row=prev_first_row, prev_last_row=prev_last_row,
-                            prev_first_col=prev_first_col, prev_last_col=prev_last_col)
-
-        # clear keras session to prevent each segmentation iteration from getting slower. Note that this forces us to
-        # reload the models every time, but that's not too slow
-        K.clear_session()
+        # append the changes of this step to the job state log, instead of saving the whole mask again
+        lores_window = lores_istissue[lores_first_row:lores_last_row, lores_first_col:lores_last_col]
+        job_state.append({'step': step,
+                          'tile': [int(first_row), int(last_row), int(first_col), int(last_col)],
+                          'lores': [int(lores_first_row), int(lores_last_row),
+                                    int(lores_first_col), int(lores_last_col)],
+                          'lores_window': None if not np.any(lores_window)
+                          else cytometer.data.SlideJobState.encode_mask(lores_window),
+                          'perc_completed': float(perc_completed), 'time_step': float(time_step),
+                          'annotations': annotations_writer.layer_item_counts(),
+                          'annotations_corrected': annotations_corrected_writer.layer_item_counts(),
+                          'area_sketch': tile_area_sketch.to_dict()})
+
+        # clear keras session if too many models have been built, to prevent each segmentation iteration from getting
+        # slower. The cache keeps the models' weights in memory, so they don't need to be reloaded from file
+        model_cache.check_session()
 
     # end of "keep extracting histology windows until we have finished"
 
+    annotations_writer.close()
+    annotations_corrected_writer.close()
+    job_state.close()
+    area_sketch.save(area_sketch_file)
+
 ########################################################################################################################
 ## Compute area to quantile map used for colourmaps (using all automatically segmented data)
 ########################################################################################################################
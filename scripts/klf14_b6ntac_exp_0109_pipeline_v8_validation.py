@@ -560,9 +560,7 @@ for i, file_svg in enumerate(file_svg_list):
     im_downsampled = np.array(im_downsampled)
     im_downsampled = im_downsampled[:, :, 0:3]
 
-    mode_r_tile = scipy.stats.mode(im_downsampled[:, :, 0], axis=None).mode[0]
-    mode_g_tile = scipy.stats.mode(im_downsampled[:, :, 1], axis=None).mode[0]
-    mode_b_tile = scipy.stats.mode(im_downsampled[:, :, 2], axis=None).mode[0]
+    (mode_r_tile, mode_g_tile, mode_b_tile), _ = cytometer.utils.colour_mode_std(im_downsampled)
 
     im[:, :, 0] = im[:, :, 0] + (mode_r_target - mode_r_tile)
     im[:, :, 1] = im[:, :, 1] + (mode_g_target - mode_g_tile)
@@ -971,9 +969,7 @@ else:
         im_downsampled = np.array(im_downsampled)
         im_downsampled = im_downsampled[:, :, 0:3]
 
-        mode_r_tile = scipy.stats.mode(im_downsampled[:, :, 0], axis=None).mode[0]
-        mode_g_tile = scipy.stats.mode(im_downsampled[:, :, 1], axis=None).mode[0]
-        mode_b_tile = scipy.stats.mode(im_downsampled[:, :, 2], axis=None).mode[0]
+        (mode_r_tile, mode_g_tile, mode_b_tile), _ = cytometer.utils.colour_mode_std(im_downsampled)
 
         im[:, :, 0] = im[:, :, 0] + (mode_r_target - mode_r_tile)
         im[:, :, 1] = im[:, :, 1] + (mode_g_target - mode_g_tile)
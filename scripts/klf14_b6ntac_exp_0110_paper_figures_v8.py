@@ -379,9 +379,7 @@ if SAVE_FIGS:
                 bbox_inches='tight', pad_inches=0)
 
 # segmentation of the training image
-mode_r_tile = scipy.stats.mode(im_downsampled[:, :, 0], axis=None).mode[0]
-mode_g_tile = scipy.stats.mode(im_downsampled[:, :, 1], axis=None).mode[0]
-mode_b_tile = scipy.stats.mode(im_downsampled[:, :, 2], axis=None).mode[0]
+(mode_r_tile, mode_g_tile, mode_b_tile), _ = cytometer.utils.colour_mode_std(im_downsampled)
 
 tile[:, :, 0] = tile[:, :, 0] + (mode_r_target - mode_r_tile)
 tile[:, :, 1] = tile[:, :, 1] + (mode_g_target - mode_g_tile)
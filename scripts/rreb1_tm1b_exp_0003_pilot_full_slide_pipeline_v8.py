@@ -391,9 +391,7 @@ for i_file, ndpi_file in enumerate(ndpi_files_list):
     # estimate the colour mode of the downsampled image, so that we can correct the image tint to match the KLF14
     # training dataset. We apply the same correction to each tile, to avoid that a tile with e.g. only muscle gets
     # overcorrected
-    mode_r_rrbe1 = scipy.stats.mode(im_downsampled[:, :, 0], axis=None).mode[0]
-    mode_g_rrbe1 = scipy.stats.mode(im_downsampled[:, :, 1], axis=None).mode[0]
-    mode_b_rrbe1 = scipy.stats.mode(im_downsampled[:, :, 2], axis=None).mode[0]
+    (mode_r_rrbe1, mode_g_rrbe1, mode_b_rrbe1), _ = cytometer.utils.colour_mode_std(im_downsampled)
 
     # keep extracting histology windows until we have finished
     while np.count_nonzero(lores_istissue) > 0:
@@ -94,17 +94,9 @@ def process_annotations(annotation_files_list, overwrite_aggregated_annotation_f
             cells, props = cytometer.data.aida_get_contours(annotation_file, layer_name='White adipocyte.*', return_props=True)
 
             # compute cell measures
-            areas = []
-            inv_compactnesses = []
-            for cell in cells:
-                poly_cell = shapely.geometry.Polygon(cell)
-                area = poly_cell.area
-                if area > 0:
-                    inv_compactness = poly_cell.length ** 2 / (4 * np.pi * area)
-                else:
-                    inv_compactness = np.nan
-                areas.append(area)
-                inv_compactnesses.append(inv_compactness)
+            metrics = cytometer.data.polygon_metrics(*cytometer.data.pack_contours(cells))
+            areas = metrics['area']
+            inv_compactnesses = metrics['inv_compactness']
 
             # prepare for removal objects that are too large or too small
             idx = (np.array(areas) >= min_area) * (np.array(areas) <= max_area)
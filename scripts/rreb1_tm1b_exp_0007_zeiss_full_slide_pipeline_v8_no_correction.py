@@ -333,9 +333,7 @@ for i_file, histo_file in enumerate(histo_files_list):
     #
     # Note: we ignore black pixels that correspond to where the scanner didn't scan
     non_black_mask = np.prod(im_downsampled <= 0, axis=2) == 0
-    mode_r_slide = scipy.stats.mode(im_downsampled[:, :, 0][non_black_mask]).mode[0]
-    mode_g_slide = scipy.stats.mode(im_downsampled[:, :, 1][non_black_mask]).mode[0]
-    mode_b_slide = scipy.stats.mode(im_downsampled[:, :, 2][non_black_mask]).mode[0]
+    (mode_r_slide, mode_g_slide, mode_b_slide), _ = cytometer.utils.colour_mode_std(im_downsampled, mask=non_black_mask)
 
     # keep extracting histology windows until we have finished
     while np.count_nonzero(lores_istissue) > 0:
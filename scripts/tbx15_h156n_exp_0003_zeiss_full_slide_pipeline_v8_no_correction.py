@@ -369,9 +369,7 @@ for i_file, histo_file in enumerate(histo_files_list):
     # f_val_to_ecdf_b_im_l5 = scipy.interpolate.interp1d(val_b_im_l5, p, fill_value=(0.0, 1.0), bounds_error=False)
 
     # background colour of the slide
-    mode_im_l5 = [float(scipy.stats.mode(im_l5[:, :, 0][non_black_mask]).mode[0]),
-                  float(scipy.stats.mode(im_l5[:, :, 1][non_black_mask]).mode[0]),
-                  float(scipy.stats.mode(im_l5[:, :, 2][non_black_mask]).mode[0])]
+    mode_im_l5 = [float(x) for x in cytometer.utils.colour_mode_std(im_l5, mask=non_black_mask)[0]]
 
     # if DEBUG:
     #     # colour correction of slide